@@ -1,231 +1,3654 @@
 import asyncio
+import bz2
+import functools
+import gzip
 import os
 import json
+import atexit
+import bisect
+import contextvars
+import hashlib
+import heapq
 import logging
-from typing import Optional, Dict, Any, List
+import logging.handlers
+import lzma
+import math
+import mmap
+import queue
+import re
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields, is_dataclass
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable, Union
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 import sys
 
 import aiohttp
+from aiohttp import http_parser
 from aiohttp_sse_client.client import EventSource
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APITimeoutError
+from openai.types.chat import ChatCompletion
+
+# 可选的高性能 JSON 库：安装后自动使用，未安装时使用标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# 可选：车票结果的列式筛选排序使用 NumPy 向量化，未安装时逐行计算
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # 加载环境变量
 load_dotenv()
 
+# 各组件日志记录器，可在 logging.components 中单独设置级别
+logger = logging.getLogger("mcp_client")
+rpc_logger = logging.getLogger("mcp_client.rpc")
+llm_logger = logging.getLogger("mcp_client.llm")
+memory_logger = logging.getLogger("mcp_client.memory")
+
+# 后台日志监听器：控制台和文件 I/O 在独立线程中执行，不占用事件循环
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+# ===== Python 3.7/3.8 兼容性函数 =====
+async def async_input(prompt: str) -> str:
+    """
+    异步输入函数，兼容Python 3.7+
+    在守护线程中阻塞读取输入：退出时不必等待用户按回车，线程池也不会被占用
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            error = e
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(error))
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(line))
+    
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+def atomic_write_text(path: str, text: Union[str, bytes]):
+    """
+    原子写入文本文件：先写入同目录下的临时文件并 fsync，再 rename 覆盖目标，
+    进程崩溃时磁盘上只会存在旧文件或新文件，不会出现写了一半的 JSON
+    text 为 bytes 时按原样写入（已是 UTF-8 编码的 JSON）
+    """
+    target = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{target.name}.", suffix=".tmp", dir=str(target.parent))
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(text, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, str(target))
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonCodec:
+    """
+    JSON 编解码器（标准库实现，也是其他实现的回退）
+    dumps 返回 UTF-8 字节，可直接写文件或作为请求体；dumps_text 返回字符串；
+    loads 接受 str 或 bytes，解析失败时抛出 ValueError（json.JSONDecodeError 是其子类）
+    """
+    
+    name = "json"
+    
+    @staticmethod
+    def _stdlib_dumps(obj: Any, indent: bool, sort_keys: bool) -> str:
+        return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, sort_keys=sort_keys)
+    
+    def dumps(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> bytes:
+        return self._stdlib_dumps(obj, indent, sort_keys).encode('utf-8')
+    
+    def dumps_text(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+        return self._stdlib_dumps(obj, indent, sort_keys)
+    
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson 实现：编码直接产生 UTF-8 字节，大块车票结果的编解码明显快于标准库"""
+    
+    name = "orjson"
+    
+    def dumps(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            # orjson 不支持的值（如超过 64 位的整数）交给标准库
+            return self._stdlib_dumps(obj, indent, sort_keys).encode('utf-8')
+    
+    def dumps_text(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+        return self.dumps(obj, indent, sort_keys).decode('utf-8')
+    
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+class MsgspecCodec(JsonCodec):
+    """msgspec 实现；需要排序键时使用标准库"""
+    
+    name = "msgspec"
+    
+    def dumps(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> bytes:
+        if sort_keys:
+            return self._stdlib_dumps(obj, indent, sort_keys).encode('utf-8')
+        try:
+            data = msgspec.json.encode(obj)
+        except (TypeError, msgspec.EncodeError):
+            return self._stdlib_dumps(obj, indent, sort_keys).encode('utf-8')
+        return msgspec.json.format(data, indent=2) if indent else data
+    
+    def dumps_text(self, obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+        return self.dumps(obj, indent, sort_keys).decode('utf-8')
+    
+    def loads(self, data: Union[str, bytes]) -> Any:
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+
+JSON_CODECS = {"json": JsonCodec, "orjson": OrjsonCodec, "msgspec": MsgspecCodec}
+
+
+def select_json_codec(name: str = "auto") -> JsonCodec:
+    """按名称创建编解码器；auto 依次尝试 orjson、msgspec、标准库，指定的库未安装时回退到标准库"""
+    installed = {"json": True, "orjson": orjson is not None, "msgspec": msgspec is not None}
+    if name == "auto":
+        name = next(candidate for candidate in ("orjson", "msgspec", "json") if installed[candidate])
+    elif not installed.get(name):
+        logger.warning(f"⚠️ JSON 实现 {name} 不可用，使用标准库 json")
+        name = "json"
+    return JSON_CODECS[name]()
+
+
+# 当前使用的编解码器，客户端初始化时按 json_codec 配置替换
+json_codec: JsonCodec = select_json_codec()
+
+
+def set_json_codec(name: str) -> JsonCodec:
+    """切换全局编解码器（RPC、对话历史、用户配置、缓存等路径都通过它编解码）"""
+    global json_codec
+    json_codec = select_json_codec(name)
+    return json_codec
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """JSON Lines 日志格式：每条日志一行 JSON，便于采集和检索"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage().strip()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json_codec.dumps_text(entry)
+
+
+def setup_logging(config: "ConfigManager"):
+    """
+    设置日志系统：根记录器只挂一个 QueueHandler，
+    由 QueueListener 线程把日志写到控制台和（可选的）滚动日志文件
+    """
+    global _log_listener
+    
+    log_level = config.get('logging.level', 'INFO')
+    log_format = config.get('logging.format', '%(asctime)s - %(levelname)s - %(message)s')
+    
+    handlers: List[logging.Handler] = []
+    if config.get('logging.console_enabled', True):
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(log_format))
+        handlers.append(console_handler)
+    
+    log_file = config.get('logging.file')
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=config.get('logging.max_bytes', 10 * 1024 * 1024),
+            backupCount=config.get('logging.backup_count', 5),
+            encoding='utf-8'
+        )
+        if config.get('logging.file_format', 'text') == 'json':
+            file_handler.setFormatter(JsonLinesFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(log_format))
+        handlers.append(file_handler)
+    
+    # 重复初始化时先停止旧的监听器，保证队列中的日志写完
+    if _log_listener is not None:
+        _log_listener.stop()
+    
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(getattr(logging, log_level))
+    
+    # 组件级别，如 {"mcp_client.rpc": "DEBUG", "httpx": "WARNING"}
+    for name, level in (config.get('logging.components') or {}).items():
+        logging.getLogger(name).setLevel(getattr(logging, level))
+
+
+@atexit.register
+def _stop_log_listener():
+    """进程退出前刷新日志队列"""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+class Deadline:
+    """查询截止时间：贯穿一次查询中的所有 LLM 调用、工具调用和重试"""
+    
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self) -> float:
+        """剩余秒数（不小于 0）"""
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+    
+    def cap(self, timeout: float) -> float:
+        """把单次调用的超时收紧到剩余时间以内"""
+        return min(timeout, self.remaining())
+
+
+# 当前查询的截止时间；通过 contextvars 随任务传递，chat 内部派生的任务也能读到
+_current_deadline: "contextvars.ContextVar[Optional[Deadline]]" = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """获取当前查询的截止时间，没有则返回 None"""
+    return _current_deadline.get()
+
+
+class StationCodeMapper:
+    """车站代码映射器：提供城市到车站代码的 fallback 映射"""
+    
+    # 常见城市代码映射表
+    CITY_CODES = {
+        "北京": "BJP", "上海": "SHH", "广州": "GZQ", "深圳": "SZQ",
+        "杭州": "HZH", "南京": "NJH", "成都": "CDW", "武汉": "WHN",
+        "西安": "XAY", "郑州": "ZZF", "重庆": "CQW", "天津": "TJP",
+        "长沙": "CSQ", "沈阳": "SYT", "哈尔滨": "HBB", "大连": "DLT",
+        "青岛": "QDK", "济南": "JNK", "福州": "FZS", "厦门": "XMS",
+        "昆明": "KMM", "贵阳": "GIW", "兰州": "LZJ", "太原": "TYV",
+        "石家庄": "SJP", "合肥": "HFH", "南昌": "NCG", "长春": "CCT",
+        "乌鲁木齐": "URQ", "拉萨": "LSA", "呼和浩特": "HHC", "银川": "YIJ",
+        "西宁": "XNO", "海口": "VUQ", "三亚": "SEQ", "苏州": "SZH",
+        "无锡": "WXH", "常州": "CZH", "南通": "NTH", "宁波": "NVH",
+        "温州": "RZH", "金华": "JHH", "珠海": "ZHQ", "汕头": "STQ",
+        "佛山": "FSQ", "东莞": "DMQ", "中山": "ZSQ"
+    }
+    
+    # 城市别名
+    CITY_ALIASES = {
+        "京": "北京", "沪": "上海", "穗": "广州", "深": "深圳",
+        "蓉": "成都", "汉": "武汉", "杭": "杭州", "宁": "南京",
+        "渝": "重庆", "津": "天津"
+    }
+    
+    # 城市近似坐标（纬度, 经度），用于挑选位于出发地和目的地之间的换乘枢纽
+    CITY_COORDS = {
+        "北京": (39.90, 116.40), "上海": (31.23, 121.47), "广州": (23.13, 113.26), "深圳": (22.54, 114.06),
+        "杭州": (30.27, 120.16), "南京": (32.06, 118.80), "成都": (30.66, 104.07), "武汉": (30.59, 114.31),
+        "西安": (34.34, 108.94), "郑州": (34.75, 113.63), "重庆": (29.56, 106.55), "天津": (39.13, 117.20),
+        "长沙": (28.23, 112.94), "沈阳": (41.80, 123.43), "哈尔滨": (45.80, 126.53), "大连": (38.91, 121.61),
+        "青岛": (36.07, 120.38), "济南": (36.65, 117.12), "福州": (26.07, 119.30), "厦门": (24.48, 118.09),
+        "昆明": (25.04, 102.71), "贵阳": (26.65, 106.63), "兰州": (36.06, 103.83), "太原": (37.87, 112.55),
+        "石家庄": (38.04, 114.51), "合肥": (31.82, 117.23), "南昌": (28.68, 115.86), "长春": (43.82, 125.32),
+        "乌鲁木齐": (43.83, 87.62), "拉萨": (29.65, 91.14), "呼和浩特": (40.84, 111.75), "银川": (38.49, 106.23),
+        "西宁": (36.62, 101.78), "海口": (20.04, 110.35), "三亚": (18.25, 109.51), "苏州": (31.30, 120.59),
+        "无锡": (31.49, 120.31), "常州": (31.81, 119.97), "南通": (31.98, 120.89), "宁波": (29.87, 121.55),
+        "温州": (28.00, 120.67), "金华": (29.08, 119.65), "珠海": (22.27, 113.58), "汕头": (23.35, 116.68),
+        "佛山": (23.02, 113.12), "东莞": (23.02, 113.75), "中山": (22.52, 113.39)
+    }
+    
+    # 铁路枢纽：换乘方案只经过这些城市
+    HUB_CITIES = (
+        "北京", "上海", "广州", "深圳", "郑州", "武汉", "长沙", "南京", "杭州", "西安", "成都", "重庆",
+        "济南", "合肥", "南昌", "石家庄", "天津", "沈阳", "兰州", "贵阳", "福州", "太原", "昆明", "哈尔滨"
+    )
+    
+    def __init__(self, custom_mapping_file: Optional[str] = None):
+        self.mapping = self.CITY_CODES.copy()
+        self.aliases = self.CITY_ALIASES.copy()
+        self.coords = self.CITY_COORDS.copy()
+        self.hubs = list(self.HUB_CITIES)
+        
+        # 加载自定义映射（如果存在）
+        if custom_mapping_file and Path(custom_mapping_file).exists():
+            try:
+                custom_data = json_codec.loads(Path(custom_mapping_file).read_bytes())
+                if 'station_codes' in custom_data:
+                    self.mapping.update(custom_data['station_codes'])
+                if 'city_aliases' in custom_data:
+                    self.aliases.update(custom_data['city_aliases'])
+                if 'city_coords' in custom_data:
+                    self.coords.update({city: tuple(latlon) for city, latlon in custom_data['city_coords'].items()})
+                if 'hub_cities' in custom_data:
+                    self.hubs = list(custom_data['hub_cities'])
+                logger.info(f"✅ 已加载自定义城市代码映射: {custom_mapping_file}")
+            except Exception as e:
+                logger.warning(f"⚠️ 加载自定义映射失败: {e}")
+    
+    def get_code(self, city_name: str) -> Optional[str]:
+        """获取城市代码"""
+        # 处理别名
+        city = self.aliases.get(city_name, city_name)
+        # 返回代码
+        return self.mapping.get(city)
+    
+    def get_city(self, station_code: str) -> Optional[str]:
+        """根据车站代码反查城市名"""
+        for city, code in self.mapping.items():
+            if code == station_code:
+                return city
+        return None
+    
+    def distance_km(self, city_a: str, city_b: str) -> Optional[float]:
+        """两个城市之间的大圆距离（公里），缺少坐标时返回 None"""
+        a = self.coords.get(self.aliases.get(city_a, city_a))
+        b = self.coords.get(self.aliases.get(city_b, city_b))
+        if a is None or b is None:
+            return None
+        lat1, lon1, lat2, lon2 = (math.radians(v) for v in (a[0], a[1], b[0], b[1]))
+        h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        return 6371.0 * 2 * math.asin(math.sqrt(h))
+    
+    def hubs_between(self, from_city: str, to_city: str, limit: int = 4, max_detour: float = 1.4) -> List[str]:
+        """
+        适合作为换乘点的枢纽城市：经过枢纽的距离不超过直线距离的 max_detour 倍，
+        按绕行比例从小到大取前 limit 个（太靠近两端的枢纽不算换乘）
+        """
+        from_city = self.aliases.get(from_city, from_city)
+        to_city = self.aliases.get(to_city, to_city)
+        direct = self.distance_km(from_city, to_city)
+        if not direct:
+            return []
+        candidates = []
+        for hub in self.hubs:
+            if hub in (from_city, to_city) or hub not in self.mapping:
+                continue
+            first, second = self.distance_km(from_city, hub), self.distance_km(hub, to_city)
+            if first is None or second is None or min(first, second) < direct * 0.1:
+                continue
+            detour = (first + second) / direct
+            if detour <= max_detour:
+                candidates.append((detour, hub))
+        candidates.sort()
+        return [hub for _, hub in candidates[:limit]]
+    
+    def get_available_cities(self) -> List[str]:
+        """获取所有支持的城市列表"""
+        return list(self.mapping.keys())
+    
+    def search_city(self, keyword: str) -> List[str]:
+        """搜索包含关键字的城市"""
+        return [city for city in self.mapping.keys() if keyword in city]
+    
+    def find_cities(self, text: str) -> List[str]:
+        """按出现顺序提取文本中提到的城市（只匹配完整城市名，不匹配单字别名）"""
+        found = []
+        for city in self.mapping.keys():
+            pos = text.find(city)
+            if pos >= 0:
+                found.append((pos, -len(city), city))
+        found.sort()
+        
+        cities = []
+        covered_until = -1
+        for pos, neg_len, city in found:
+            # 跳过被更长城市名覆盖的匹配
+            if pos < covered_until:
+                continue
+            cities.append(city)
+            covered_until = pos - neg_len
+        return cities
+
+
+@dataclass
+class TicketCriteria:
+    """车票筛选与排序条件（时间均为当天的分钟数）"""
+    depart_after: int = 0
+    depart_before: int = 24 * 60
+    arrive_before: Optional[int] = None
+    max_duration: Optional[int] = None
+    max_price: Optional[float] = None
+    # 要求其中任一席别有票；为空时不限席别
+    seats: Tuple[str, ...] = ()
+    min_seats: int = 1
+    # 只保留这些车型（车次首字母，O 表示其他）；为空时不限
+    train_types: str = ""
+    # 排序键 preference 优先的车型
+    preferred_types: str = ""
+    # 排序键：depart / arrive / duration / price / preference / seats，前缀 - 表示降序
+    sort: Tuple[str, ...] = ("preference", "arrive", "price")
+    limit: int = 10
+    
+    @classmethod
+    def from_request(cls, arguments: Dict[str, Any], preferences: Dict[str, Any],
+                     sort: Tuple[str, ...] = ("preference", "arrive", "price"), limit: int = 10) -> "TicketCriteria":
+        """
+        合并 get-tickets 的参数（earliestStartTime / latestStartTime / trainFilterFlags / sortFlag /
+        sortReverse / limitedNum）和用户配置中的偏好（preferred_seat_type / preferred_train_types）
+        """
+        criteria = cls(sort=tuple(sort), limit=limit)
+        try:
+            if arguments.get("earliestStartTime") not in (None, ""):
+                criteria.depart_after = int(arguments["earliestStartTime"]) * 60
+            if arguments.get("latestStartTime") not in (None, ""):
+                criteria.depart_before = min(int(arguments["latestStartTime"]) * 60 + 59, 24 * 60)
+            if int(arguments.get("limitedNum") or 0) > 0:
+                criteria.limit = int(arguments["limitedNum"])
+        except (TypeError, ValueError):
+            pass
+        # 复兴号(F)、智能动车组(S)等标志不是车型，不参与车型筛选
+        criteria.train_types = "".join(flag for flag in str(arguments.get("trainFilterFlags") or "")
+                                       if flag in "GDCZTKO")
+        sort_key = {"startTime": "depart", "arriveTime": "arrive", "duration": "duration"}.get(
+            arguments.get("sortFlag") or "")
+        if sort_key:
+            primary = f"-{sort_key}" if arguments.get("sortReverse") else sort_key
+            criteria.sort = (primary,) + tuple(key for key in criteria.sort if key.lstrip("-") != sort_key)
+        if preferences.get("preferred_seat_type"):
+            criteria.seats = (preferences["preferred_seat_type"],)
+        criteria.preferred_types = "".join(preferences.get("preferred_train_types") or [])
+        return criteria
+
+
+class TicketTable:
+    """
+    车票结果的列式表：get-tickets 返回的文本或 JSON 解析后按列存储（安装 NumPy 时为 NumPy 数组），
+    筛选和多键排序对整列进行，只把排在前面的车次交给 LLM 或命令行；多天、多条路线的结果可以合并成一张表
+    """
+    
+    # 常见席别的固定列顺序，遇到其他席别时追加列
+    SEAT_NAMES = ("商务座", "特等座", "优选一等座", "一等座", "二等座", "高级软卧", "软卧", "一等卧", "动卧",
+                  "硬卧", "二等卧", "软座", "硬座", "无座")
+    # 余票为"有"或"充足"时记作的张数
+    PLENTY = 99
+    SORT_LABELS = {"depart": "出发时间", "arrive": "到达时间", "duration": "历时", "price": "票价",
+                   "preference": "偏好车型", "seats": "余票"}
+    
+    # 12306-mcp 文本格式：G1(实际车次train_no: 24000000G10I) 北京南(telecode: VNP) -> 上海虹桥(telecode: AOH) 09:00 -> 13:37 历时：04:37
+    _TRAIN_LINE = re.compile(
+        r'^(?P<code>[A-Z]?\d+)(?:\([^)]*\))?\s+(?P<from>[^\s(]+)\((?:telecode:\s*)?[A-Z]+\)\s*->\s*'
+        r'(?P<to>[^\s(]+)\((?:telecode:\s*)?[A-Z]+\)\s+(?P<start>\d{1,2}:\d{2})\s*->\s*(?P<arrive>\d{1,2}:\d{2})'
+        r'(?:\s*历时[:：]?\s*(?P<lishi>\d{1,2}:\d{2}))?'
+    )
+    # - 二等座: 剩余3张票 662元
+    _SEAT_LINE = re.compile(r'^-\s*(?P<seat>[^:：\s]+)\s*[:：]\s*(?P<status>\S+)\s+(?P<price>\d+(?:\.\d+)?)元')
+    
+    def __init__(self, records: List[Tuple[str, str, str, str, int, int, Dict[str, Tuple[int, float]]]]):
+        """records: (车次, 出发站, 到达站, 日期, 出发分钟, 历时分钟, {席别: (余票, 票价)})"""
+        self.codes = [r[0] for r in records]
+        self.from_stations = [r[1] for r in records]
+        self.to_stations = [r[2] for r in records]
+        self.dates = [r[3] for r in records]
+        names = {name for r in records for name in r[6]}
+        self.seat_names = [name for name in self.SEAT_NAMES if name in names] + \
+            sorted(names.difference(self.SEAT_NAMES))
+        
+        # 出发时刻换算为绝对分钟数（日期序数 × 1440 + 当天分钟），不同日期、不同查询的车次可以直接比较和衔接
+        days = {date: self._date_ordinal(date) for date in set(self.dates)}
+        start = [days[r[3]] * 1440 + r[4] for r in records]
+        types = [r[0][0] if r[0][:1] and r[0][:1] in "GDCZTK" else "O" for r in records]
+        counts = [[r[6].get(name, (0, 0.0))[0] for name in self.seat_names] for r in records]
+        prices = [[r[6][name][1] if name in r[6] else float("nan") for name in self.seat_names] for r in records]
+        if np is not None:
+            self.depart = np.array([r[4] for r in records], dtype=np.int32)
+            self.duration = np.array([r[5] for r in records], dtype=np.int32)
+            self.start = np.array(start, dtype=np.int64)
+            self.types = np.array(types, dtype="U1")
+            self.counts = np.array(counts, dtype=np.int16).reshape(len(records), len(self.seat_names))
+            self.prices = np.array(prices, dtype=np.float64).reshape(len(records), len(self.seat_names))
+        else:
+            self.depart = [r[4] for r in records]
+            self.duration = [r[5] for r in records]
+            self.start = start
+            self.types = types
+            self.counts = counts
+            self.prices = prices
+    
+    def __len__(self) -> int:
+        return len(self.codes)
+    
+    @staticmethod
+    def _date_ordinal(date: str) -> int:
+        try:
+            return datetime.strptime(date, "%Y-%m-%d").toordinal()
+        except (TypeError, ValueError):
+            return 0
+    
+    @staticmethod
+    def _minutes(text: str) -> int:
+        hours, minutes = text.split(":")
+        return int(hours) * 60 + int(minutes)
+    
+    @classmethod
+    def _seat_count(cls, status: str) -> int:
+        """余票描述转换为张数：有/有票/充足 -> PLENTY，数字或"剩余N张票" -> N，其余（无票、候补等）-> 0"""
+        if status in ("有", "有票", "充足", "充足票"):
+            return cls.PLENTY
+        if status in ("无", "无票", "--", ""):
+            return 0
+        match = re.search(r'\d+', status)
+        return int(match.group()) if match and not status.startswith("无") else 0
+    
+    @classmethod
+    def parse(cls, tool_result: Any, date: str = "") -> List[tuple]:
+        """把一次 get-tickets 的结果解析为记录（支持 12306-mcp 的 text 和 json 格式）；无法识别时返回空列表"""
+        content = tool_result.get("content") if isinstance(tool_result, dict) else None
+        if not isinstance(content, list):
+            return []
+        records = []
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            rows = item.get("data")
+            text = item.get("text")
+            if rows is None and isinstance(text, str) and text.lstrip().startswith("["):
+                try:
+                    rows = json_codec.loads(text)
+                except ValueError:
+                    rows = None
+            if isinstance(rows, list):
+                records.extend(cls._parse_rows(rows, date))
+            elif isinstance(text, str):
+                records.extend(cls._parse_text(text, date))
+        return records
+    
+    @classmethod
+    def _parse_rows(cls, rows: List[Dict[str, Any]], date: str) -> List[tuple]:
+        records = []
+        for row in rows:
+            try:
+                depart = cls._minutes(row["start_time"])
+                duration = cls._minutes(row["lishi"])
+                seats = {p["seat_name"]: (cls._seat_count(str(p.get("num", ""))), float(p["price"]))
+                         for p in row.get("prices", [])}
+                records.append((row["start_train_code"], row.get("from_station", ""), row.get("to_station", ""),
+                                date or row.get("start_date", ""), depart, duration, seats))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return records
+    
+    @classmethod
+    def _parse_text(cls, text: str, date: str) -> List[tuple]:
+        records = []
+        current = None
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith("-"):
+                match = cls._SEAT_LINE.match(line)
+                if match and current is not None:
+                    current[6][match.group("seat")] = (cls._seat_count(match.group("status")),
+                                                       float(match.group("price")))
+                continue
+            match = cls._TRAIN_LINE.match(line)
+            if match:
+                depart = cls._minutes(match.group("start"))
+                if match.group("lishi"):
+                    duration = cls._minutes(match.group("lishi"))
+                else:
+                    duration = (cls._minutes(match.group("arrive")) - depart) % 1440
+                current = (match.group("code"), match.group("from"), match.group("to"), date, depart, duration, {})
+                records.append(current)
+        return records
+    
+    @classmethod
+    def from_results(cls, results: List[Tuple[Any, str]]) -> "TicketTable":
+        """合并多次查询（多天或多条路线）的结果：results 为 (get-tickets 结果, 日期) 列表"""
+        return cls([record for result, date in results for record in cls.parse(result, date)])
+    
+    def _seat_columns(self, seats: Tuple[str, ...]) -> List[int]:
+        return [self.seat_names.index(name) for name in seats if name in self.seat_names]
+    
+    def select(self, criteria: TicketCriteria, require_seats: bool = True) -> List[int]:
+        """按条件筛选并多键排序，返回所有符合条件的行号（按排序结果）"""
+        columns = self._seat_columns(criteria.seats) if require_seats else []
+        if require_seats and criteria.seats and not columns:
+            return []
+        if np is not None:
+            return self._select_numpy(criteria, columns)
+        return self._select_python(criteria, columns)
+    
+    def _select_numpy(self, criteria: TicketCriteria, columns: List[int]) -> List[int]:
+        # 所选席别中有票的最低价和最多余票；未指定席别时看所有席别
+        counts = self.counts[:, columns] if columns else self.counts
+        prices = self.prices[:, columns] if columns else self.prices
+        available = counts >= criteria.min_seats
+        price = np.where(available, prices, np.inf).min(axis=1, initial=np.inf)
+        seats_left = counts.max(axis=1, initial=0)
+        
+        mask = (self.depart >= criteria.depart_after) & (self.depart <= criteria.depart_before)
+        if criteria.arrive_before is not None:
+            mask &= self.depart + self.duration <= criteria.arrive_before
+        if criteria.max_duration is not None:
+            mask &= self.duration <= criteria.max_duration
+        if criteria.max_price is not None:
+            mask &= price <= criteria.max_price
+        # 与纯 Python 路径一致：指定了席别时（包括放宽为任意席别时）丢弃全部售罄的车次
+        if criteria.seats:
+            mask &= available.any(axis=1)
+        if criteria.train_types:
+            mask &= np.isin(self.types, list(criteria.train_types))
+        rows = np.flatnonzero(mask)
+        
+        sort_columns = {
+            "depart": self.start,
+            "arrive": self.start + self.duration,
+            "duration": self.duration,
+            "price": price,
+            "seats": seats_left,
+            "preference": ~np.isin(self.types, list(criteria.preferred_types or "-"))
+        }
+        # lexsort 以最后一个键为主键
+        keys = []
+        for key in reversed(criteria.sort):
+            column = sort_columns.get(key.lstrip("-"))
+            if column is not None:
+                column = column[rows].astype(np.float64)
+                keys.append(-column if key.startswith("-") else column)
+        if keys:
+            rows = rows[np.lexsort(keys)]
+        return rows.tolist()
+    
+    def _select_python(self, criteria: TicketCriteria, columns: List[int]) -> List[int]:
+        columns = columns or list(range(len(self.seat_names)))
+        preferred = set(criteria.preferred_types)
+        train_types = set(criteria.train_types)
+        rows = []
+        for i in range(len(self.codes)):
+            depart, duration = self.depart[i], self.duration[i]
+            available = [self.prices[i][c] for c in columns if self.counts[i][c] >= criteria.min_seats]
+            price = min(available) if available else float("inf")
+            if not criteria.depart_after <= depart <= criteria.depart_before:
+                continue
+            if criteria.arrive_before is not None and depart + duration > criteria.arrive_before:
+                continue
+            if criteria.max_duration is not None and duration > criteria.max_duration:
+                continue
+            if criteria.max_price is not None and price > criteria.max_price:
+                continue
+            if criteria.seats and not available:
+                continue
+            if train_types and self.types[i] not in train_types:
+                continue
+            values = {
+                "depart": self.start[i],
+                "arrive": self.start[i] + duration,
+                "duration": duration,
+                "price": price,
+                "seats": max((self.counts[i][c] for c in columns), default=0),
+                "preference": self.types[i] not in preferred
+            }
+            key = tuple(-values[k.lstrip("-")] if k.startswith("-") else values[k]
+                        for k in criteria.sort if k.lstrip("-") in values)
+            rows.append((key, i))
+        rows.sort()
+        return [i for _, i in rows]
+    
+    def legs(self, criteria: TicketCriteria) -> List[Tuple[int, int, float, int]]:
+        """
+        符合条件的车次作为行程中的一段：(出发绝对分钟, 到达绝对分钟, 票价, 行号)
+        票价取所选席别中有票的最低价；所选席别全部无票时与 render 一样放宽为任意有票席别
+        """
+        rows = self.select(criteria)
+        columns = self._seat_columns(criteria.seats)
+        if not rows and criteria.seats:
+            rows, columns = self.select(criteria, require_seats=False), []
+        columns = columns or list(range(len(self.seat_names)))
+        legs = []
+        for i in rows:
+            prices = [float(self.prices[i][c]) for c in columns if self.counts[i][c] >= criteria.min_seats]
+            if prices:
+                start = int(self.start[i])
+                legs.append((start, start + int(self.duration[i]), min(prices), i))
+        return legs
+    
+    def format_row(self, i: int, highlight: Tuple[str, ...] = ()) -> str:
+        """一行车次摘要：日期、区间、时刻、历时和各席别余票/票价（偏好的席别排在前面）"""
+        depart, duration = int(self.depart[i]), int(self.duration[i])
+        arrive = depart + duration
+        next_day = f"+{arrive // 1440}" if arrive >= 1440 else ""
+        order = [c for c in self._seat_columns(highlight)] + \
+            [c for c in range(len(self.seat_names)) if self.seat_names[c] not in highlight]
+        seats = []
+        for c in order:
+            price = float(self.prices[i][c])
+            if price != price:  # NaN：该车次没有这个席别
+                continue
+            count = int(self.counts[i][c])
+            status = "有" if count >= self.PLENTY else (f"{count}张" if count else "无")
+            seats.append(f"{self.seat_names[c]}:{status} {price:g}元")
+        date = f"{self.dates[i]} " if self.dates[i] else ""
+        return (f"{self.codes[i]} {date}{self.from_stations[i]}→{self.to_stations[i]} "
+                f"{depart // 60:02d}:{depart % 60:02d}→{arrive % 1440 // 60:02d}:{arrive % 60:02d}{next_day} "
+                f"历时{duration // 60}h{duration % 60:02d}m | " + " ".join(seats))
+    
+    def render(self, criteria: TicketCriteria) -> str:
+        """筛选排序后的前 k 趟车（文本）；偏好席别全部无票时放宽席别要求并注明"""
+        rows = self.select(criteria)
+        note = ""
+        if not rows and criteria.seats:
+            rows = self.select(criteria, require_seats=False)
+            note = f"（{'/'.join(criteria.seats)}均无余票，以下为其他席别）"
+        order = "、".join(self.SORT_LABELS[k.lstrip("-")] + ("↓" if k.startswith("-") else "")
+                         for k in criteria.sort if k.lstrip("-") in self.SORT_LABELS)
+        top = rows[:criteria.limit]
+        header = f"共 {len(self)} 趟车，符合条件 {len(rows)} 趟，按{order}排序的前 {len(top)} 趟{note}："
+        return "\n".join([header] + [self.format_row(i, criteria.seats) for i in top])
+
+
+@dataclass
+class Itinerary:
+    """一个行程方案：各段为 (车票表, 行号)，时间为绝对分钟数"""
+    legs: List[Tuple[TicketTable, int]]
+    depart: int
+    arrive: int
+    price: float
+    
+    @property
+    def minutes(self) -> int:
+        return self.arrive - self.depart
+    
+    @property
+    def transfers(self) -> int:
+        return len(self.legs) - 1
+    
+    def describe(self, seats: Tuple[str, ...] = ()) -> str:
+        """多行文本：总历时、换乘站和等待时间、总票价，以及每一段的车次信息"""
+        stops = []
+        for (first, i), (second, j) in zip(self.legs, self.legs[1:]):
+            wait = int(second.start[j]) - int(first.start[i] + first.duration[i])
+            station = first.to_stations[i] if first.to_stations[i] == second.from_stations[j] else \
+                f"{first.to_stations[i]}→{second.from_stations[j]}"
+            stops.append(f"{station} 等 {wait // 60}h{wait % 60:02d}m")
+        summary = f"总历时 {self.minutes // 60}h{self.minutes % 60:02d}m | " + \
+            (f"换乘 {self.transfers} 次（{'，'.join(stops)}）" if stops else "直达") + f" | 最低 {self.price:g}元"
+        return "\n".join([summary] + [f"  {n}. {table.format_row(row, seats)}"
+                                      for n, (table, row) in enumerate(self.legs, 1)])
+
+
+class ItineraryPlanner:
+    """
+    换乘方案搜索：并发查询出发地→枢纽、枢纽→目的地的车票（枢纽由 StationCodeMapper 按绕行比例挑选），
+    按最短换乘时间拼接两段，丢弃总历时超出上限的组合，返回在（总历时、换乘次数、票价）上的帕累托最优方案
+    """
+    
+    def __init__(self, fetch: Callable[[str, str, str], Awaitable[Any]], mapper: StationCodeMapper,
+                 max_hubs: int = 4, max_detour: float = 1.4, min_connection: int = 20,
+                 cross_station_connection: int = 60, max_wait: int = 360, max_total: int = 36 * 60,
+                 max_total_ratio: float = 2.0, concurrency: int = 8):
+        # fetch(出发站代码, 到达站代码, 日期) 返回 get-tickets 的结果，失败时返回 None
+        self.fetch = fetch
+        self.mapper = mapper
+        self.max_hubs = max_hubs
+        self.max_detour = max_detour
+        # 同站换乘 / 同城不同站换乘的最短时间（分钟）
+        self.min_connection = min_connection
+        self.cross_station_connection = cross_station_connection
+        self.max_wait = max_wait
+        # 总历时上限：绝对上限，以及相对最快方案的倍数
+        self.max_total = max_total
+        self.max_total_ratio = max_total_ratio
+        self.concurrency = concurrency
+        self.requests = 0
+    
+    async def plan(self, from_city: str, to_city: str, date: str, criteria: TicketCriteria) -> List[Itinerary]:
+        from_code, to_code = self.mapper.get_code(from_city), self.mapper.get_code(to_city)
+        if not from_code or not to_code:
+            return []
+        hubs = [(hub, self.mapper.get_code(hub))
+                for hub in self.mapper.hubs_between(from_city, to_city, self.max_hubs, self.max_detour)]
+        next_date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def fetch(a: str, b: str, day: str) -> Optional[Tuple[Any, str]]:
+            async with semaphore:
+                self.requests += 1
+                try:
+                    result = await self.fetch(a, b, day)
+                except Exception as e:
+                    logger.warning(f"⚠️ 换乘查询失败 {a}->{b} {day}: {e}")
+                    return None
+                return (result, day) if result is not None else None
+        
+        started = time.monotonic()
+        # 第一阶段：直达和各枢纽的两段同时查询
+        fetched = await asyncio.gather(
+            fetch(from_code, to_code, date),
+            *(fetch(src, dst, date) for _, hub_code in hubs for src, dst in ((from_code, hub_code), (hub_code, to_code)))
+        )
+        direct, pairs = fetched[0], [(fetched[1 + 2 * n], fetched[2 + 2 * n]) for n in range(len(hubs))]
+        tables = [(TicketTable.from_results([first] if first else []),
+                   TicketTable.from_results([second] if second else [])) for first, second in pairs]
+        
+        itineraries: List[Itinerary] = []
+        if direct is not None:
+            table = TicketTable.from_results([direct])
+            itineraries.extend(Itinerary([(table, i)], depart, arrive, price)
+                               for depart, arrive, price, i in table.legs(criteria))
+        bound = min([self.max_total] + [it.minutes * self.max_total_ratio for it in itineraries])
+        for first, second in tables:
+            bound = self._join(first, second, criteria, itineraries, bound)
+        
+        # 第二阶段：第一段到达太晚、当天无车可接时，只在次日车次可能产生不超过上限的方案时补查
+        late = [n for n, (first, second) in enumerate(tables) if self._needs_next_day(first, second, criteria, bound)]
+        if late:
+            extra = await asyncio.gather(*(fetch(hubs[n][1], to_code, next_date) for n in late))
+            for n, result in zip(late, extra):
+                if result is not None:
+                    bound = self._join(tables[n][0], TicketTable.from_results([result]), criteria, itineraries, bound)
+        itineraries = [it for it in itineraries if it.minutes <= bound]
+        front = self.pareto_front(itineraries)
+        logger.info(f"🔁 换乘搜索 {from_city}→{to_city}: 查询 {self.requests} 次，候选 {len(itineraries)} 个，"
+                    f"帕累托最优 {len(front)} 个，用时 {time.monotonic() - started:.2f}秒")
+        return front
+    
+    def _join(self, first: TicketTable, second: TicketTable, criteria: TicketCriteria,
+              out: List[Itinerary], bound: float) -> float:
+        """拼接两段：第二段在第一段到达后 [最短换乘时间, max_wait] 内出发；返回收紧后的总历时上限"""
+        if not len(first) or not len(second):
+            return bound
+        seconds = sorted(second.legs(self._connecting_criteria(criteria)))
+        starts = [leg[0] for leg in seconds]
+        for depart, arrive, price, i in first.legs(criteria):
+            k = bisect.bisect_left(starts, arrive + self.min_connection)
+            while k < len(seconds) and seconds[k][0] <= arrive + self.max_wait:
+                depart2, arrive2, price2, j = seconds[k]
+                k += 1
+                if first.to_stations[i] != second.from_stations[j] and depart2 < arrive + self.cross_station_connection:
+                    continue
+                total = arrive2 - depart
+                if total > bound:
+                    continue
+                out.append(Itinerary([(first, i), (second, j)], depart, arrive2, price + price2))
+                bound = min(bound, total * self.max_total_ratio)
+        return bound
+    
+    @staticmethod
+    def _connecting_criteria(criteria: TicketCriteria) -> TicketCriteria:
+        """后续各段只受席别和车型约束，出发时间窗口只作用于第一段"""
+        return TicketCriteria(seats=criteria.seats, min_seats=criteria.min_seats,
+                              train_types=criteria.train_types, sort=("depart",))
+    
+    def _needs_next_day(self, first: TicketTable, second: TicketTable, criteria: TicketCriteria,
+                        bound: float) -> bool:
+        """
+        是否需要补查次日的第二段：用当天的第二段时刻表平移一天估计次日车次，
+        存在当天无车可接、等待不超过 max_wait、且估计总历时不超过上限的第一段时才需要
+        """
+        if not len(first) or not len(second):
+            return False
+        seconds = second.legs(self._connecting_criteria(criteria))
+        if not seconds:
+            return False
+        latest_depart = max(leg[0] for leg in seconds)
+        next_depart = min(leg[0] for leg in seconds) + 1440
+        next_arrive = min(leg[1] for leg in seconds) + 1440
+        return any(arrive + self.min_connection > latest_depart and next_depart - arrive <= self.max_wait
+                   and next_arrive - depart <= bound for depart, arrive, _, _ in first.legs(criteria))
+    
+    @staticmethod
+    def pareto_front(itineraries: List[Itinerary]) -> List[Itinerary]:
+        """（总历时、换乘次数、票价）均不被其他方案优于的方案，按总历时排序；完全相同的取先出现的"""
+        front: List[Itinerary] = []
+        for it in sorted(itineraries, key=lambda it: (it.minutes, it.transfers, it.price)):
+            if not any(other.transfers <= it.transfers and other.price <= it.price for other in front):
+                front.append(it)
+        return front
+
+
+@dataclass
+class TicketSearchResult:
+    """多日期、多路线查询的结果：每个 (日期, 出发站代码, 到达站代码) 一张表（查询失败为 None），以及合并后的总表"""
+    queries: List[Tuple[str, str, str]]
+    tables: List[Optional[TicketTable]]
+    combined: TicketTable
+    
+    @property
+    def failed(self) -> int:
+        return sum(1 for table in self.tables if table is None)
+
+
+class TicketFanout:
+    """
+    多日期 × 多路线的并发查票：展开日期和路线的笛卡尔积，通过 fetch 并发查询（仍经过工具缓存和限速），
+    合并为一张车票表统一筛选排序；同时作为本地工具提供给 LLM，一轮工具调用即可得到整周的结果
+    """
+    
+    TOOL_NAME = "get-tickets-range"
+    TOOL = {
+        "type": "function",
+        "function": {
+            "name": TOOL_NAME,
+            "description": "一次查询多个日期和/或多条路线的车票并汇总（如“下周哪天最便宜”、“从北京或天津出发”），"
+                           "返回每天每条路线的有票车次数、最低价、最短历时，以及全部结果中排在最前的车次。"
+                           "需要比较多个日期或多条路线时使用本工具，不要逐日调用 get-tickets",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "fromStations": {"type": "array", "items": {"type": "string"},
+                                     "description": "出发站代码列表，如 [\"BJP\"]"},
+                    "toStations": {"type": "array", "items": {"type": "string"},
+                                   "description": "到达站代码列表，如 [\"SHH\"]"},
+                    "startDate": {"type": "string", "description": "起始日期，格式 YYYY-MM-DD"},
+                    "days": {"type": "integer", "description": "从起始日期起连续查询的天数，默认 7"},
+                    "dates": {"type": "array", "items": {"type": "string"},
+                              "description": "指定日期列表（YYYY-MM-DD），提供时忽略 startDate/days"},
+                    "sortBy": {"type": "string", "enum": ["price", "depart", "arrive", "duration"],
+                               "description": "汇总结果的首要排序方式，默认按票价"},
+                    "trainFilterFlags": {"type": "string", "description": "车型筛选，如 GD 表示只看高铁和动车"},
+                    "earliestStartTime": {"type": "integer", "description": "最早出发时间（0-24 时）"},
+                    "latestStartTime": {"type": "integer", "description": "最晚出发时间（0-24 时）"},
+                    "limitedNum": {"type": "integer", "description": "返回的车次数"}
+                },
+                "required": ["fromStations", "toStations"]
+            }
+        }
+    }
+    
+    def __init__(self, fetch: Callable[[str, str, str], Awaitable[Any]], concurrency: int = 8,
+                 max_queries: int = 31, max_days: int = 15):
+        # fetch(出发站代码, 到达站代码, 日期) 返回 get-tickets 的结果，失败时返回 None
+        self.fetch = fetch
+        self.concurrency = concurrency
+        self.max_queries = max_queries
+        self.max_days = max_days
+    
+    def parse_arguments(self, arguments: Dict[str, Any]) -> Tuple[List[str], List[str], List[str]]:
+        """从工具参数解析 (出发站代码列表, 到达站代码列表, 日期列表)；参数不合法时抛出 ValueError"""
+        if arguments.get("dates"):
+            dates = [str(date) for date in arguments["dates"]]
+        else:
+            start = arguments.get("startDate") or datetime.now().strftime("%Y-%m-%d")
+            days = max(1, min(int(arguments.get("days") or 7), self.max_days))
+            dates = [start]
+        try:
+            parsed = [datetime.strptime(date, "%Y-%m-%d") for date in dates]
+        except ValueError:
+            raise ValueError(f"日期格式应为 YYYY-MM-DD: {', '.join(dates)}")
+        if not arguments.get("dates"):
+            dates = [(parsed[0] + timedelta(days=n)).strftime("%Y-%m-%d") for n in range(days)]
+        
+        def codes(value: Any) -> List[str]:
+            items = value if isinstance(value, list) else str(value or "").split(",")
+            return [str(item).strip().upper() for item in items if str(item).strip()]
+        
+        return codes(arguments.get("fromStations")), codes(arguments.get("toStations")), dates
+    
+    async def search(self, from_codes: List[str], to_codes: List[str], dates: List[str]) -> TicketSearchResult:
+        """并发查询 日期 × 出发站 × 到达站 的所有组合并合并结果；组合为空或超过上限时抛出 ValueError"""
+        dates = list(dict.fromkeys(dates))
+        routes = [(a, b) for a in dict.fromkeys(from_codes) for b in dict.fromkeys(to_codes) if a != b]
+        if not routes or not dates:
+            raise ValueError("至少需要一个日期和一对不同的出发/到达车站")
+        if len(dates) > self.max_days or len(dates) * len(routes) > self.max_queries:
+            raise ValueError(f"查询范围过大（最多 {self.max_days} 天、{self.max_queries} 个日期与路线的组合），请缩小范围")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        queries = [(date, a, b) for date in dates for a, b in routes]
+        
+        async def fetch(date: str, a: str, b: str) -> Optional[List[tuple]]:
+            async with semaphore:
+                try:
+                    result = await self.fetch(a, b, date)
+                except Exception as e:
+                    logger.warning(f"⚠️ 批量查票失败 {a}->{b} {date}: {e}")
+                    return None
+                return None if result is None else TicketTable.parse(result, date)
+        
+        started = time.monotonic()
+        records = await asyncio.gather(*(fetch(*query) for query in queries))
+        tables = [TicketTable(rows) if rows is not None else None for rows in records]
+        combined = TicketTable([row for rows in records if rows for row in rows])
+        logger.info(f"📅 批量查票: {len(dates)} 天 × {len(routes)} 条路线，{len(combined)} 趟车，"
+                    f"用时 {time.monotonic() - started:.2f}秒")
+        return TicketSearchResult(queries, tables, combined)
+    
+    @staticmethod
+    def render(result: TicketSearchResult, criteria: TicketCriteria, names: Callable[[str], str]) -> str:
+        """汇总文本：每个日期/路线的有票车次数、最低价和最短历时，以及合并后排在最前的车次"""
+        lines = [f"按日期/路线汇总（有票车次数 / 最低价 / 最短历时），共 {len(result.queries)} 次查询"
+                 + (f"，失败 {result.failed} 次" if result.failed else "") + "："]
+        cheapest = None
+        for (date, a, b), table in zip(result.queries, result.tables):
+            label = f"{date} {names(a)}→{names(b)}"
+            if table is None:
+                lines.append(f"{label}: 查询失败")
+                continue
+            legs = table.legs(criteria) if len(table) else []
+            if not legs:
+                lines.append(f"{label}: 无符合条件的车次" if len(table) else f"{label}: 无车次")
+                continue
+            price = min(leg[2] for leg in legs)
+            fastest = min(leg[1] - leg[0] for leg in legs)
+            lines.append(f"{label}: {len(legs)} 趟 / {price:g}元 / {fastest // 60}h{fastest % 60:02d}m")
+            if cheapest is None or price < cheapest[0]:
+                cheapest = (price, label)
+        if cheapest is not None:
+            lines.append(f"最低价: {cheapest[1]} {cheapest[0]:g}元")
+        if len(result.combined):
+            lines.append("")
+            lines.append(result.combined.render(criteria))
+        return "\n".join(lines)
+
+
+@dataclass
+class TicketSnapshots:
+    """归档扫描结果：列名 -> 列（安装 NumPy 时为 NumPy 数组），train / seat 列是 trains / seats 中的下标"""
+    columns: Dict[str, Any]
+    trains: List[str]
+    seats: List[str]
+    
+    def __len__(self) -> int:
+        return len(self.columns["polled"])
+
+
+class TicketSnapshotArchive:
+    """
+    车票余量快照的列式归档：每次实际请求服务器的 get-tickets 结果，按（车次, 席别）各记一行快照，
+    按 路线/出行日期 分区写成列式分段（每列一个本机字节序的二进制文件，读取时直接内存映射，
+    车次和席别为分段内字典的下标）；结果先缓冲在内存中，攒够 batch_results 个或等待 flush_seconds 后
+    在线程池中批量解析和写盘，不占用事件循环
+    """
+    
+    # 列名 -> array 类型码（同时是 NumPy dtype 字符码）：查询时间、发车时间（时间戳秒）、车次、席别、余票、票价
+    COLUMNS = {"polled": "d", "departs": "d", "train": "I", "seat": "B", "count": "h", "price": "f"}
+    # 车站代码和日期来自 LLM 的工具参数，用作分区路径前必须校验
+    _STATION = re.compile(r'[A-Z]{3}')
+    _DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+    
+    def __init__(self, directory: str, batch_results: int = 50, flush_seconds: float = 60.0):
+        self.directory = Path(directory)
+        self.batch_results = batch_results
+        self.flush_seconds = flush_seconds
+        # (出发站代码, 到达站代码, 日期, get-tickets 结果, 查询时间)
+        self._pending: List[Tuple[str, str, str, Any, float]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        self.snapshots_written = 0
+    
+    @classmethod
+    def valid_partition(cls, from_code: Any, to_code: Any, date: Any) -> bool:
+        """出发站、到达站代码为 3 位大写字母且日期为 YYYY-MM-DD（可以安全地用作分区路径）"""
+        return (isinstance(from_code, str) and isinstance(to_code, str) and isinstance(date, str) and
+                bool(cls._STATION.fullmatch(from_code)) and bool(cls._STATION.fullmatch(to_code)) and
+                bool(cls._DATE.fullmatch(date)))
+    
+    def record(self, arguments: Dict[str, Any], tool_result: Any, polled: Optional[float] = None):
+        """记录一次 get-tickets 结果（只追加到缓冲区，解析和写盘在后台批量进行）；参数不合法时忽略"""
+        from_code, to_code, date = arguments.get("fromStation"), arguments.get("toStation"), arguments.get("date")
+        if not self.valid_partition(from_code, to_code, date):
+            return
+        self._pending.append((from_code, to_code, date, tool_result, time.time() if polled is None else polled))
+        if len(self._pending) >= self.batch_results:
+            self._start_flush()
+        else:
+            self._schedule_flush()
+    
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flush_handle = loop.call_later(self.flush_seconds, self._start_flush)
+    
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            # 上一批尚未写完，写完后会继续处理缓冲区
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有运行中的事件循环，等待显式 flush()/close()
+            return
+        self._flush_task = loop.create_task(self._drain())
+    
+    async def _drain(self):
+        """把缓冲区中的结果交给线程池解析并写成分段，直到缓冲区为空"""
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.write, batch)
+            except Exception as e:
+                logger.error(f"❌ 写入车票快照归档失败: {e}")
+                return
+    
+    async def flush(self):
+        """取消计时器，等待进行中的写入，并把剩余结果落盘（查询归档前、退出时调用）"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._drain()
+    
+    def write(self, batch: List[Tuple[str, str, str, Any, float]]) -> List[Path]:
+        """解析一批结果并按 路线/日期 分区写成新分段（可在线程池中执行），返回写入的分段目录"""
+        partitions: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        for from_code, to_code, date, tool_result, polled in batch:
+            if not self.valid_partition(from_code, to_code, date):
+                logger.warning(f"⚠️ 忽略分区参数不合法的车票快照: {from_code!r} {to_code!r} {date!r}")
+                continue
+            part = partitions.get((from_code, to_code, date))
+            if part is None:
+                part = {"columns": {name: array(code) for name, code in self.COLUMNS.items()},
+                        "trains": {}, "seats": {}}
+                partitions[(from_code, to_code, date)] = part
+            columns, trains, seats = part["columns"], part["trains"], part["seats"]
+            midnight = datetime.strptime(date, "%Y-%m-%d").timestamp()
+            for code, _, _, _, depart, _, seat_info in TicketTable.parse(tool_result, date):
+                train = trains.setdefault(code, len(trains))
+                for seat_name, (count, price) in seat_info.items():
+                    columns["polled"].append(polled)
+                    columns["departs"].append(midnight + depart * 60)
+                    columns["train"].append(train)
+                    columns["seat"].append(seats.setdefault(seat_name, len(seats)))
+                    columns["count"].append(min(count, 32767))
+                    columns["price"].append(price)
+        
+        written = []
+        with self._write_lock:
+            for (from_code, to_code, date), part in partitions.items():
+                if part["columns"]["polled"]:
+                    written.append(self._write_segment(self.directory / f"{from_code}-{to_code}" / date, part))
+        self.snapshots_written += sum(len(part["columns"]["polled"]) for part in partitions.values())
+        return written
+    
+    def _write_segment(self, directory: Path, part: Dict[str, Any]) -> Path:
+        """先写入临时目录并 fsync，再 rename 为分段目录；读取时忽略以 . 开头的临时目录"""
+        directory.mkdir(parents=True, exist_ok=True)
+        target = directory / f"seg-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{target.name}.", dir=str(directory)))
+        try:
+            for name, column in part["columns"].items():
+                with open(tmp_dir / f"{name}.bin", 'wb') as f:
+                    column.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            meta = {"rows": len(part["columns"]["polled"]), "byteorder": sys.byteorder,
+                    "columns": self.COLUMNS, "trains": list(part["trains"]), "seats": list(part["seats"])}
+            (tmp_dir / "meta.json").write_bytes(json_codec.dumps(meta))
+            os.replace(str(tmp_dir), str(target))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return target
+    
+    def segments(self, from_code: Optional[str] = None, to_code: Optional[str] = None,
+                 start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Path]:
+        """按路线和出行日期范围（含两端）裁剪分区后的分段目录"""
+        if not self.directory.exists():
+            return []
+        found = []
+        for route in sorted(self.directory.iterdir()):
+            origin, _, destination = route.name.partition("-")
+            if not route.is_dir() or (from_code and origin != from_code) or (to_code and destination != to_code):
+                continue
+            for day in sorted(route.iterdir()):
+                if (start_date and day.name < start_date) or (end_date and day.name > end_date):
+                    continue
+                found.extend(sorted(path for path in day.glob("seg-*") if path.is_dir()))
+        return found
+    
+    def _read_segment(self, path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        meta = json_codec.loads((path / "meta.json").read_bytes())
+        columns = {}
+        for name, code in meta["columns"].items():
+            if np is not None:
+                # 只读映射文件，不复制数据；比 numpy.memmap 的创建开销小，分段很多时更明显
+                with open(path / f"{name}.bin", 'rb') as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                column = np.frombuffer(buffer, dtype=np.dtype(code), count=meta["rows"])
+                columns[name] = column if meta["byteorder"] == sys.byteorder else column.byteswap()
+            else:
+                column = array(code)
+                with open(path / f"{name}.bin", 'rb') as f:
+                    column.fromfile(f, meta["rows"])
+                if meta["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                columns[name] = column
+        return meta, columns
+    
+    def scan(self, from_code: Optional[str] = None, to_code: Optional[str] = None,
+             start_date: Optional[str] = None, end_date: Optional[str] = None,
+             train: Optional[str] = None, seat: Optional[str] = None) -> TicketSnapshots:
+        """读取符合条件的快照：路线和日期用于裁剪分区，车次和席别在分段内按列过滤；损坏的分段会被跳过"""
+        trains: Dict[str, int] = {}
+        seats: Dict[str, int] = {}
+        pieces: List[Dict[str, Any]] = []
+        for path in self.segments(from_code, to_code, start_date, end_date):
+            try:
+                meta, columns = self._read_segment(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"⚠️ 跳过无法读取的快照分段 {path}: {e}")
+                continue
+            if (train and train not in meta["trains"]) or (seat and seat not in meta["seats"]):
+                continue
+            # 分段内的字典下标映射为全局下标
+            train_map = [trains.setdefault(name, len(trains)) for name in meta["trains"]]
+            seat_map = [seats.setdefault(name, len(seats)) for name in meta["seats"]]
+            if np is not None:
+                mask = np.ones(meta["rows"], dtype=bool)
+                if train:
+                    mask &= columns["train"] == meta["trains"].index(train)
+                if seat:
+                    mask &= columns["seat"] == meta["seats"].index(seat)
+                piece = {name: column[mask] for name, column in columns.items()}
+                piece["train"] = np.asarray(train_map, dtype=np.uint32)[piece["train"]]
+                piece["seat"] = np.asarray(seat_map, dtype=np.uint8)[piece["seat"]]
+            else:
+                rows = range(meta["rows"])
+                if train:
+                    train_index = meta["trains"].index(train)
+                    rows = [i for i in rows if columns["train"][i] == train_index]
+                if seat:
+                    seat_index = meta["seats"].index(seat)
+                    rows = [i for i in rows if columns["seat"][i] == seat_index]
+                piece = {name: [column[i] for i in rows] for name, column in columns.items()}
+                piece["train"] = [train_map[i] for i in piece["train"]]
+                piece["seat"] = [seat_map[i] for i in piece["seat"]]
+            pieces.append(piece)
+        
+        if np is not None:
+            merged = {name: np.concatenate([piece[name] for piece in pieces]) if pieces else np.zeros(0, dtype=code)
+                      for name, code in self.COLUMNS.items()}
+        else:
+            merged = {name: [value for piece in pieces for value in piece[name]] for name in self.COLUMNS}
+        return TicketSnapshots(merged, list(trains), list(seats))
+    
+    @staticmethod
+    def sellout_profile(snapshots: TicketSnapshots) -> List[Dict[str, Any]]:
+        """
+        各（车次, 席别）的售罄规律：对每个班次（车次 + 发车时间），按查询时间找到从有票变为无票的第一次快照，
+        统计观察到的班次数、售罄的班次数，以及售罄时距发车的小时数中位数；按售罄比例从高到低排序
+        """
+        if not len(snapshots):
+            return []
+        columns = snapshots.columns
+        if np is not None:
+            order = np.lexsort((columns["polled"], columns["seat"], columns["departs"], columns["train"]))
+            keys = np.stack([columns["train"][order].astype(np.float64), columns["departs"][order],
+                             columns["seat"][order].astype(np.float64)], axis=1)
+            # 每个班次一组：组号在键变化处加一
+            change = np.ones(len(order), dtype=bool)
+            change[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+            group = np.cumsum(change) - 1
+            group_start = np.flatnonzero(change)
+            zero = np.flatnonzero(columns["count"][order] <= 0)
+            zero_groups, first = np.unique(group[zero], return_index=True)
+            sold_rows = zero[first]
+            # 第一次快照就无票的班次不知道何时售罄，不计入
+            sold = sold_rows > group_start[zero_groups]
+            sold_rows, sold_groups = sold_rows[sold], zero_groups[sold]
+            hours = (columns["departs"][order][sold_rows] - columns["polled"][order][sold_rows]) / 3600.0
+            # （车次, 席别）编码为一个整数，分别统计班次数和售罄时距发车的小时数
+            pairs = keys[:, 0].astype(np.int64) * 256 + keys[:, 2].astype(np.int64)
+            unique_pairs, totals = np.unique(pairs[group_start], return_counts=True)
+            departures = {(int(p) // 256, int(p) % 256): int(n) for p, n in zip(unique_pairs, totals)}
+            sold_pairs = pairs[group_start[sold_groups]]
+            sold_hours: Dict[Tuple[int, int], List[float]] = {}
+            for p, h in zip(sold_pairs.tolist(), hours.tolist()):
+                sold_hours.setdefault((p // 256, p % 256), []).append(h)
+        else:
+            groups: Dict[Tuple[int, float, int], List[Tuple[float, int]]] = {}
+            for train, departs, seat, polled, count in zip(columns["train"], columns["departs"], columns["seat"],
+                                                            columns["polled"], columns["count"]):
+                groups.setdefault((train, departs, seat), []).append((polled, count))
+            departures = {}
+            sold_hours = {}
+            for (train, departs, seat), polls in groups.items():
+                departures[(train, seat)] = departures.get((train, seat), 0) + 1
+                polls.sort()
+                for n, (polled, count) in enumerate(polls):
+                    if count <= 0:
+                        if n:
+                            sold_hours.setdefault((train, seat), []).append((departs - polled) / 3600.0)
+                        break
+        
+        profile = []
+        for (train, seat), total in departures.items():
+            hours = sorted(sold_hours.get((train, seat), []))
+            median = None
+            if hours:
+                mid = len(hours) // 2
+                median = hours[mid] if len(hours) % 2 else (hours[mid - 1] + hours[mid]) / 2
+            profile.append({"train": snapshots.trains[train], "seat": snapshots.seats[seat], "departures": total,
+                            "sold_out": len(hours), "median_hours_before": median})
+        profile.sort(key=lambda p: (-p["sold_out"] / p["departures"], -(p["median_hours_before"] or 0)))
+        return profile
+
+
+class CacheBackend(ABC):
+    """
+    工具结果缓存的存储后端接口
+    get/set 按键读写并带 TTL，容量超限时由后端自行淘汰；try_lease/release 提供按键的短期租约，
+    保证多个进程同时未命中时只有一个进程去调用工具（其余进程等待结果写入）
+    Redis 等外部存储可以用 GET / SET EX / SET NX PX / DEL 实现同样的接口
+    blocking=True 的后端（访问磁盘或网络）由 ToolResultCache 在线程池中调用，不阻塞事件循环
+    """
+    
+    max_entries: int = 512
+    blocking: bool = False
+    
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """读取未过期的值，不存在时返回 None"""
+    
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float):
+        """写入值，ttl 秒后过期"""
+    
+    def contains(self, key: str) -> bool:
+        return self.get(key) is not None
+    
+    def try_lease(self, key: str, seconds: float) -> bool:
+        """尝试获得计算该键的租约；租约到期后自动失效，避免持有者崩溃后其他进程一直等待"""
+        return True
+    
+    def release(self, key: str):
+        pass
+    
+    def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """进程内缓存后端：有序字典实现的 LRU"""
+    
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+    
+    def contains(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+    
+    def set(self, key: str, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    SQLite 缓存后端（WAL 模式）：同一主机上的多个客户端进程共享工具结果
+    读操作不阻塞写操作；按最近访问时间淘汰（访问时间每 touch_interval 秒最多更新一次，命中时通常无需写库）
+    写操作可能等待其他进程的写锁，由 ToolResultCache 在线程池中调用；每个线程使用独立的连接
+    """
+    
+    blocking = True
+    
+    def __init__(self, path: str, max_entries: int = 512, touch_interval: float = 30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.owner = f"{os.getpid()}-{id(self)}"
+        parent = Path(path).parent
+        if not parent.exists():
+            parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tool_cache_accessed ON tool_cache (accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache_leases ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+    
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """当前线程的连接（首次使用时创建）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 自动提交模式，写操作用 BEGIN IMMEDIATE 显式加写锁；busy timeout 应对其他进程的短暂写锁
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _write(self, statements: List[Tuple[str, tuple]]) -> List[sqlite3.Cursor]:
+        """在一个写事务中执行多条语句"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursors = [self._conn.execute(sql, args) for sql, args in statements]
+            self._conn.execute("COMMIT")
+            return cursors
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+    
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT value, expires_at, accessed_at FROM tool_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        if now - row[2] > self.touch_interval:
+            self._conn.execute("UPDATE tool_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json_codec.loads(row[0])
+    
+    def contains(self, key: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM tool_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+    
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        self._write([
+            ("INSERT OR REPLACE INTO tool_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+             (key, json_codec.dumps(value), now + ttl, now)),
+            ("DELETE FROM tool_cache WHERE expires_at <= ?", (now,)),
+            ("DELETE FROM tool_cache WHERE key IN (SELECT key FROM tool_cache ORDER BY accessed_at DESC "
+             "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        ])
+    
+    def try_lease(self, key: str, seconds: float) -> bool:
+        now = time.time()
+        _, inserted = self._write([
+            ("DELETE FROM tool_cache_leases WHERE key = ? AND expires_at <= ?", (key, now)),
+            ("INSERT OR IGNORE INTO tool_cache_leases (key, owner, expires_at) VALUES (?, ?, ?)",
+             (key, self.owner, now + seconds))
+        ])
+        return inserted.rowcount == 1
+    
+    def release(self, key: str):
+        self._conn.execute("DELETE FROM tool_cache_leases WHERE key = ? AND owner = ?", (key, self.owner))
+    
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM tool_cache").fetchone()[0]
+    
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class _LeaderCancelled(Exception):
+    """发起缓存计算的调用被取消：等待同一结果的调用改为自行计算，而不是一起被取消"""
+
+
+class ToolResultCache:
+    """
+    工具结果缓存：按工具名和规范化参数缓存成功结果，支持按工具设置 TTL
+    存储由可替换的后端负责（默认进程内 LRU，也可用 SQLite 在多个进程间共享）
+    """
+    
+    def __init__(self, ttl_by_tool: Dict[str, float], max_entries: int = 512,
+                 backend: Optional[CacheBackend] = None, lease_seconds: float = 30.0):
+        self.ttl_by_tool = ttl_by_tool
+        self.backend = backend if backend is not None else MemoryCacheBackend(max_entries)
+        self.backend.max_entries = max_entries
+        self.lease_seconds = lease_seconds
+        # 本进程内正在计算的键：并发的相同调用等待同一个结果
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def max_entries(self) -> int:
+        return self.backend.max_entries
+    
+    @max_entries.setter
+    def max_entries(self, value: int):
+        self.backend.max_entries = value
+    
+    @staticmethod
+    def make_key(tool_name: str, arguments: Dict[str, Any]) -> str:
+        """
+        生成缓存键：忽略空值参数并排序，使等价调用命中同一条目
+        固定使用标准库 json：不同编解码器的输出格式不同，共享缓存的进程必须生成相同的键
+        """
+        normalized = {k: v for k, v in (arguments or {}).items() if v not in (None, "", [], {})}
+        return f"{tool_name}:{json.dumps(normalized, ensure_ascii=False, sort_keys=True)}"
+    
+    def is_cacheable(self, tool_name: str) -> bool:
+        """该工具是否启用缓存（TTL > 0）"""
+        return self.ttl_by_tool.get(tool_name, 0) > 0
+    
+    def get(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[Any]:
+        """读取未过期的缓存结果"""
+        if not self.is_cacheable(tool_name):
+            return None
+        value = self.backend.get(self.make_key(tool_name, arguments))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+    
+    async def contains(self, tool_name: str, arguments: Dict[str, Any]) -> bool:
+        """是否存在未过期条目（不计入命中统计；会阻塞的后端在线程池中查询，后端出错时视为不存在）"""
+        return await self._backend_call(False, self.backend.contains, self.make_key(tool_name, arguments))
+    
+    def set(self, tool_name: str, arguments: Dict[str, Any], result: Any):
+        """写入缓存，超出容量时由后端淘汰"""
+        ttl = self.ttl_by_tool.get(tool_name, 0)
+        if ttl <= 0:
+            return
+        self.backend.set(self.make_key(tool_name, arguments), result, ttl)
+    
+    async def _backend_call(self, default: Any, method: Callable[..., Any], *args) -> Any:
+        """调用后端方法：会阻塞的后端在线程池中执行；后端出错（数据库被锁、损坏等）时记录日志并返回 default"""
+        try:
+            if self.backend.blocking:
+                return await asyncio.get_event_loop().run_in_executor(None, functools.partial(method, *args))
+            return method(*args)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ 工具缓存后端出错，按未命中处理: {e}")
+            return default
+    
+    async def get_or_compute(self, tool_name: str, arguments: Dict[str, Any],
+                             compute: Callable[[], Awaitable[Any]],
+                             should_cache: Callable[[Any], bool]) -> Tuple[Any, bool]:
+        """
+        读取缓存，未命中时调用 compute 计算并写入（should_cache 为真时），返回 (结果, 是否来自缓存)
+        同一键的并发未命中只计算一次：本进程内等待同一个 Future，跨进程通过后端租约协调；
+        等待者只在结果已写入缓存时计为命中（不可缓存的结果如错误原样共享，但不算命中）；
+        发起计算的调用被取消时，等待者不受影响，改为由其中一个重新计算
+        """
+        if not self.is_cacheable(tool_name):
+            return await compute(), False
+        
+        key = self.make_key(tool_name, arguments)
+        while True:
+            value = await self._backend_call(None, self.backend.get, key)
+            if value is not None:
+                self.hits += 1
+                return value, True
+            
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                value, shared_hit = await asyncio.shield(inflight)
+            except _LeaderCancelled:
+                continue
+            if shared_hit:
+                self.hits += 1
+            return value, shared_hit
+        
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, from_cache, stored = await self._compute_with_lease(tool_name, key, compute, should_cache)
+        except BaseException as e:
+            future.set_exception(_LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            # 没有等待者时也标记为已读取，避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result((value, from_cache or stored))
+            return value, from_cache
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+    
+    async def _compute_with_lease(self, tool_name: str, key: str, compute: Callable[[], Awaitable[Any]],
+                                  should_cache: Callable[[Any], bool]) -> Tuple[Any, bool, bool]:
+        """
+        获得租约的进程负责计算；其他进程轮询结果，租约过期后自行计算（后端出错时直接计算）
+        返回 (结果, 是否来自缓存, 是否写入了缓存)
+        """
+        waited_until = time.monotonic() + self.lease_seconds
+        while not await self._backend_call(True, self.backend.try_lease, key, self.lease_seconds):
+            await asyncio.sleep(0.05)
+            value = await self._backend_call(None, self.backend.get, key)
+            if value is not None:
+                return value, True, False
+            if time.monotonic() >= waited_until:
+                break
+        try:
+            # 等待租约期间其他进程可能已经写入
+            value = await self._backend_call(None, self.backend.get, key)
+            if value is not None:
+                return value, True, False
+            value = await compute()
+            stored = should_cache(value)
+            if stored:
+                await self._backend_call(None, self.backend.set, key, value, self.ttl_by_tool.get(tool_name, 0))
+            return value, False, stored
+        finally:
+            await asyncio.shield(self._backend_call(None, self.backend.release, key))
+
+
+@dataclass(frozen=True)
+class ConnectionSettings:
+    """MCP 连接配置"""
+    retry_attempts: int = 3
+    retry_delay: float = 1.0
+    max_retry_delay: float = 30.0
+    timeout_seconds: float = 30.0
+    sse_reconnect_enabled: bool = True
+    sse_reconnect_interval: float = 5.0
+    heartbeat_interval: float = 60.0
+    pool_size: int = 100
+    keepalive_timeout: float = 15.0
+    connect_wait: float = 10.0
+    accept_encoding: str = "auto"
+    request_compression: str = "auto"
+    request_compression_min_bytes: int = 1024
+    
+    def __post_init__(self):
+        if self.retry_attempts < 1:
+            raise ValueError("mcp_server.connection.retry_attempts 必须 >= 1")
+        if self.pool_size < 1:
+            raise ValueError("mcp_server.connection.pool_size 必须 >= 1")
+        if self.request_compression not in ("off", "auto", "gzip"):
+            raise ValueError("mcp_server.connection.request_compression 必须是 off、auto 或 gzip")
+
+
+@dataclass(frozen=True)
+class McpServerSettings:
+    """MCP 服务器配置"""
+    url: str = "http://localhost:12306"
+    connection: ConnectionSettings = field(default_factory=ConnectionSettings)
+
+
+@dataclass(frozen=True)
+class LLMSettings:
+    """LLM 配置（端点、路由等复杂结构仍通过 ConfigManager.get 读取）"""
+    provider: str = "deepseek"
+    model: str = ""
+    base_url: str = ""
+    max_iterations: int = 5
+    
+    def __post_init__(self):
+        if self.max_iterations < 1:
+            raise ValueError("llm.max_iterations 必须 >= 1")
+
+
+@dataclass(frozen=True)
+class MemorySettings:
+    """记忆配置"""
+    session_enabled: bool = True
+    persistent_enabled: bool = True
+    user_profile_path: str = "user_profile.json"
+    profile_save_debounce: float = 2.0
+    history_path: str = "conversation_history.json"
+    history_save_debounce: float = 2.0
+    max_context_messages: int = 20
+    load_recent_history: bool = True
+    recent_history_count: int = 3
+    summary_method: str = "llm"
+    summary_max_chars: int = 400
+    max_history_sessions: int = 50
+    archive_dir: str = ""
+    archive_compression: str = "gzip"
+    # relevant：按与当前问题的相关度检索历史会话；recent：注入最近 recent_history_count 个会话
+    history_retrieval: str = "relevant"
+    retrieval_max_tokens: int = 300
+    retrieval_top_k: int = 5
+    
+    def __post_init__(self):
+        if self.archive_compression not in HistoryArchive.FORMATS:
+            raise ValueError(f"memory.archive_compression 必须是 {', '.join(HistoryArchive.FORMATS)} 之一")
+        if self.history_retrieval not in ("relevant", "recent"):
+            raise ValueError("memory.history_retrieval 必须是 relevant 或 recent")
+
+
+@dataclass(frozen=True)
+class RateLimitSettings:
+    """MCP 请求限速配置；tools 为 工具名 -> {"rate": 每秒请求数, "burst": 突发数}"""
+    enabled: bool = True
+    default_rate: float = 0.0
+    default_burst: float = 1.0
+    background_reserve: float = 1.0
+    tools: dict = field(default_factory=dict)
+    
+    def __post_init__(self):
+        # 突发数小于 1 时令牌永远攒不够一个，请求会一直排队
+        if self.default_burst < 1:
+            raise ValueError("rate_limit.default_burst 必须 >= 1")
+        for name, limit in self.tools.items():
+            if not isinstance(limit, dict):
+                raise ValueError(f"配置项 rate_limit.tools.{name} 应为对象")
+            for key in ("rate", "burst"):
+                value = limit.get(key)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                          or value < 0):
+                    raise ValueError(f"配置项 rate_limit.tools.{name}.{key} 应为非负数")
+            if limit.get("burst", 1) < 1:
+                raise ValueError(f"rate_limit.tools.{name}.burst 必须 >= 1")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """编译后的只读配置快照，热路径通过属性访问，无需逐级查找字典"""
+    mcp_server: McpServerSettings = field(default_factory=McpServerSettings)
+    llm: LLMSettings = field(default_factory=LLMSettings)
+    memory: MemorySettings = field(default_factory=MemorySettings)
+    rate_limit: RateLimitSettings = field(default_factory=RateLimitSettings)
+
+
+def _compile_settings(cls, data: Any, path: str = ""):
+    """把 JSON 字典编译为（嵌套的）配置数据类，并校验字段类型"""
+    if not isinstance(data, dict):
+        raise ValueError(f"配置项 {path or '<root>'} 应为对象")
+    
+    values = {}
+    for f in fields(cls):
+        if f.name not in data:
+            continue
+        key = f"{path}.{f.name}" if path else f.name
+        value = data[f.name]
+        if is_dataclass(f.type):
+            values[f.name] = _compile_settings(f.type, value, key)
+        elif f.type is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"配置项 {key} 应为布尔值")
+            values[f.name] = value
+        elif f.type in (int, float):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"配置项 {key} 应为数字")
+            if value < 0:
+                raise ValueError(f"配置项 {key} 不能为负数")
+            values[f.name] = f.type(value)
+        elif f.type is str:
+            if not isinstance(value, str):
+                raise ValueError(f"配置项 {key} 应为字符串")
+            values[f.name] = value
+        elif f.type is dict:
+            if not isinstance(value, dict):
+                raise ValueError(f"配置项 {key} 应为对象")
+            values[f.name] = value
+    return cls(**values)
+
+
+class ConfigSnapshot:
+    """一次加载的配置：原始字典、点分路径索引和编译后的 Settings，整体替换以保证原子性"""
+    
+    def __init__(self, raw: Dict[str, Any], mtime: float = 0.0):
+        self.raw = raw
+        self.mtime = mtime
+        self.settings = _compile_settings(Settings, raw)
+        self.index: Dict[str, Any] = {}
+        self._build_index(raw, "")
+    
+    def _build_index(self, node: Dict[str, Any], prefix: str):
+        for key, value in node.items():
+            path = f"{prefix}.{key}" if prefix else key
+            self.index[path] = value
+            if isinstance(value, dict):
+                self._build_index(value, path)
+
+
+class ConfigManager:
+    """配置管理器：支持JSON配置文件和环境变量；编译为只读快照，并支持热加载"""
+    
+    def __init__(self, config_path: str = "config.json"):
+        self.config_path = config_path
+        self._listeners: List[Any] = []
+        self._snapshot = self._load_snapshot()
+    
+    @property
+    def config(self) -> Dict[str, Any]:
+        """当前配置的原始字典"""
+        return self._snapshot.raw
+    
+    @property
+    def settings(self) -> Settings:
+        """当前编译后的配置快照（热路径使用）"""
+        return self._snapshot.settings
+    
+    def _file_mtime(self) -> float:
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return 0.0
+    
+    def _load_snapshot(self) -> ConfigSnapshot:
+        """
+        启动时加载并编译配置；文件不存在时使用默认配置
+        文件存在但无效（JSON 错误、字段类型或取值不合法）时抛出 ValueError，而不是悄悄以默认配置运行
+        """
+        if not Path(self.config_path).exists():
+            logger.warning(f"配置文件 {self.config_path} 不存在，使用默认配置")
+            return ConfigSnapshot(self._get_default_config())
+        
+        try:
+            return self._read_snapshot()
+        except Exception as e:
+            raise ValueError(f"配置文件 {self.config_path} 无效: {e}") from e
+    
+    def _read_snapshot(self) -> ConfigSnapshot:
+        """读取并编译配置文件，出错时抛出异常"""
+        mtime = self._file_mtime()
+        with open(self.config_path, 'r', encoding='utf-8') as f:
+            return ConfigSnapshot(json.load(f), mtime)
+    
+    def _get_default_config(self) -> Dict[str, Any]:
+        """默认配置"""
+        return {
+            "mcp_server": {
+                "url": "http://localhost:12306",
+                "connection": {
+                    "retry_attempts": 3,
+                    "retry_delay": 1.0,
+                    "max_retry_delay": 30.0,
+                    "timeout_seconds": 30,
+                    "sse_reconnect_enabled": True,
+                    "heartbeat_interval": 60
+                }
+            },
+            "llm": {
+                "provider": "deepseek",
+                "model": "deepseek-chat",
+                "max_iterations": 5
+            },
+            "memory": {
+                "session_enabled": True,
+                "max_context_messages": 20
+            },
+            "logging": {
+                "level": "INFO"
+            }
+        }
+    
+    def get(self, path: str, default: Any = None) -> Any:
+        """获取配置项，支持点分路径，如 'mcp_server.url'（查预先建立的索引）"""
+        return self._snapshot.index.get(path, default)
+    
+    def add_listener(self, callback):
+        """注册配置变更回调：callback(old_settings, new_settings)"""
+        self._listeners.append(callback)
+    
+    async def reload(self) -> bool:
+        """重新加载配置：在线程池中读取和编译，成功后在事件循环中整体替换快照；无效配置保留旧快照"""
+        loop = asyncio.get_event_loop()
+        try:
+            snapshot = await loop.run_in_executor(None, self._read_snapshot)
+        except Exception as e:
+            logger.error(f"❌ 配置热加载失败，继续使用当前配置: {e}")
+            # 记录时间戳，避免对同一个无效文件反复报错
+            self._snapshot.mtime = self._file_mtime()
+            return False
+        
+        old_settings = self._snapshot.settings
+        self._snapshot = snapshot
+        logger.info(f"🔄 已热加载配置: {self.config_path}")
+        for callback in self._listeners:
+            try:
+                callback(old_settings, snapshot.settings)
+            except Exception as e:
+                logger.error(f"❌ 应用新配置失败: {e}")
+        return True
+    
+    async def watch(self, interval: float = 2.0):
+        """轮询配置文件修改时间，变化时热加载"""
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._file_mtime()
+            if mtime and mtime != self._snapshot.mtime:
+                await self.reload()
+
+
+class UserProfileManager:
+    """用户配置管理器：管理用户偏好和记忆（脏标记 + 防抖后台落盘 + 原子写入）"""
+    
+    def __init__(self, profile_path: str = "user_profile.json", save_debounce: float = 2.0):
+        self.profile_path = profile_path
+        self.save_debounce = save_debounce
+        
+        # 版本号：每次修改 +1，落盘后记录已保存的版本，两者不等即为"脏"
+        self._version = 0
+        self._saved_version = 0
+        # 用户上下文只依赖偏好和别名，单独计版本，避免统计更新导致缓存失效
+        self._context_version = 0
+        self._context_cache: Optional[Tuple[int, str]] = None
+        
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        
+        self.profile = self._load_profile()
+        if self.is_dirty:
+            self.save()
+    
+    @property
+    def is_dirty(self) -> bool:
+        """是否存在尚未落盘的修改"""
+        return self._version != self._saved_version
+    
+    def _load_profile(self) -> Dict[str, Any]:
+        """加载用户配置"""
+        if not Path(self.profile_path).exists():
+            return self._create_default_profile()
+        
+        try:
+            return json_codec.loads(Path(self.profile_path).read_bytes())
+        except Exception as e:
+            memory_logger.error(f"加载用户配置失败: {e}")
+            return self._create_default_profile()
+    
+    def _create_default_profile(self) -> Dict[str, Any]:
+        """创建默认用户配置（只标记为脏，由调用方在赋值后落盘）"""
+        profile = {
+            "user_id": "default_user",
+            "created_at": datetime.now().isoformat(),
+            "preferences": {},
+            "aliases": {},
+            "travel_history": {"frequent_routes": []},
+            "metadata": {"total_queries": 0}
+        }
+        self._version += 1
+        return profile
+    
+    def mark_dirty(self, context_changed: bool = False):
+        """
+        标记配置已修改，并安排一次防抖的后台落盘
+        直接修改 preferences/aliases 后需传入 context_changed=True 以刷新用户上下文缓存
+        """
+        self._version += 1
+        if context_changed:
+            self._context_version += 1
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """在防抖窗口结束后落盘；窗口内的多次修改合并为一次写入"""
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有运行中的事件循环（同步场景），等待显式 save()
+            return
+        self._flush_handle = loop.call_later(self.save_debounce, self._start_flush)
+    
+    def _start_flush(self):
+        """防抖计时器回调：启动后台落盘任务"""
+        self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            # 上一次写入尚未完成，完成后会自行检查是否需要再次落盘
+            return
+        self._flush_task = asyncio.ensure_future(self.flush())
+    
+    def _write(self, text: Union[str, bytes], version: int):
+        """写入磁盘（可在线程池中执行）；加锁并比较版本，避免旧快照覆盖新快照"""
+        with self._write_lock:
+            if version <= self._saved_version:
+                return
+            atomic_write_text(self.profile_path, text)
+            self._saved_version = version
+    
+    async def flush(self):
+        """异步落盘：在事件循环中序列化快照，文件 I/O 放到线程池执行"""
+        if not self.is_dirty:
+            return
+        version = self._version
+        try:
+            text = json_codec.dumps(self.profile, indent=True)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._write, text, version)
+        except Exception as e:
+            memory_logger.error(f"保存用户配置失败: {e}")
+            return
+        if self.is_dirty:
+            self._schedule_flush()
+    
+    async def close(self):
+        """取消防抖计时器，等待进行中的写入，并把剩余修改落盘"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+    
+    def save(self):
+        """同步保存用户配置（原子写入）"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        try:
+            text = json_codec.dumps(self.profile, indent=True)
+            self._write(text, self._version)
+        except Exception as e:
+            memory_logger.error(f"保存用户配置失败: {e}")
+    
+    def get_user_context(self) -> str:
+        """获取用户上下文信息，用于增强系统提示（在偏好变化前复用缓存结果）"""
+        if self._context_cache is not None and self._context_cache[0] == self._context_version:
+            return self._context_cache[1]
+        context = self._render_user_context()
+        self._context_cache = (self._context_version, context)
+        return context
+    
+    def _render_user_context(self) -> str:
+        """生成用户上下文字符串"""
+        prefs = self.profile.get('preferences', {})
+        aliases = self.profile.get('aliases', {})
+        
+        context_parts = []
+        
+        if prefs.get('default_departure_city'):
+            context_parts.append(f"- 常用出发地: {prefs['default_departure_city']}")
+        
+        if prefs.get('default_arrival_city'):
+            context_parts.append(f"- 常用目的地: {prefs['default_arrival_city']}")
+        
+        if prefs.get('preferred_seat_type'):
+            context_parts.append(f"- 偏好席别: {prefs['preferred_seat_type']}")
+        
+        if aliases:
+            alias_strs = [f"'{k}' = '{v}'" for k, v in aliases.items() if v]
+            if alias_strs:
+                context_parts.append(f"- 地点别名: {', '.join(alias_strs)}")
+        
+        if context_parts:
+            return "\n# 用户偏好\n" + "\n".join(context_parts) + "\n"
+        return ""
+    
+    def update_query_stats(self):
+        """更新查询统计"""
+        if 'metadata' not in self.profile:
+            self.profile['metadata'] = {}
+        self.profile['metadata']['total_queries'] = self.profile['metadata'].get('total_queries', 0) + 1
+        self.profile['metadata']['last_active'] = datetime.now().isoformat()
+        self.mark_dirty()
+    
+    def record_route(self, from_station: str, to_station: str,
+                     from_city: Optional[str] = None, to_city: Optional[str] = None,
+                     max_routes: int = 20):
+        """记录一次成功查询的路线，累计次数并更新最近使用时间"""
+        history = self.profile.setdefault('travel_history', {})
+        routes = history.setdefault('frequent_routes', [])
+        now = datetime.now().isoformat()
+        
+        for route in routes:
+            if route.get('from') == from_station and route.get('to') == to_station:
+                route['count'] = route.get('count', 0) + 1
+                route['last_used'] = now
+                break
+        else:
+            routes.append({
+                "from": from_station,
+                "to": to_station,
+                "from_city": from_city or "",
+                "to_city": to_city or "",
+                "count": 1,
+                "last_used": now
+            })
+        
+        # 超出上限时淘汰得分最低的路线
+        if len(routes) > max_routes:
+            routes[:] = self.get_frequent_routes(max_routes)
+        
+        # 用户未设置默认出发/到达城市时，用最常用路线填充
+        context_changed = False
+        prefs = self.profile.setdefault('preferences', {})
+        top = self.get_frequent_routes(1)
+        if top and top[0].get('count', 0) >= 3:
+            if not prefs.get('default_departure_city') and top[0].get('from_city'):
+                prefs['default_departure_city'] = top[0]['from_city']
+                context_changed = True
+            if not prefs.get('default_arrival_city') and top[0].get('to_city'):
+                prefs['default_arrival_city'] = top[0]['to_city']
+                context_changed = True
+        
+        self.mark_dirty(context_changed=context_changed)
+    
+    def get_frequent_routes(self, limit: int = 3, half_life_days: float = 14.0) -> List[Dict[str, Any]]:
+        """按频次和最近使用时间排序常用路线：得分 = 次数 × 0.5^(距今天数 / 半衰期)"""
+        routes = self.profile.get('travel_history', {}).get('frequent_routes', [])
+        now = datetime.now()
+        
+        def score(route: Dict[str, Any]) -> float:
+            try:
+                age_days = (now - datetime.fromisoformat(route.get('last_used', ''))).total_seconds() / 86400
+            except ValueError:
+                age_days = half_life_days * 4
+            return route.get('count', 0) * 0.5 ** (max(age_days, 0) / half_life_days)
+        
+        return sorted(routes, key=score, reverse=True)[:limit]
+
+
+class TokenAccountant:
+    """Token 记账器：记录每轮 LLM 调用的用量，按会话和用户（每日）汇总，并执行单次查询/每日预算"""
+    
+    def __init__(self, profile: Optional[UserProfileManager] = None,
+                 per_query_tokens: int = 0, per_day_tokens: int = 0,
+                 degrade_ratio: float = 0.8, pricing: Optional[Dict[str, Dict[str, float]]] = None):
+        self.profile = profile
+        self.per_query_tokens = per_query_tokens
+        self.per_day_tokens = per_day_tokens
+        self.degrade_ratio = degrade_ratio
+        self.pricing = pricing or {}
+        self.session_usage = self._empty_usage()
+        # 未启用用户配置时，每日用量只在内存中统计
+        self._local_daily: Dict[str, Dict[str, Any]] = {}
+    
+    @staticmethod
+    def _empty_usage() -> Dict[str, Any]:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "calls": 0, "cost": 0.0}
+    
+    def start_query(self) -> Dict[str, Any]:
+        """开始一次查询，返回该查询的用量记录"""
+        usage = self._empty_usage()
+        usage["last_prompt_tokens"] = 0
+        return usage
+    
+    def _daily_usage(self) -> Dict[str, Any]:
+        """今日用量记录（可写）"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self.profile:
+            usage = self.profile.profile.setdefault('usage', {})
+            daily = usage.setdefault('daily', {})
+        else:
+            daily = self._local_daily
+        if today not in daily:
+            daily[today] = self._empty_usage()
+            # 只保留最近 31 天
+            for day in sorted(daily)[:-31]:
+                del daily[day]
+        return daily[today]
+    
+    def record(self, query_usage: Dict[str, Any], usage: Any, model: str):
+        """记录一次 LLM 调用的用量（usage 为 OpenAI 响应中的 usage 对象，可能为空）"""
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        price = self.pricing.get(model, {})
+        cost = (prompt_tokens * price.get('prompt', 0) + completion_tokens * price.get('completion', 0)) / 1000
+        
+        targets = [query_usage, self.session_usage, self._daily_usage()]
+        if self.profile:
+            targets.append(self.profile.profile['usage'].setdefault('total', self._empty_usage()))
+        for target in targets:
+            target['prompt_tokens'] += prompt_tokens
+            target['completion_tokens'] += completion_tokens
+            target['calls'] += 1
+            target['cost'] = round(target.get('cost', 0.0) + cost, 6)
+        query_usage['last_prompt_tokens'] = prompt_tokens
+        
+        if self.profile:
+            self.profile.mark_dirty()
+    
+    @staticmethod
+    def total_tokens(usage: Dict[str, Any]) -> int:
+        return usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+    
+    def day_tokens(self) -> int:
+        """今日已用 Token 数"""
+        return self.total_tokens(self._daily_usage())
+    
+    def day_exhausted(self) -> bool:
+        """每日预算是否已用完"""
+        return self.per_day_tokens > 0 and self.day_tokens() >= self.per_day_tokens
+    
+    def can_continue(self, query_usage: Dict[str, Any]) -> bool:
+        """是否还能再发起一轮 LLM 调用：下一轮的提示至少和上一轮一样长"""
+        next_cost = query_usage.get('last_prompt_tokens', 0)
+        if self.per_query_tokens > 0 and self.total_tokens(query_usage) + next_cost > self.per_query_tokens:
+            return False
+        if self.per_day_tokens > 0 and self.day_tokens() + next_cost > self.per_day_tokens:
+            return False
+        return True
+    
+    def should_degrade(self, query_usage: Dict[str, Any]) -> bool:
+        """用量是否已接近预算上限（超过 degrade_ratio），需要降级"""
+        if self.per_query_tokens > 0 and \
+                self.total_tokens(query_usage) >= self.per_query_tokens * self.degrade_ratio:
+            return True
+        if self.per_day_tokens > 0 and self.day_tokens() >= self.per_day_tokens * self.degrade_ratio:
+            return True
+        return False
+    
+    def summary(self) -> Dict[str, Any]:
+        """用量汇总：本次会话、今日、累计"""
+        result = {
+            "session": dict(self.session_usage),
+            "today": dict(self._daily_usage()),
+            "per_query_budget": self.per_query_tokens,
+            "per_day_budget": self.per_day_tokens
+        }
+        if self.profile:
+            result["total"] = dict(self.profile.profile.get('usage', {}).get('total', self._empty_usage()))
+        return result
+
+
+class ToolLoopState:
+    """单次查询的工具循环状态：已执行的调用结果、重复次数和查票成功次数"""
+    
+    def __init__(self, expected_routes: int = 1, max_repeats: int = 2, finalize_after_tickets: bool = True):
+        self.expected_routes = expected_routes
+        self.max_repeats = max_repeats
+        self.finalize_after_tickets = finalize_after_tickets
+        self.results: Dict[str, str] = {}
+        self.repeats = 0
+        self.tickets_ok = 0
+    
+    def lookup(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[str]:
+        """查找本次查询中相同参数的调用结果；命中即计为一次重复调用"""
+        content = self.results.get(ToolResultCache.make_key(tool_name, arguments))
+        if content is not None:
+            self.repeats += 1
+        return content
+    
+    def remember(self, tool_name: str, arguments: Dict[str, Any], content: str, ok: bool):
+        """记录一次实际执行的调用结果"""
+        self.results[ToolResultCache.make_key(tool_name, arguments)] = content
+        if ok and tool_name == 'get-tickets':
+            self.tickets_ok += 1
+        elif ok and tool_name == TicketFanout.TOOL_NAME:
+            # 一次批量查票已覆盖所需的全部日期和路线
+            self.tickets_ok = max(self.tickets_ok + 1, self.expected_routes)
+    
+    def should_finalize(self) -> bool:
+        """是否应禁止继续调用工具、直接生成回复：查票已覆盖所有路线，或模型在反复调用同一工具"""
+        if self.finalize_after_tickets and self.tickets_ok >= self.expected_routes:
+            return True
+        return self.repeats >= self.max_repeats
+
+
+class ToolLoopController:
+    """工具循环控制器：根据最近成功查询实际用到的轮数，自适应收紧最大轮数"""
+    
+    def __init__(self, min_iterations: int = 2, window: int = 20, margin: int = 1,
+                 max_repeats: int = 2, finalize_after_tickets: bool = True, adaptive: bool = True):
+        self.min_iterations = min_iterations
+        self.margin = margin
+        self.max_repeats = max_repeats
+        self.finalize_after_tickets = finalize_after_tickets
+        self.adaptive = adaptive
+        self._rounds: "deque[int]" = deque(maxlen=window)
+    
+    def start_query(self, cities: List[str]) -> ToolLoopState:
+        """开始一次查询；提到 N 个城市时预计需要查询 N-1 段路线"""
+        return ToolLoopState(max(1, len(cities) - 1), self.max_repeats, self.finalize_after_tickets)
+    
+    def allowed_iterations(self, configured: int) -> int:
+        """本次查询允许的最大轮数：最近成功查询轮数的 P90 加余量，不超过配置值"""
+        if not self.adaptive or len(self._rounds) < 5:
+            return configured
+        ordered = sorted(self._rounds)
+        p90 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+        return max(self.min_iterations, min(configured, p90 + self.margin))
+    
+    def record_outcome(self, rounds_used: int, exhausted: bool):
+        """记录查询结果；轮数耗尽时按多一轮计入，使限制在不够用时自动放宽"""
+        self._rounds.append(rounds_used + 1 if exhausted else rounds_used)
+
+
+class ToolSelector:
+    """
+    按查询挑选发送给 LLM 的工具子集：常用工具始终发送，其余工具按关键词规则选入；
+    没有规则的工具（如其他 MCP 服务器的工具）按问题与工具描述是否有区分度的共同词选入。
+    模型调用了子集外的工具时把它加入子集，工具返回错误时后续轮次发送全部工具
+    """
+    
+    ALWAYS = ("get-current-date", "get-station-code-of-citys", "get-tickets")
+    # 工具名 -> 正则列表：问题匹配任一正则时选入（汉字属于 \w，英文边界用前后断言而不是 \b）
+    RULES = {
+        "get-tickets-range": [r"哪天|哪一天|最便宜|便宜的一天|[这本下]周|周末|几天|每天|连续|比较|对比|或者|还是"],
+        "get-interline-tickets": [r"中转|换乘|转车|联程|没有直达"],
+        "get-train-route-stations": [r"经停|停靠|途经|途径|沿途|停几站|停站|时刻表",
+                                     r"(?<![A-Za-z0-9])[GDCZTK]\d{1,4}(?!\d).*(站|到达|几点)"],
+        "get-stations-code-in-city": [r"有(哪些|哪几个|几个)(火车)?站|所有(火)?车站"],
+        # 具体车站名：“北京南站”、“北京南到…”、“虹桥站”（排除“哪些站”、“火车站”、“哪个车站”、“经停站”等）
+        "get-station-code-by-names": [r"[\u4e00-\u9fff]{2}[东南西北](站|到|去|出发)",
+                                      r"[\u4e00-\u9fff]{2}(?<!哪些)(?<!几个)(?<!车)(?<!经停)(?<!停靠)站(?!点)"],
+        "get-station-by-telecode": [r"(?<![A-Za-z])[A-Z]{3}(?![A-Za-z])|电报码"],
+    }
+    
+    def __init__(self, always: Optional[List[str]] = None, rules: Optional[Dict[str, List[str]]] = None):
+        self.always = set(self.ALWAYS if always is None else always)
+        merged = dict(self.RULES)
+        merged.update(rules or {})
+        self.rules = {name: [re.compile(pattern) for pattern in patterns]
+                      for name, patterns in merged.items()}
+        self.tools: List[Dict[str, Any]] = []
+        # 没有规则的工具 -> 描述中有区分度的词（出现在不到一半工具描述中的词）
+        self._keywords: Dict[str, set] = {}
+        self._tool_tokens: Dict[str, int] = {}
+        # 估算的工具定义 token 数：实际发送的 / 每次都发送全部工具时的
+        self.requests = 0
+        self.tokens_sent = 0
+        self.tokens_full = 0
+    
+    @staticmethod
+    def base_name(name: str) -> str:
+        """去掉服务器前缀（server__tool）的工具名"""
+        return name.rpartition("__")[2]
+    
+    def update(self, tools: List[Dict[str, Any]]):
+        """工具表变化时重建描述关键词和每个工具定义的 token 估算"""
+        self.tools = tools
+        terms = {}
+        for tool in tools:
+            func = tool.get("function", {})
+            text = f"{func.get('name', '')} {func.get('description', '')}".replace("-", " ").replace("_", " ")
+            terms[func.get("name", "")] = set(SessionIndex.tokenize(text))
+        counts: Dict[str, int] = {}
+        for words in terms.values():
+            for word in words:
+                counts[word] = counts.get(word, 0) + 1
+        limit = max(1, len(tools) // 2)
+        self._keywords = {name: {word for word in words if counts[word] <= limit}
+                          for name, words in terms.items()
+                          if self.base_name(name) not in self.rules and self.base_name(name) not in self.always}
+        self._tool_tokens = {tool.get("function", {}).get("name", ""):
+                             SessionIndex.estimate_tokens(json_codec.dumps_text(tool)) for tool in tools}
+    
+    def select(self, query: str, extra: Optional[set] = None, widen: bool = False) -> List[Dict[str, Any]]:
+        """本轮发送的工具：常用工具 + 规则或描述匹配的工具 + 已放宽加入的工具；widen=True 时发送全部"""
+        if widen:
+            return self.tools
+        words = set(SessionIndex.tokenize(query))
+        # 常用工具和规则按去掉服务器前缀的工具名匹配，描述关键词和 extra 按完整工具名匹配
+        matched = set(self.always)
+        matched.update(name for name, patterns in self.rules.items() if any(p.search(query) for p in patterns))
+        names = set(extra or ())
+        names.update(name for name, keywords in self._keywords.items() if keywords & words)
+        selected = []
+        for tool in self.tools:
+            name = tool.get("function", {}).get("name", "")
+            if name in names or self.base_name(name) in matched:
+                selected.append(tool)
+        # 一个工具都没有选中（如 12306 服务器未连接、其他服务器的工具与问题无关）时发送全部工具，
+        # OpenAI 兼容接口不接受空的工具列表
+        return selected or self.tools
+    
+    def record(self, selected: List[Dict[str, Any]]):
+        """记录一次 LLM 请求实际发送的工具（用于统计节省的 token）"""
+        self.requests += 1
+        self.tokens_sent += sum(self._tool_tokens.get(tool["function"]["name"], 0) for tool in selected)
+        self.tokens_full += sum(self._tool_tokens.values())
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "tool_tokens_sent": self.tokens_sent,
+            "tool_tokens_full": self.tokens_full,
+            "saved_ratio": round(1 - self.tokens_sent / self.tokens_full, 3) if self.tokens_full else 0.0
+        }
+
+
+class SpeculativeCalls:
+    """
+    推测执行表：第一轮 LLM 请求进行的同时，提前发起按问题预测的工具调用（当前日期、提到的城市的车站代码），
+    结果在 ttl 秒内等待参数相同的调用取用，过期未用的计为浪费（只丢弃条目，调用继续完成并写入工具缓存，
+    因为其他查询可能正在等待同一个缓存计算）；
+    每个工具统计最近 window 次推测的浪费比例，超过 max_waste_ratio 时停止推测该工具，之后每 probe_every 次预测试探一次
+    """
+    
+    def __init__(self, ttl: float = 30.0, max_pending: int = 4, window: int = 20,
+                 max_waste_ratio: float = 0.5, min_samples: int = 5, probe_every: int = 5):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.window = window
+        self.max_waste_ratio = max_waste_ratio
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        # 键 -> (过期时间, 工具名, 任务)；任务结果为 (工具结果, 调用耗时)
+        self._pending: Dict[str, Tuple[float, str, asyncio.Task]] = {}
+        # 所有未完成的推测任务（包括已过期丢弃的），保持引用直到完成
+        self._running: set = set()
+        # 工具名 -> 最近的推测是否被使用
+        self._outcomes: Dict[str, deque] = {}
+        self._skipped: Dict[str, int] = {}
+        self.started = 0
+        self.used = 0
+        self.wasted = 0
+        self.suppressed = 0
+        # 被第一轮 LLM 请求掩盖的工具调用耗时
+        self.hidden_seconds = 0.0
+    
+    @staticmethod
+    def make_key(tool_name: str, arguments: Dict[str, Any]) -> str:
+        """与工具缓存相同的键，但用 | 分隔的多个值（如 citys）不区分顺序"""
+        normalized = {k: "|".join(sorted(v.split("|"))) if isinstance(v, str) else v
+                      for k, v in (arguments or {}).items()}
+        return ToolResultCache.make_key(tool_name, normalized)
+    
+    def allowed(self, tool_name: str) -> bool:
+        """该工具最近的浪费比例未超过上限（超过时每 probe_every 次预测放行一次）"""
+        outcomes = self._outcomes.get(tool_name)
+        if outcomes is None or len(outcomes) < self.min_samples:
+            return True
+        if outcomes.count(False) / len(outcomes) <= self.max_waste_ratio:
+            return True
+        skipped = self._skipped.get(tool_name, 0) + 1
+        self._skipped[tool_name] = 0 if skipped >= self.probe_every else skipped
+        return skipped >= self.probe_every
+    
+    def start(self, tool_name: str, arguments: Dict[str, Any], call: Callable[[], Awaitable[Any]]) -> bool:
+        """发起一次推测调用；已有相同的推测、待取用的推测达到上限或该工具浪费过多时跳过"""
+        self.expire()
+        key = self.make_key(tool_name, arguments)
+        if key in self._pending or len(self._pending) >= self.max_pending:
+            return False
+        if not self.allowed(tool_name):
+            self.suppressed += 1
+            return False
+        
+        async def run() -> Tuple[Any, float]:
+            started = time.monotonic()
+            try:
+                result = await call()
+            except Exception as e:
+                logger.debug(f"推测调用 {tool_name} 失败: {e}")
+                result = None
+            return result, time.monotonic() - started
+        
+        task = asyncio.ensure_future(run())
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        self._pending[key] = (time.monotonic() + self.ttl, tool_name, task)
+        self.started += 1
+        return True
+    
+    async def take(self, tool_name: str, arguments: Dict[str, Any],
+                   accept: Callable[[Any], bool] = lambda value: True) -> Optional[Any]:
+        """等待并返回与本次调用匹配且未过期的推测结果；没有匹配的推测或结果不可用（accept 为假）时返回 None"""
+        if not self._pending:
+            return None
+        self.expire()
+        entry = self._pending.pop(self.make_key(tool_name, arguments), None)
+        if entry is None:
+            return None
+        taken = time.monotonic()
+        # 取用方被取消时不取消推测调用本身
+        result, elapsed = await asyncio.shield(entry[2])
+        if result is None or not accept(result):
+            self._record(tool_name, False)
+            return None
+        self._record(tool_name, True)
+        self.hidden_seconds += max(0.0, elapsed - (time.monotonic() - taken))
+        return result
+    
+    def expire(self):
+        """丢弃过期未用的推测（不取消仍在进行的调用）"""
+        now = time.monotonic()
+        for key in [key for key, entry in self._pending.items() if entry[0] < now]:
+            self._record(self._pending.pop(key)[1], False)
+    
+    def _record(self, tool_name: str, used: bool):
+        if used:
+            self.used += 1
+        else:
+            self.wasted += 1
+        outcomes = self._outcomes.get(tool_name)
+        if outcomes is None or outcomes.maxlen != self.window:
+            outcomes = self._outcomes[tool_name] = deque(outcomes or (), maxlen=self.window)
+        outcomes.append(used)
+    
+    async def close(self, timeout: float = 2.0):
+        """丢弃所有未取用的推测（不计入浪费），等待仍在进行的调用完成，超时后取消"""
+        self._pending.clear()
+        if not self._running:
+            return
+        _, running = await asyncio.wait(set(self._running), timeout=timeout)
+        for task in running:
+            task.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        self.expire()
+        return {
+            "started": self.started,
+            "used": self.used,
+            "wasted": self.wasted,
+            "suppressed": self.suppressed,
+            "pending": len(self._pending),
+            "hidden_seconds": round(self.hidden_seconds, 3)
+        }
+
+
+class LLMEndpoint:
+    """LLM 端点：一个 OpenAI 兼容服务及其滚动延迟/错误率统计"""
+    
+    def __init__(self, name: str, client: AsyncOpenAI, model: str, window: int = 50,
+                 max_error_rate: float = 0.5, cooldown_seconds: float = 30.0):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.max_error_rate = max_error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self._samples: "deque[Tuple[float, bool]]" = deque(maxlen=window)
+        self.unhealthy_until = 0.0
+    
+    def record(self, latency: float, ok: bool):
+        """记录一次调用结果；错误率超过阈值时进入冷却期"""
+        self._samples.append((latency, ok))
+        if not ok and len(self._samples) >= 3 and self.error_rate() > self.max_error_rate:
+            self.unhealthy_until = time.monotonic() + self.cooldown_seconds
+            llm_logger.warning(f"⚠️ LLM 端点 {self.name} 错误率过高，冷却 {self.cooldown_seconds:.0f} 秒")
+    
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+    
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+    
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """成功调用延迟的分位数（秒），无样本时返回 None"""
+        latencies = sorted(latency for latency, ok in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "healthy": self.healthy,
+            "samples": len(self._samples),
+            "error_rate": round(self.error_rate(), 3),
+            "p50_latency": self.latency_percentile(0.5),
+            "p95_latency": self.latency_percentile(0.95)
+        }
+
+
+class LLMRouter:
+    """
+    LLM 路由器：在多个 OpenAI 兼容端点间选择最快的健康端点，失败时自动切换；
+    启用对冲时，首个请求超过该端点 P95 延迟仍未返回，就向次优端点再发一次，取先返回者
+    """
+    
+    def __init__(self, endpoints: List[LLMEndpoint], hedge_enabled: bool = False,
+                 hedge_default_delay: float = 3.0, hedge_min_delay: float = 0.5):
+        if not endpoints:
+            raise ValueError("至少需要配置一个 LLM 端点")
+        self.endpoints = endpoints
+        self.hedge_enabled = hedge_enabled
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedged_requests = 0
+    
+    def ranked(self) -> List[LLMEndpoint]:
+        """
+        按健康状态和 P50 延迟排序：从未请求过的端点排在前面以便尽快测得延迟，
+        有请求但没有成功样本（只失败过）的端点排在已测得延迟的端点之后
+        """
+        def key(ep: LLMEndpoint) -> Tuple[bool, float]:
+            p50 = ep.latency_percentile(0.5)
+            if p50 is None:
+                p50 = 0.0 if not ep._samples else float('inf')
+            return not ep.healthy, p50
+        
+        return sorted(self.endpoints, key=key)
+    
+    def _hedge_delay(self, endpoint: LLMEndpoint) -> float:
+        p95 = endpoint.latency_percentile(0.95)
+        return max(self.hedge_min_delay, p95 if p95 is not None else self.hedge_default_delay)
+    
+    def _launch(self, endpoint: LLMEndpoint, model: Optional[str], kwargs: Dict[str, Any]) -> asyncio.Future:
+        """以任务方式发起异步 OpenAI 调用；任务被取消（查询取消、对冲失败方）时 httpx 随即关闭连接"""
+        return asyncio.ensure_future(self._call(endpoint, model or endpoint.model, kwargs))
+    
+    @staticmethod
+    async def _call(endpoint: LLMEndpoint, model_name: str, kwargs: Dict[str, Any]) -> Tuple[Any, str]:
+        """执行一次调用并记录延迟；被取消的调用没有完整的延迟样本，不记录"""
+        started = time.monotonic()
+        try:
+            response = await endpoint.client.chat.completions.create(model=model_name, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            endpoint.record(time.monotonic() - started, False)
+            raise
+        endpoint.record(time.monotonic() - started, True)
+        return response, model_name
+    
+    async def create(self, model: Optional[str] = None, **kwargs) -> Tuple[Any, str]:
+        """
+        发送 chat.completions 请求，返回 (响应, 实际使用的模型)；model 为空时使用端点默认模型
+        存在查询截止时间时，SDK 超时和等待时间都不超过剩余时间，到期抛出 asyncio.TimeoutError
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            if deadline.expired:
+                raise asyncio.TimeoutError("查询已超过截止时间")
+            kwargs.setdefault('timeout', deadline.remaining())
+        
+        ranked = self.ranked()
+        pending = {self._launch(ranked[0], model, kwargs)}
+        next_index = 1
+        hedged = False
+        last_error: Optional[BaseException] = None
+        
+        try:
+            while pending:
+                timeout = None
+                hedge_pending = self.hedge_enabled and not hedged and next_index < len(ranked)
+                if hedge_pending:
+                    timeout = self._hedge_delay(ranked[0])
+                if deadline is not None:
+                    timeout = deadline.cap(timeout) if timeout is not None else deadline.remaining()
+                
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                # 没有可对冲的端点时超时只可能来自截止时间（计时器可能略早于截止时间触发）
+                if not done and (not hedge_pending or deadline is not None and deadline.expired):
+                    raise asyncio.TimeoutError("查询已超过截止时间")
+                
+                if not done:
+                    # 对冲：首个请求过慢，向次优端点再发一次
+                    llm_logger.info(f"⏱️ LLM 端点 {ranked[0].name} 响应过慢，对冲请求 {ranked[next_index].name}")
+                    pending.add(self._launch(ranked[next_index], model, kwargs))
+                    next_index += 1
+                    hedged = True
+                    self.hedged_requests += 1
+                    continue
+                
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    llm_logger.warning(f"⚠️ LLM 请求失败: {last_error}")
+                
+                # 全部失败且没有进行中的请求：切换到下一个端点（截止时间已到则不再切换）
+                if not pending and next_index < len(ranked) and not (deadline is not None and deadline.expired):
+                    llm_logger.info(f"🔀 切换到 LLM 端点 {ranked[next_index].name}")
+                    pending.add(self._launch(ranked[next_index], model, kwargs))
+                    next_index += 1
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        raise last_error
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedged_requests": self.hedged_requests,
+            "endpoints": [ep.stats() for ep in self.endpoints]
+        }
+
+
+class TokenBucket:
+    """
+    令牌桶：按 rate（每秒）补充令牌，最多积累 burst 个
+    令牌不足时请求按 (优先级, 到达顺序) 排队，有令牌时优先放行交互请求；
+    后台请求不能取走最后 reserve 个令牌，为交互请求保留突发余量
+    """
+    
+    def __init__(self, limiter: "RateLimiter", rate: float, burst: float, reserve: float = 0.0):
+        self.limiter = limiter
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.acquired = 0
+    
+    def configure(self, rate: float, burst: float, reserve: float):
+        self._refill(time.monotonic())
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = min(self.tokens, burst)
+        self.reschedule()
+    
+    @property
+    def limited(self) -> bool:
+        return self.rate > 0
+    
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+    
+    def _refill(self, now: float):
+        if self.limited:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def _needed(self, priority: int) -> float:
+        """放行该优先级的请求所需的令牌数"""
+        if priority == RateLimiter.INTERACTIVE:
+            return 1.0
+        return 1.0 + min(self.reserve, max(self.burst - 1.0, 0.0))
+    
+    def _try_take(self, priority: int, now: float) -> bool:
+        if now < self.limiter.paused_until:
+            return False
+        if not self.limited:
+            return True
+        if self.tokens >= self._needed(priority):
+            self.tokens -= 1.0
+            return True
+        return False
+    
+    async def acquire(self, priority: int):
+        """获取一个令牌；排队期间被取消时自动退出队列"""
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and self._try_take(priority, now):
+            self.acquired += 1
+            return
+        
+        future = asyncio.get_event_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        # 新请求可能排到队首（如交互请求插到等待保留令牌的后台请求之前），立即重新调度
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        await future
+    
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._try_take(priority, now):
+                break
+            heapq.heappop(self._waiters)
+            self.acquired += 1
+            future.set_result(None)
+        if self._waiters:
+            self._schedule()
+    
+    def reschedule(self):
+        """暂停时间变化后重新计算放行时间"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule()
+    
+    def _schedule(self):
+        """按队首请求所需的令牌数计算下一次放行时间"""
+        if self._timer is not None or not self._waiters:
+            return
+        now = time.monotonic()
+        delay = max(self.limiter.paused_until - now, 0.0)
+        if self.limited:
+            priority = self._waiters[0][0]
+            delay = max(delay, (self._needed(priority) - self.tokens) / self.rate)
+        self._timer = asyncio.get_event_loop().call_later(max(delay, 0.001), self._dispatch)
+
+
+class RateLimiter:
+    """
+    MCP 调用调度器：按工具名（非工具调用按方法名）的令牌桶限速，交互查询优先于心跳、预取等后台请求；
+    服务器返回 429/503 时按 Retry-After 暂停该服务器的所有请求；记录排队深度和等待时间
+    """
+    
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+    
+    def __init__(self, default_rate: float = 0.0, default_burst: float = 1.0,
+                 limits: Optional[Dict[str, Dict[str, float]]] = None, background_reserve: float = 1.0):
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.limits = limits or {}
+        self.background_reserve = background_reserve
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.throttled = 0
+        # 各优先级的等待统计: [次数, 总等待秒数, 最大等待秒数]
+        self._waits: Dict[int, List[float]] = {p: [0, 0.0, 0.0] for p in self.PRIORITY_NAMES}
+    
+    def _bucket_config(self, key: str) -> Tuple[float, float]:
+        limit = self.limits.get(key, {})
+        rate = float(limit.get('rate', self.default_rate))
+        burst = max(float(limit.get('burst', self.default_burst)), 1.0)
+        return rate, burst
+    
+    def configure(self, default_rate: float, default_burst: float,
+                  limits: Dict[str, Dict[str, float]], background_reserve: float):
+        """配置热加载：更新限速参数，已有的令牌桶立即生效"""
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.limits = limits
+        self.background_reserve = background_reserve
+        for key, bucket in self.buckets.items():
+            bucket.configure(*self._bucket_config(key), background_reserve)
+    
+    def bucket(self, key: str) -> TokenBucket:
+        if key not in self.buckets:
+            rate, burst = self._bucket_config(key)
+            self.buckets[key] = TokenBucket(self, rate, burst, self.background_reserve)
+        return self.buckets[key]
+    
+    async def acquire(self, key: str, priority: int = INTERACTIVE) -> float:
+        """等待放行，返回排队时间（秒）"""
+        started = time.monotonic()
+        await self.bucket(key).acquire(priority)
+        waited = time.monotonic() - started
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        if waited >= 0.5:
+            rpc_logger.debug("⏳ %s 限速排队 %.2f 秒", key, waited)
+        return waited
+    
+    def pause(self, seconds: float):
+        """服务器要求退避：在此期间不放行任何请求"""
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        for bucket in self.buckets.values():
+            bucket.reschedule()
+    
+    def stats(self) -> Dict[str, Any]:
+        waits = {}
+        for priority, (count, total, longest) in self._waits.items():
+            waits[self.PRIORITY_NAMES[priority]] = {
+                "requests": int(count),
+                "avg_wait_ms": round(total / count * 1000, 1) if count else 0.0,
+                "max_wait_ms": round(longest * 1000, 1)
+            }
+        return {
+            "queue_depth": sum(bucket.queued for bucket in self.buckets.values()),
+            "paused_seconds": round(max(self.paused_until - time.monotonic(), 0.0), 1),
+            "throttled": self.throttled,
+            "waits": waits,
+            "buckets": {
+                key: {"rate": bucket.rate, "queued": bucket.queued, "acquired": bucket.acquired}
+                for key, bucket in self.buckets.items()
+            }
+        }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+
+
+def supported_content_encodings() -> List[str]:
+    """aiohttp 能够自动解压的响应编码（br 需要安装 Brotli，zstd 需要较新的 aiohttp 和 zstd 库）"""
+    encodings = ["gzip", "deflate"]
+    if getattr(http_parser, "HAS_BROTLI", False):
+        encodings.append("br")
+    if getattr(http_parser, "HAS_ZSTD", False):
+        encodings.append("zstd")
+    return encodings
+
+
+@functools.lru_cache(maxsize=8)
+def accept_encoding_header(setting: str) -> str:
+    """
+    生成 Accept-Encoding 请求头：auto 表示声明所有可解压的编码，identity 表示不压缩；
+    也可以写成逗号分隔的列表，其中无法解压的编码会被忽略
+    """
+    supported = supported_content_encodings()
+    if setting == "auto":
+        return ", ".join(supported)
+    wanted = [token.strip() for token in setting.split(",") if token.strip()]
+    unsupported = [token for token in wanted if token not in supported and token != "identity"]
+    if unsupported:
+        rpc_logger.warning("⚠️ 当前环境无法解压 %s，不会在 Accept-Encoding 中声明", ", ".join(unsupported))
+    return ", ".join(token for token in wanted if token not in unsupported) or "identity"
+
+
+class MCPServerConnection:
+    """
+    单个 MCP 服务器连接：独立的连接池会话、请求编号、SSE 监听和滚动延迟/错误率统计
+    工具以 prefix__name 的形式注册到客户端的工具表中（prefix 为空时保持原名）
+    """
+    
+    def __init__(self, name: str, url: str, prefix: str = "", window: int = 50):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.prefix = prefix
+        self.session: Optional[aiohttp.ClientSession] = None
+        # 连接池配置变更后被替换、等待关闭的旧会话
+        self.retired_sessions: List[aiohttp.ClientSession] = []
+        self.sse_task: Optional[asyncio.Task] = None
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.tools: List[Dict[str, Any]] = []
+        self.server_info: Dict[str, Any] = {}
+        self.connected = False
+        self.request_id = 0
+        self.last_error: Optional[str] = None
+        self._samples: "deque[Tuple[float, bool]]" = deque(maxlen=window)
+        # 上游保护：限速与优先级调度（默认不限速，由客户端按配置设置）
+        self.limiter = RateLimiter()
+        # 服务器在响应的 Accept-Encoding 中声明可接受的请求体编码（RFC 7694）；返回 415 时停止压缩请求体
+        self.request_encodings: set = set()
+        self.request_compression_rejected = False
+        # 传输统计：压缩响应数、线上字节数（压缩后）、解压后字节数、请求体压缩节省的字节数
+        self.compressed_responses = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.request_bytes_saved = 0
+    
+    def public_name(self, tool_name: str) -> str:
+        """工具在客户端工具表中的名称"""
+        return f"{self.prefix}__{tool_name}" if self.prefix else tool_name
+    
+    def open_session(self, connection: ConnectionSettings):
+        """按连接池配置创建 HTTP 会话"""
+        connector = aiohttp.TCPConnector(limit=connection.pool_size, keepalive_timeout=connection.keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=connector)
+    
+    def replace_session(self, connection: ConnectionSettings):
+        """连接池参数变化时换用新会话；旧会话上的请求完成后再关闭"""
+        old_session = self.session
+        self.open_session(connection)
+        if old_session is not None:
+            self.retired_sessions.append(old_session)
+            asyncio.ensure_future(self._close_session_later(old_session, connection.timeout_seconds))
+    
+    @staticmethod
+    async def _close_session_later(session: aiohttp.ClientSession, delay: float):
+        """等待进行中的请求结束后关闭旧会话"""
+        await asyncio.sleep(delay)
+        if not session.closed:
+            await session.close()
+    
+    def _next_request_id(self) -> int:
+        """生成下一个请求ID"""
+        self.request_id += 1
+        return self.request_id
+    
+    @staticmethod
+    def _parse_sse_response(body: Union[str, bytes]) -> Optional[Dict[str, Any]]:
+        """解析SSE格式的响应；按字节处理，JSON 部分直接交给编解码器，不必先解码为字符串"""
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        try:
+            if data.startswith(b'event:'):
+                lines = data.strip().split(b'\n')
+                for line in lines:
+                    if line.startswith(b'data:'):
+                        return json_codec.loads(line[len(b'data:'):].strip())
+            elif data.startswith(b'data:'):
+                return json_codec.loads(data[len(b'data:'):].strip())
+            else:
+                return json_codec.loads(data)
+        except ValueError as e:
+            rpc_logger.error(f"⚠️ JSON解析失败: {e}")
+            return None
+    
+    def _should_compress_request(self, size: int, connection: ConnectionSettings) -> bool:
+        """请求体是否使用 gzip：auto 模式下仅当服务器声明接受 gzip 时压缩；服务器拒绝过则不再压缩"""
+        if connection.request_compression == "off" or self.request_compression_rejected:
+            return False
+        if size < connection.request_compression_min_bytes:
+            return False
+        return connection.request_compression == "gzip" or "gzip" in self.request_encodings
+    
+    def _record_transfer(self, response: aiohttp.ClientResponse, body: bytes):
+        """记录响应的线上字节数，并从 Accept-Encoding 响应头学习服务器接受的请求体编码"""
+        self.body_bytes += len(body)
+        if response.headers.get('Content-Encoding', 'identity') != 'identity' and response.content_length is not None:
+            self.compressed_responses += 1
+            self.wire_bytes += response.content_length
+        else:
+            self.wire_bytes += len(body)
+        accepted = response.headers.get('Accept-Encoding')
+        if accepted is not None:
+            self.request_encodings = {token.split(';')[0].strip().lower() for token in accepted.split(',')}
+    
+    async def request(self, method: str, params: Optional[Dict[str, Any]], connection: ConnectionSettings,
+                      min_attempt_seconds: float = 1.0,
+                      priority: int = RateLimiter.INTERACTIVE) -> Optional[Dict[str, Any]]:
+        """
+        发送标准MCP JSON-RPC 2.0请求（支持重试），并记录延迟与传输层错误
+        每次尝试前先经过限速调度；服务器返回 429/503 时按 Retry-After 暂停后续请求
+        """
+        if self.session is None:
+            raise RuntimeError(f"MCP 服务器 {self.name} 未连接")
+        
+        retry_attempts = connection.retry_attempts
+        # 限速按工具名（与客户端工具表中的名称一致），其他请求按方法名
+        if method == "tools/call" and params and params.get("name"):
+            limit_key = self.public_name(params["name"])
+        else:
+            limit_key = method
+        # 查询截止时间：单次超时不超过剩余时间，剩余时间不足时不再重试
+        deadline = current_deadline()
+        
+        mcp_url = f"{self.url}/mcp"
+        payload = {
+            "jsonrpc": "2.0",
+            "id": self._next_request_id(),
+            "method": method,
+            "params": params or {}
+        }
+        
+        # 请求体只编码一次，重试时复用
+        data = json_codec.dumps(payload)
+        compressed_data: Optional[bytes] = None
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json, text/event-stream',
+            'Accept-Encoding': accept_encoding_header(connection.accept_encoding),
+        }
+        
+        last_error = None
+        attempt = 0
+        # 415 后立即重发未压缩的请求，不占用重试次数
+        while attempt < retry_attempts:
+            if deadline is not None and deadline.remaining() < min_attempt_seconds:
+                rpc_logger.warning("⏰ 查询剩余时间不足，跳过请求: %s", method)
+                break
+            try:
+                # 排队时间同样计入查询截止时间
+                await asyncio.wait_for(
+                    self.limiter.acquire(limit_key, priority),
+                    deadline.remaining() - min_attempt_seconds if deadline is not None else None
+                )
+            except asyncio.TimeoutError:
+                rpc_logger.warning("⏰ 限速排队超过查询剩余时间，跳过请求: %s", method)
+                break
+            request_timeout = connection.timeout_seconds
+            if deadline is not None:
+                request_timeout = deadline.cap(request_timeout)
+            
+            compress = self._should_compress_request(len(data), connection)
+            if compress and compressed_data is None:
+                compressed_data = gzip.compress(data, compresslevel=5)
+            attempt_headers = dict(headers, **{'Content-Encoding': 'gzip'}) if compress else headers
+            
+            started = time.monotonic()
+            try:
+                async with self.session.post(
+                    mcp_url,
+                    data=compressed_data if compress else data,
+                    headers=attempt_headers,
+                    timeout=aiohttp.ClientTimeout(total=request_timeout)
+                ) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+                    self.record(time.monotonic() - started, True)
+                    self._record_transfer(response, body)
+                    if compress:
+                        self.request_bytes_saved += len(data) - len(compressed_data)
+                    self.last_error = None
+                    message = self._parse_sse_response(body)
+                    
+                    if message:
+                        if 'error' in message:
+                            error = message['error']
+                            rpc_logger.error(f"❌ MCP错误 [{self.name}]: {error.get('message', 'Unknown error')}")
+                            return None
+                        return message.get('result')
+                    return None
+            
+            except (aiohttp.ClientResponseError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if compress and isinstance(e, aiohttp.ClientResponseError) and e.status == 415:
+                    # 服务器不接受压缩的请求体：之后不再压缩，立即重发未压缩的请求（同一次尝试）
+                    self.request_compression_rejected = True
+                    rpc_logger.warning("⚠️ [%s] 服务器不接受压缩的请求体，改为不压缩", self.name)
+                    continue
+                self.record(time.monotonic() - started, False)
+                last_error = e
+                rpc_logger.warning("⚠️ 请求失败 [%s] (尝试 %d/%d): %s", self.name, attempt + 1, retry_attempts, e)
+                
+                wait_time = min(connection.retry_delay * (2 ** attempt), connection.max_retry_delay)
+                retry_after = 0.0
+                if isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503):
+                    # 服务器限流/过载：暂停该服务器的所有请求（包括排队中的其他请求）
+                    header = e.headers.get('Retry-After') if e.headers else None
+                    retry_after = parse_retry_after(header)
+                    if retry_after is None:
+                        retry_after = wait_time
+                    self.limiter.pause(retry_after)
+                    rpc_logger.warning("🚦 [%s] 服务器要求退避 %.1f 秒", self.name, retry_after)
+                
+                attempt += 1
+                if attempt < retry_attempts:
+                    if deadline is not None and deadline.remaining() < max(wait_time, retry_after) + min_attempt_seconds:
+                        rpc_logger.warning("⏰ 查询剩余时间不足，放弃重试: %s", method)
+                        break
+                    await asyncio.sleep(wait_time)
+                    continue
+        
+        self.last_error = str(last_error) if last_error else "deadline"
+        rpc_logger.error(f"❌ 请求最终失败 [{self.name}]: {last_error}")
+        return None
+    
+    def record(self, latency: float, ok: bool):
+        self._samples.append((latency, ok))
+    
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+    
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """成功请求延迟的分位数（秒），无样本时返回 None"""
+        latencies = sorted(latency for latency, ok in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "connected": self.connected,
+            "tools": len(self.tools),
+            "samples": len(self._samples),
+            "error_rate": round(self.error_rate(), 3),
+            "p50_latency": self.latency_percentile(0.5),
+            "p95_latency": self.latency_percentile(0.95),
+            "last_error": self.last_error,
+            "rate_limit": self.limiter.stats(),
+            "transfer": {
+                "compressed_responses": self.compressed_responses,
+                "wire_bytes": self.wire_bytes,
+                "body_bytes": self.body_bytes,
+                "request_bytes_saved": self.request_bytes_saved
+            }
+        }
+    
+    async def listen_sse(self, reconnect_interval: float):
+        """监听SSE事件流（断开后自动重连）"""
+        sse_url = f"{self.url}/sse"
+        while self.session is not None:
+            try:
+                rpc_logger.info("🔌 连接SSE事件流 [%s]...", self.name)
+                async with EventSource(sse_url, session=self.session) as event_source:
+                    async for event in event_source:
+                        if event.data and event.data.strip():
+                            rpc_logger.debug("收到SSE事件 [%s]: %.100s", self.name, event.data)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                rpc_logger.warning(f"⚠️ SSE连接断开 [{self.name}]: {e}，{reconnect_interval}秒后重连...")
+                await asyncio.sleep(reconnect_interval)
+    
+    async def close(self):
+        """停止后台任务并关闭会话"""
+        self.connected = False
+        for task in (self.heartbeat_task, self.sse_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.heartbeat_task = None
+        self.sse_task = None
+        
+        for session in self.retired_sessions:
+            if not session.closed:
+                await session.close()
+        self.retired_sessions = []
+        
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+class TrafficCassette:
+    """
+    流量录制/回放：录制模式下记录 MCP 与 LLM 的请求、响应和耗时；
+    回放模式下按请求内容匹配录制的响应（匹配不到时按录制顺序取下一条），可按录制耗时或零延迟返回
+    请求键和录制文件都使用标准库 json 而不是 json_codec：请求键是序列化结果的哈希，json_codec 的输出
+    随安装的可选库变化（如 orjson 的分隔符不带空格），换一台机器回放时会全部匹配不上；
+    录制文件只在退出时写一次、回放时读一次，编解码速度无关紧要，统一用标准库即可
+    """
+    
+    def __init__(self, path: str, mode: str = "record", replay_latency: str = "recorded"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"未知的录制模式: {mode}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.conversation: List[str] = []
+        self.interactions: List[Dict[str, Any]] = []
+        self._used: set = set()
+        self.misses = 0
+        
+        if mode == "replay":
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.conversation = data.get('conversation', [])
+            self.interactions = data.get('interactions', [])
+    
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    
+    @staticmethod
+    def _to_jsonable(value: Any) -> Any:
+        """把 SDK 对象（如 ChatCompletionMessage）转换为可序列化的结构"""
+        if hasattr(value, 'model_dump'):
+            return value.model_dump(exclude_none=True)
+        if isinstance(value, dict):
+            return {k: TrafficCassette._to_jsonable(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [TrafficCassette._to_jsonable(v) for v in value]
+        return value
+    
+    @classmethod
+    def request_key(cls, kind: str, request: Dict[str, Any]) -> str:
+        payload = json.dumps(cls._to_jsonable(request), ensure_ascii=False, sort_keys=True, default=str)
+        return f"{kind}:{hashlib.sha1(payload.encode('utf-8')).hexdigest()}"
+    
+    def record(self, kind: str, request: Dict[str, Any], response: Any, elapsed: float):
+        """记录一次交互"""
+        self.interactions.append({
+            "kind": kind,
+            "key": self.request_key(kind, request),
+            "request": self._to_jsonable(request),
+            "response": self._to_jsonable(response),
+            "elapsed": round(elapsed, 6)
+        })
+    
+    def _match(self, kind: str, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        key = self.request_key(kind, request)
+        fallback = None
+        for index, entry in enumerate(self.interactions):
+            if index in self._used or entry['kind'] != kind:
+                continue
+            if entry['key'] == key:
+                self._used.add(index)
+                return entry
+            if fallback is None:
+                fallback = index
+        if fallback is not None:
+            # 请求内容有差异（如系统提示中的历史记录不同）：按录制顺序回放
+            self.misses += 1
+            self._used.add(fallback)
+            return self.interactions[fallback]
+        return None
+    
+    async def replay(self, kind: str, request: Dict[str, Any]) -> Any:
+        """回放一次交互的响应；没有可用录制时抛出 LookupError"""
+        entry = self._match(kind, request)
+        if entry is None:
+            raise LookupError(f"回放数据中没有可用的 {kind} 响应")
+        if self.replay_latency == "recorded" and entry.get('elapsed'):
+            await asyncio.sleep(entry['elapsed'])
+        return entry['response']
+    
+    def save(self):
+        """保存录制结果（原子写入）"""
+        if self.mode != "record":
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.path, json.dumps({
+            "version": 1,
+            "recorded_at": datetime.now().isoformat(),
+            "conversation": self.conversation,
+            "interactions": self.interactions
+        }, ensure_ascii=False))
+
+
+class HistoryArchive:
+    """
+    压缩的历史会话归档：每批移出历史文件的会话写成一个 JSON Lines 分段（每行一个会话），
+    按文件名中的时间排序；读取时流式解压逐行解析，不需要把整个分段读入内存
+    """
+    
+    # 压缩格式 -> (文件后缀, 打开函数)；打开函数接受文件对象，读写都是流式的
+    FORMATS = {
+        "gzip": (".gz", lambda f, mode: gzip.GzipFile(fileobj=f, mode=mode, compresslevel=6)),
+        "bz2": (".bz2", lambda f, mode: bz2.BZ2File(f, mode)),
+        "xz": (".xz", lambda f, mode: lzma.LZMAFile(f, mode))
+    }
+    
+    def __init__(self, directory: str, compression: str = "gzip"):
+        self.directory = Path(directory)
+        self.compression = compression
+    
+    def segments(self) -> List[Path]:
+        """所有分段（按时间从旧到新），包括以其他压缩格式写入的旧分段"""
+        if not self.directory.exists():
+            return []
+        suffixes = {suffix for suffix, _ in self.FORMATS.values()}
+        return sorted(path for path in self.directory.glob("history-*.jsonl.*") if path.suffix in suffixes)
+    
+    def append(self, sessions: List[Dict[str, Any]]) -> Path:
+        """把一批会话写成新分段：先写临时文件并 fsync，再 rename，崩溃时不会留下半个分段"""
+        suffix, opener = self.FORMATS[self.compression]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        target = self.directory / f"history-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl{suffix}"
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{target.name}.", suffix=".tmp", dir=str(self.directory))
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with opener(raw, 'wb') as f:
+                    for session in sessions:
+                        f.write(json_codec.dumps(session) + b"\n")
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, str(target))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return target
+    
+    def iter_sessions(self):
+        """按时间顺序逐个产出归档的会话（流式解压）；损坏的行或分段会被跳过"""
+        openers = {suffix: opener for suffix, opener in self.FORMATS.values()}
+        for path in self.segments():
+            try:
+                with open(path, 'rb') as raw, openers[path.suffix](raw, 'rb') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            yield json_codec.loads(line)
+                        except ValueError:
+                            memory_logger.warning(f"⚠️ 跳过归档中无法解析的会话: {path.name}")
+            except (OSError, EOFError, lzma.LZMAError, zlib.error) as e:
+                memory_logger.error(f"读取历史归档失败 {path.name}: {e}")
+
 
-# ===== Python 3.7/3.8 兼容性函数 =====
-async def async_input(prompt: str) -> str:
+class MessageLog:
     """
-    异步输入函数，兼容Python 3.7+
-    在Python 3.9+中使用asyncio.to_thread，在旧版本中使用run_in_executor
+    紧凑的消息存储：按列保存角色、正文和时间戳，而不是每条消息一个字典
+    角色保存为 1 字节编号（对应驻留的角色字符串），时间戳保存为浮点秒；
+    发送给 LLM 的消息列表按需生成并缓存，追加消息后失效
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, input, prompt)
-
-
-class StationCodeMapper:
-    """车站代码映射器：提供城市到车站代码的 fallback 映射"""
     
-    # 常见城市代码映射表
-    CITY_CODES = {
-        "北京": "BJP", "上海": "SHH", "广州": "GZQ", "深圳": "SZQ",
-        "杭州": "HZH", "南京": "NJH", "成都": "CDW", "武汉": "WHN",
-        "西安": "XAY", "郑州": "ZZF", "重庆": "CQW", "天津": "TJP",
-        "长沙": "CSQ", "沈阳": "SYT", "哈尔滨": "HBB", "大连": "DLT",
-        "青岛": "QDK", "济南": "JNK", "福州": "FZS", "厦门": "XMS",
-        "昆明": "KMM", "贵阳": "GIW", "兰州": "LZJ", "太原": "TYV",
-        "石家庄": "SJP", "合肥": "HFH", "南昌": "NCG", "长春": "CCT",
-        "乌鲁木齐": "URQ", "拉萨": "LSA", "呼和浩特": "HHC", "银川": "YIJ",
-        "西宁": "XNO", "海口": "VUQ", "三亚": "SEQ", "苏州": "SZH",
-        "无锡": "WXH", "常州": "CZH", "南通": "NTH", "宁波": "NVH",
-        "温州": "RZH", "金华": "JHH", "珠海": "ZHQ", "汕头": "STQ",
-        "佛山": "FSQ", "东莞": "DMQ", "中山": "ZSQ"
-    }
+    # 角色编号 -> 角色字符串（sys.intern 后全局只有一份）；遇到新角色时追加
+    ROLES: List[str] = [sys.intern(role) for role in ("system", "user", "assistant", "tool")]
+    _ROLE_CODES: Dict[str, int] = {role: code for code, role in enumerate(ROLES)}
     
-    # 城市别名
-    CITY_ALIASES = {
-        "京": "北京", "沪": "上海", "穗": "广州", "深": "深圳",
-        "蓉": "成都", "汉": "武汉", "杭": "杭州", "宁": "南京",
-        "渝": "重庆", "津": "天津"
-    }
+    __slots__ = ("_roles", "_contents", "_times", "_view")
     
-    def __init__(self, custom_mapping_file: Optional[str] = None):
-        self.mapping = self.CITY_CODES.copy()
-        self.aliases = self.CITY_ALIASES.copy()
-        
-        # 加载自定义映射（如果存在）
-        if custom_mapping_file and Path(custom_mapping_file).exists():
-            try:
-                with open(custom_mapping_file, 'r', encoding='utf-8') as f:
-                    custom_data = json.load(f)
-                    if 'station_codes' in custom_data:
-                        self.mapping.update(custom_data['station_codes'])
-                    if 'city_aliases' in custom_data:
-                        self.aliases.update(custom_data['city_aliases'])
-                logging.info(f"✅ 已加载自定义城市代码映射: {custom_mapping_file}")
-            except Exception as e:
-                logging.warning(f"⚠️ 加载自定义映射失败: {e}")
+    def __init__(self):
+        self._roles = array('B')
+        self._contents: List[str] = []
+        self._times = array('d')
+        # (消息数, 窗口大小, LLM 格式的消息列表)
+        self._view: Optional[Tuple[int, int, List[Dict[str, str]]]] = None
     
-    def get_code(self, city_name: str) -> Optional[str]:
-        """获取城市代码"""
-        # 处理别名
-        city = self.aliases.get(city_name, city_name)
-        # 返回代码
-        return self.mapping.get(city)
+    @classmethod
+    def role_code(cls, role: str) -> int:
+        code = cls._ROLE_CODES.get(role)
+        if code is None:
+            code = len(cls.ROLES)
+            cls.ROLES.append(sys.intern(role))
+            cls._ROLE_CODES[cls.ROLES[code]] = code
+        return code
     
-    def get_available_cities(self) -> List[str]:
-        """获取所有支持的城市列表"""
-        return list(self.mapping.keys())
+    def append(self, role: str, content: str, created: Optional[float] = None):
+        self._roles.append(self.role_code(role))
+        self._contents.append(content)
+        self._times.append(time.time() if created is None else created)
+        self._view = None
     
-    def search_city(self, keyword: str) -> List[str]:
-        """搜索包含关键字的城市"""
-        return [city for city in self.mapping.keys() if keyword in city]
-
-
-class ConfigManager:
-    """配置管理器：支持JSON配置文件和环境变量"""
+    def __len__(self) -> int:
+        return len(self._contents)
     
-    def __init__(self, config_path: str = "config.json"):
-        self.config_path = config_path
-        self.config = self._load_config()
-        
-    def _load_config(self) -> Dict[str, Any]:
-        """加载配置文件"""
-        if not Path(self.config_path).exists():
-            logging.warning(f"配置文件 {self.config_path} 不存在，使用默认配置")
-            return self._get_default_config()
-        
-        try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"加载配置文件失败: {e}，使用默认配置")
-            return self._get_default_config()
+    def role(self, index: int) -> str:
+        return self.ROLES[self._roles[index]]
     
-    def _get_default_config(self) -> Dict[str, Any]:
-        """默认配置"""
-        return {
-            "mcp_server": {
-                "url": "http://localhost:12306",
-                "connection": {
-                    "retry_attempts": 3,
-                    "retry_delay": 1.0,
-                    "max_retry_delay": 30.0,
-                    "timeout_seconds": 30,
-                    "sse_reconnect_enabled": True,
-                    "heartbeat_interval": 60
-                }
-            },
-            "llm": {
-                "provider": "deepseek",
-                "model": "deepseek-chat",
-                "max_iterations": 5
-            },
-            "memory": {
-                "session_enabled": True,
-                "max_context_messages": 20
-            },
-            "logging": {
-                "level": "INFO"
-            }
-        }
+    def content(self, index: int) -> str:
+        return self._contents[index]
     
-    def get(self, path: str, default: Any = None) -> Any:
-        """获取配置项，支持点分路径，如 'mcp_server.url'"""
-        keys = path.split('.')
-        value = self.config
-        for key in keys:
-            if isinstance(value, dict) and key in value:
-                value = value[key]
-            else:
-                return default
-        return value
+    def created(self, index: int) -> float:
+        return self._times[index]
+    
+    def contents(self, role: str):
+        """按顺序产出指定角色的消息正文"""
+        code = self._ROLE_CODES.get(role)
+        return (content for r, content in zip(self._roles, self._contents) if r == code)
+    
+    def llm_messages(self, start: int = 0, end: Optional[int] = None) -> List[Dict[str, str]]:
+        """把 [start, end) 区间的消息转换为 LLM 格式（每次返回新的字典）"""
+        roles = self.ROLES
+        return [{"role": roles[r], "content": c} for r, c in zip(self._roles[start:end], self._contents[start:end])]
+    
+    def llm_view(self, limit: int) -> List[Dict[str, str]]:
+        """最近 limit 条消息的 LLM 格式视图；消息未变化时直接返回缓存的列表，调用方不应修改它"""
+        view = self._view
+        if view is None or view[0] != len(self._contents) or view[1] != limit:
+            view = (len(self._contents), limit, self.llm_messages(max(0, len(self._contents) - limit)))
+            self._view = view
+        return view[2]
+    
+    def to_records(self) -> List[Dict[str, str]]:
+        """转换为历史文件中的格式（ISO 时间戳），与旧版本保存的文件兼容"""
+        roles = self.ROLES
+        return [
+            {"role": roles[r], "content": c, "timestamp": datetime.fromtimestamp(t).isoformat()}
+            for r, c, t in zip(self._roles, self._contents, self._times)
+        ]
+    
+    @classmethod
+    def from_records(cls, records: List[Dict[str, Any]]) -> "MessageLog":
+        """从历史文件格式加载；缺失或无法解析的时间戳记为 0"""
+        log = cls()
+        for record in records:
+            try:
+                created = datetime.fromisoformat(record["timestamp"]).timestamp()
+            except (KeyError, TypeError, ValueError):
+                created = 0.0
+            log.append(record.get("role", "user"), record.get("content") or "", created)
+        return log
 
 
-class UserProfileManager:
-    """用户配置管理器：管理用户偏好和记忆"""
+class SessionIndex:
+    """
+    历史会话的 BM25 倒排索引：中文按字二元组（单字词保留单字）、字母数字按词切分，
+    每个会话（用户问题和摘要）为一个文档；会话结束时增量加入，检索时只累加查询词的倒排表
+    （安装 NumPy 时向量化计算），几万个会话也只需几毫秒
+    """
     
-    def __init__(self, profile_path: str = "user_profile.json"):
-        self.profile_path = profile_path
-        self.profile = self._load_profile()
+    _TOKEN = re.compile(r'[\u4e00-\u9fff]+|[A-Za-z0-9]+')
     
-    def _load_profile(self) -> Dict[str, Any]:
-        """加载用户配置"""
-        if not Path(self.profile_path).exists():
-            return self._create_default_profile()
-        
-        try:
-            with open(self.profile_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"加载用户配置失败: {e}")
-            return self._create_default_profile()
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # 词 -> (文档号数组, 词频数组)：按文档号递增，每个文档最多一项
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._lengths = array('I')
+        self._total_length = 0
+        # 文档号 -> 注入提示词的片段；会话 ID -> 文档号（生成摘要后替换片段）
+        self.snippets: List[str] = []
+        self._doc_ids: Dict[str, int] = {}
     
-    def _create_default_profile(self) -> Dict[str, Any]:
-        """创建默认用户配置"""
-        profile = {
-            "user_id": "default_user",
-            "created_at": datetime.now().isoformat(),
-            "preferences": {},
-            "aliases": {},
-            "travel_history": {"frequent_routes": []},
-            "metadata": {"total_queries": 0}
-        }
-        self.save()
-        return profile
+    def __len__(self) -> int:
+        return len(self.snippets)
     
-    def save(self):
-        """保存用户配置"""
-        try:
-            with open(self.profile_path, 'w', encoding='utf-8') as f:
-                json.dump(self.profile, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"保存用户配置失败: {e}")
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        tokens = []
+        for run in cls._TOKEN.findall(text):
+            if run.isascii():
+                tokens.append(run.lower())
+            elif len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        return tokens
     
-    def get_user_context(self) -> str:
-        """获取用户上下文信息，用于增强系统提示"""
-        prefs = self.profile.get('preferences', {})
-        aliases = self.profile.get('aliases', {})
-        
-        context_parts = []
-        
-        if prefs.get('default_departure_city'):
-            context_parts.append(f"- 常用出发地: {prefs['default_departure_city']}")
-        
-        if prefs.get('default_arrival_city'):
-            context_parts.append(f"- 常用目的地: {prefs['default_arrival_city']}")
-        
-        if prefs.get('preferred_seat_type'):
-            context_parts.append(f"- 偏好席别: {prefs['preferred_seat_type']}")
-        
-        if aliases:
-            alias_strs = [f"'{k}' = '{v}'" for k, v in aliases.items() if v]
-            if alias_strs:
-                context_parts.append(f"- 地点别名: {', '.join(alias_strs)}")
-        
-        if context_parts:
-            return "\n# 用户偏好\n" + "\n".join(context_parts) + "\n"
-        return ""
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """粗略估算 token 数：汉字约 0.6 个，其他字符约 0.3 个"""
+        cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+        return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
     
-    def update_query_stats(self):
-        """更新查询统计"""
-        if 'metadata' not in self.profile:
-            self.profile['metadata'] = {}
-        self.profile['metadata']['total_queries'] = self.profile['metadata'].get('total_queries', 0) + 1
-        self.profile['metadata']['last_active'] = datetime.now().isoformat()
+    def add(self, session_id: str, text: str, snippet: str):
+        """加入一个会话；同一会话 ID 重复加入时只更新片段"""
+        if session_id in self._doc_ids:
+            self.snippets[self._doc_ids[session_id]] = snippet
+            return
+        doc = len(self.snippets)
+        tokens = self.tokenize(text)
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = (array('I'), array('H'))
+            postings[0].append(doc)
+            postings[1].append(min(count, 65535))
+        self._lengths.append(len(tokens))
+        self._total_length += len(tokens)
+        self.snippets.append(snippet)
+        self._doc_ids[session_id] = doc
+    
+    def set_snippet(self, session_id: str, snippet: str):
+        doc = self._doc_ids.get(session_id)
+        if doc is not None:
+            self.snippets[doc] = snippet
+    
+    def search(self, query: str, limit: int = 5) -> List[Tuple[float, int]]:
+        """BM25 得分最高的 limit 个文档：[(得分, 文档号)]，得分相同时较新的会话在前"""
+        terms = [term for term in set(self.tokenize(query)) if term in self._postings]
+        count = len(self.snippets)
+        if not terms or not count:
+            return []
+        avg_length = self._total_length / count or 1.0
+        k1, b = self.k1, self.b
+        if np is not None:
+            # np.array 复制数据，不持有 array 的缓冲区（否则之后无法追加）
+            norm = k1 * (1 - b + b * np.array(self._lengths, dtype=np.float64) / avg_length)
+            scores = np.zeros(count)
+            for term in terms:
+                docs, freqs = self._postings[term]
+                docs = np.array(docs, dtype=np.intp)
+                freqs = np.array(freqs, dtype=np.float64)
+                idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                scores[docs] += idf * freqs * (k1 + 1) / (freqs + norm[docs])
+            matched = np.flatnonzero(scores)
+            if len(matched) > limit:
+                matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+            return sorted(((float(scores[doc]), int(doc)) for doc in matched), reverse=True)
+        scores_by_doc: Dict[int, float] = {}
+        for term in terms:
+            docs, freqs = self._postings[term]
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, freq in zip(docs, freqs):
+                norm = k1 * (1 - b + b * self._lengths[doc] / avg_length)
+                scores_by_doc[doc] = scores_by_doc.get(doc, 0.0) + idf * freq * (k1 + 1) / (freq + norm)
+        return heapq.nlargest(limit, ((score, doc) for doc, score in scores_by_doc.items()))
 
 
 class ConversationMemory:
-    """会话记忆管理器：管理对话历史"""
+    """
+    会话记忆管理器：管理对话历史
+    超出窗口的旧消息和已结束的会话由后台任务压缩为滚动摘要，提示词中用摘要代替原始消息
+    当前会话和历史会话的消息都用 MessageLog 紧凑存储，只在保存和归档时转换为字典
+    事件循环中的历史变化防抖后在线程池中保存（归档压缩和写入历史文件都不占用事件循环）
+    """
     
-    def __init__(self, history_path: str = "conversation_history.json", max_messages: int = 20):
+    def __init__(self, history_path: str = "conversation_history.json", max_messages: int = 20,
+                 summary_max_chars: int = 400, max_sessions: int = 50,
+                 archive: Optional[HistoryArchive] = None, archive_batch: int = 20,
+                 save_debounce: float = 2.0):
         self.history_path = history_path
+        self.save_debounce = save_debounce
         self.max_messages = max_messages
-        self.current_session: List[Dict[str, Any]] = []
+        self.summary_max_chars = summary_max_chars
+        # 历史文件保留最近 max_sessions 个会话；启用归档时，超出 archive_batch 个后把更早的会话整批压缩归档
+        self.max_sessions = max_sessions
+        self.archive = archive
+        self.archive_batch = archive_batch
+        self.current_session = MessageLog()
+        # 当前会话的滚动摘要，以及已并入摘要的消息数
+        self.session_summary = ""
+        self._summarized_count = 0
+        # 历史记录变化时递增，用于缓存 get_recent_context 的结果
+        self._history_version = 0
+        self._recent_context_cache: Optional[Tuple[int, int, str]] = None
+        # 已保存到历史文件的版本；保存可能在线程池中进行，_save_lock 保证同一时间只有一次归档和写入
+        self._saved_version = 0
+        self._save_lock = threading.Lock()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
         self.history = self._load_history()
+        # 历史会话（含归档）的检索索引，首次检索时建立，之后随 clear_session 增量更新；
+        # 索引可能在线程池中建立，_index_lock 保护"向历史追加会话"与"建成后发布索引"两个步骤
+        self.index: Optional[SessionIndex] = None
+        self._index_lock = threading.Lock()
+        self._index_building = False
     
     def _load_history(self) -> List[Dict[str, Any]]:
         """加载历史对话"""
@@ -233,65 +3656,319 @@ class ConversationMemory:
             return []
         
         try:
-            with open(self.history_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            history = json_codec.loads(Path(self.history_path).read_bytes())
+            for session in history:
+                session["messages"] = MessageLog.from_records(session.get("messages") or [])
+            return history
         except Exception as e:
-            logging.error(f"加载对话历史失败: {e}")
+            memory_logger.error(f"加载对话历史失败: {e}")
             return []
     
+    @staticmethod
+    def _session_record(session: Dict[str, Any]) -> Dict[str, Any]:
+        """会话的文件格式：消息转换为字典列表"""
+        record = dict(session)
+        record["messages"] = session["messages"].to_records()
+        return record
+    
+    def _archive_overflow(self):
+        """把超出保留数量的旧会话写入压缩归档并移出内存；写入失败时保留在历史中，下次再试"""
+        overflow = len(self.history) - self.max_sessions
+        if self.archive is None or overflow <= self.archive_batch:
+            return
+        try:
+            segment = self.archive.append([self._session_record(session) for session in self.history[:overflow]])
+        except Exception as e:
+            memory_logger.error(f"归档历史会话失败: {e}")
+            return
+        with self._index_lock:
+            del self.history[:overflow]
+        memory_logger.info(f"🗜️ 已归档 {overflow} 个历史会话: {segment.name}")
+    
+    def iter_archived_sessions(self):
+        """按时间顺序遍历已归档的会话（流式解压，未启用归档时为空）"""
+        if self.archive is None:
+            return iter(())
+        return self.archive.iter_sessions()
+    
+    def _write_history(self, version: int):
+        """归档溢出的会话并写入历史文件（可在线程池中执行）；加锁并比较版本，已保存的版本不再重复写入"""
+        with self._save_lock:
+            if version <= self._saved_version:
+                return
+            self._archive_overflow()
+            # 只保存最近的会话（启用归档时，尚未凑满一批的会话也保留在历史文件中）
+            keep = self.max_sessions + (self.archive_batch if self.archive is not None else 0)
+            recent_history = self.history[-keep:] if len(self.history) > keep else self.history
+            records = [self._session_record(session) for session in recent_history]
+            atomic_write_text(self.history_path, json_codec.dumps(records, indent=True))
+            self._saved_version = version
+    
     def save_history(self):
-        """保存对话历史"""
+        """同步保存对话历史（取消等待中的防抖保存）"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        try:
+            self._write_history(self._history_version)
+        except Exception as e:
+            memory_logger.error(f"保存对话历史失败: {e}")
+    
+    def _schedule_save(self):
+        """历史变化后安排保存：事件循环中在防抖窗口结束后于线程池保存，没有运行中的事件循环时直接保存"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_history()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.save_debounce, self._start_flush)
+    
+    def _start_flush(self):
+        """防抖计时器回调：启动后台保存任务"""
+        self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            # 上一次保存尚未完成，完成后会自行检查是否需要再次保存
+            return
+        self._flush_task = asyncio.ensure_future(self.flush())
+    
+    async def flush(self):
+        """在线程池中归档并保存历史，期间有新的变化时再安排一次保存"""
+        version = self._history_version
+        if version <= self._saved_version:
+            return
         try:
-            # 只保存最近的会话
-            recent_history = self.history[-50:] if len(self.history) > 50 else self.history
-            with open(self.history_path, 'w', encoding='utf-8') as f:
-                json.dump(recent_history, f, ensure_ascii=False, indent=2)
+            await asyncio.get_event_loop().run_in_executor(None, self._write_history, version)
         except Exception as e:
-            logging.error(f"保存对话历史失败: {e}")
+            memory_logger.error(f"保存对话历史失败: {e}")
+            return
+        if self._history_version > self._saved_version:
+            self._schedule_save()
+    
+    async def close(self):
+        """取消防抖计时器，等待进行中的保存，并把剩余变化落盘"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
     
     def add_message(self, role: str, content: str):
         """添加消息到当前会话"""
-        message = {"role": role, "content": content, "timestamp": datetime.now().isoformat()}
-        self.current_session.append(message)
+        self.current_session.append(role, content)
     
     def get_current_session(self, include_system: bool = True) -> List[Dict[str, str]]:
-        """获取当前会话（用于LLM调用）"""
-        # 截断过长的会话，保留最新的消息
-        messages = self.current_session[-self.max_messages:] if len(self.current_session) > self.max_messages else self.current_session
-        
-        # 转换为LLM格式（移除timestamp）
-        return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+        """获取当前会话（用于LLM调用，只读）；消息未变化时复用缓存的视图"""
+        # 截断过长的会话，保留最新的消息（更早的消息由滚动摘要代替）
+        return self.current_session.llm_view(self.max_messages)
+    
+    def get_session_summary(self) -> str:
+        """获取当前会话早前内容的摘要（用于系统提示）"""
+        if not self.session_summary:
+            return ""
+        return "\n# 本次会话早前内容摘要\n" + self.session_summary + "\n"
     
     def clear_session(self):
         """清除当前会话"""
         if self.current_session:
-            # 保存到历史记录
-            self.history.append({
+            # 保存到历史记录；已有的滚动摘要作为会话摘要的起点，后台压缩时只需处理剩余消息
+            entry = {
                 "session_id": datetime.now().isoformat(),
-                "messages": self.current_session.copy()
-            })
-            self.save_history()
-        self.current_session = []
+                "messages": self.current_session
+            }
+            if self.session_summary:
+                entry["summary_base"] = self.session_summary
+                entry["summarized_count"] = self._summarized_count
+            with self._index_lock:
+                self.history.append(entry)
+                if self.index is not None:
+                    self._index_session(entry, self.index)
+            self._history_version += 1
+            self._schedule_save()
+        self.current_session = MessageLog()
+        self.session_summary = ""
+        self._summarized_count = 0
+    
+    def _pending_session_range(self) -> Tuple[int, int]:
+        """当前会话中已移出窗口、尚未并入摘要的消息区间"""
+        return self._summarized_count, len(self.current_session) - self.max_messages
+    
+    def _unsummarized_sessions(self, count: int) -> List[Dict[str, Any]]:
+        """
+        最近 count 个会话中还没有压缩的会话（更早的会话不会注入提示词，无需压缩）
+        以 summarized 标记判断而不是摘要是否为空：没有实际内容的会话摘要为空，不应被反复选中
+        """
+        if count <= 0:
+            return []
+        return [s for s in self.history[-count:]
+                if not (s.get("summarized") or s.get("summary")) and s.get("messages")]
+    
+    def needs_compaction(self, recent_count: int) -> bool:
+        start, end = self._pending_session_range()
+        return end > start or bool(self._unsummarized_sessions(recent_count))
+    
+    async def compact(self, summarize: Callable[[str, List[Dict[str, Any]]], Awaitable[str]], recent_count: int):
+        """
+        执行一次压缩：把移出窗口的旧消息并入当前会话的滚动摘要，并为最近的历史会话生成摘要
+        summarize(已有摘要, 新消息) 返回新的摘要；压缩期间会话可能被清除或继续增长，提交前需核对
+        """
+        start, end = self._pending_session_range()
+        if end > start:
+            session = self.current_session
+            summary = await summarize(self.session_summary, session.llm_messages(start, end))
+            if self.current_session is session and self._summarized_count == start:
+                self.session_summary = summary
+                self._summarized_count = end
+                memory_logger.debug(f"当前会话已压缩 {end} 条消息")
+        
+        sessions = self._unsummarized_sessions(recent_count)
+        for session in sessions:
+            base = session.get("summary_base", "")
+            messages = session["messages"].llm_messages(session.get("summarized_count", 0))
+            session["summary"] = await summarize(base, messages) if messages else base
+            session["summarized"] = True
+            if self.index is not None and session["summary"]:
+                self.index.set_snippet(session.get("session_id", ""), session["summary"])
+            session.pop("summary_base", None)
+            session.pop("summarized_count", None)
+        if sessions:
+            self._history_version += 1
+            self._schedule_save()
+            memory_logger.debug(f"已为 {len(sessions)} 个历史会话生成摘要")
+    
+    @staticmethod
+    def extractive_summary(previous: str, messages: List[Dict[str, Any]], max_chars: int = 400) -> str:
+        """抽取式摘要：保留每个问题和回复的首行，超出长度时丢弃最早的内容"""
+        lines = previous.splitlines() if previous else []
+        for msg in messages:
+            text = next((line.strip() for line in msg.get("content", "").splitlines() if line.strip()), "")
+            if not text:
+                continue
+            if msg.get("role") == "user":
+                lines.append(f"用户问: {text[:60]}")
+            elif msg.get("role") == "assistant":
+                lines.append(f"回复: {text[:80]}")
+        while len(lines) > 1 and sum(len(line) + 1 for line in lines) > max_chars:
+            lines.pop(0)
+        return "\n".join(lines)[:max_chars]
+    
+    @staticmethod
+    def _index_session(session: Dict[str, Any], index: SessionIndex):
+        """把一个会话加入索引：检索文本为用户问题和摘要，片段优先使用摘要，否则为最近的几个问题"""
+        messages = session.get("messages") or []
+        if isinstance(messages, MessageLog):
+            questions = list(messages.contents("user"))
+        else:
+            questions = [m.get("content") or "" for m in messages if m.get("role") == "user"]
+        summary = session.get("summary") or session.get("summary_base") or ""
+        if not questions and not summary:
+            return
+        snippet = summary or "用户曾问: " + "；".join(q[:100] for q in questions[-3:])
+        session_id = session.get("session_id") or f"session-{len(index)}"
+        index.add(session_id, "\n".join(questions) + "\n" + summary, snippet)
+    
+    def build_index(self) -> Optional[SessionIndex]:
+        """
+        建立（或返回已有的）检索索引：先按时间顺序加入归档的会话，再加入历史中的会话；可在线程池中调用
+        索引在局部变量中建成，补入建立期间新增的会话和摘要后才发布；其他线程正在建立时返回 None
+        """
+        with self._index_lock:
+            if self.index is not None or self._index_building:
+                return self.index
+            self._index_building = True
+        try:
+            started = time.perf_counter()
+            index = SessionIndex()
+            history = list(self.history)
+            # 会话可能在建立期间被移入归档，同一会话 ID 重复加入时只更新片段
+            for session in self.iter_archived_sessions():
+                self._index_session(session, index)
+            for session in history:
+                self._index_session(session, index)
+            with self._index_lock:
+                indexed = {id(session) for session in history}
+                for session in self.history:
+                    if id(session) not in indexed:
+                        self._index_session(session, index)
+                    elif session.get("summary"):
+                        index.set_snippet(session.get("session_id", ""), session["summary"])
+                self.index = index
+            memory_logger.info(f"🔎 已索引 {len(index)} 个历史会话，用时 {(time.perf_counter() - started) * 1000:.0f}ms")
+            return index
+        finally:
+            self._index_building = False
+    
+    def _schedule_index_build(self):
+        """在线程池中建立检索索引；没有运行中的事件循环时不建立，由调用方显式调用 build_index"""
+        if self._index_building:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        
+        def on_done(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is not None:
+                memory_logger.error(f"❌ 建立历史会话索引失败: {future.exception()}")
+        
+        loop.run_in_executor(None, self.build_index).add_done_callback(on_done)
+    
+    def get_relevant_context(self, query: str, max_tokens: int = 300, limit: int = 5,
+                             min_score_ratio: float = 0.5) -> str:
+        """
+        按与当前问题的相关度（BM25）检索历史会话，在 token 预算内注入最相关的片段；
+        得分低于最高分 min_score_ratio 倍的弱匹配不注入，内容重复的片段只保留一个
+        """
+        if not query or max_tokens <= 0 or (not self.history and self.archive is None):
+            return ""
+        index = self.index
+        if index is None:
+            # 索引尚未建立（或正在后台建立）：在线程池中建立，本次不注入，不在事件循环中扫描归档
+            self._schedule_index_build()
+            return ""
+        parts: List[str] = []
+        used = 0
+        hits = index.search(query, limit * 2)
+        for score, doc in hits:
+            if score < hits[0][0] * min_score_ratio:
+                break
+            snippet = index.snippets[doc]
+            cost = index.estimate_tokens(snippet)
+            if snippet in parts or used + cost > max_tokens:
+                continue
+            parts.append(snippet)
+            used += cost
+            if len(parts) >= limit:
+                break
+        if not parts:
+            return ""
+        return "\n# 相关的历史对话\n" + "\n".join(parts) + "\n"
     
     def get_recent_context(self, count: int = 3) -> str:
-        """获取最近的对话上下文摘要"""
+        """获取最近的对话上下文摘要（已压缩的会话使用摘要，否则退回到原始问题）"""
         if not self.history or count <= 0:
             return ""
         
+        if self._recent_context_cache is not None and self._recent_context_cache[:2] == (self._history_version, count):
+            return self._recent_context_cache[2]
+        
         recent_sessions = self.history[-count:]
         context_parts = []
         
         for session in recent_sessions:
-            messages = session.get('messages', [])
-            # 只提取用户问题和助手回复的摘要
-            for msg in messages:
-                if msg['role'] == 'user':
-                    content = msg['content'][:100]  # 截断
-                    context_parts.append(f"用户曾问: {content}")
+            if session.get('summary'):
+                context_parts.append(session['summary'])
+                continue
+            # 只提取用户问题的摘要
+            for content in session['messages'].contents('user'):
+                context_parts.append(f"用户曾问: {content[:100]}")  # 截断
         
+        context = ""
         if context_parts:
-            return "\n# 最近对话记录\n" + "\n".join(context_parts[-5:]) + "\n"
-        return ""
+            context = "\n# 最近对话记录\n" + "\n".join(context_parts[-5:]) + "\n"
+        self._recent_context_cache = (self._history_version, count, context)
+        return context
 
 
 class Train12306MCPClient:
@@ -300,48 +3977,159 @@ class Train12306MCPClient:
     def __init__(self, config_path: str = 'config.json'):
         # 加载配置
         self.config = ConfigManager(config_path)
-        self.mcp_server_url = self.config.get('mcp_server.url', 'http://localhost:12306')
+        self.mcp_server_url = self.config.settings.mcp_server.url
         
         # 设置日志
         self._setup_logging()
         
-        # 连接相关
-        self.session: Optional[aiohttp.ClientSession] = None
-        self.sse_task: Optional[asyncio.Task] = None
-        self.heartbeat_task: Optional[asyncio.Task] = None
+        # JSON 编解码：auto 时优先使用已安装的 orjson / msgspec
+        codec = set_json_codec(self.config.get('json_codec', 'auto'))
+        logger.info(f"🧩 JSON 编解码: {codec.name}")
+        
+        # 连接相关：每个 MCP 服务器一个连接，工具表合并所有服务器的工具
+        self.servers: List[MCPServerConnection] = self._build_mcp_servers()
+        self.mcp_server_url = self.servers[0].url
+        self._configure_rate_limits()
+        # 工具名 -> (所属服务器, 服务器上的工具名)
+        self.tool_routes: Dict[str, Tuple[MCPServerConnection, str]] = {}
+        # 本地实现的工具：工具名 -> (发给 LLM 的工具定义, 处理函数)，依赖 get-tickets 可用
+        self.local_tools: Dict[str, Tuple[Dict[str, Any], Callable[[Dict[str, Any]], Awaitable[Any]]]] = {}
+        if self.config.get('ticket_fanout.enabled', True):
+            self.local_tools[TicketFanout.TOOL_NAME] = (TicketFanout.TOOL, self._ticket_fanout_tool)
+        self._server_connect_tasks: List[asyncio.Task] = []
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.config_watch_task: Optional[asyncio.Task] = None
+        self.compaction_task: Optional[asyncio.Task] = None
         self.tools_cache: List[Dict[str, Any]] = []
-        self.request_id = 0
         self.is_connected = False
         
+        # 工具结果缓存（默认只缓存车站代码和车票查询）
+        ttl_by_tool = self.config.get('cache.tool_ttl', {
+            "get-tickets": 300,
+            "get-station-code-of-citys": 86400,
+            "get-stations-code-in-city": 86400,
+            "get-station-code-by-names": 86400
+        })
+        self.tool_cache = ToolResultCache(
+            ttl_by_tool,
+            self.config.get('cache.max_entries', 512),
+            backend=self._build_cache_backend(),
+            lease_seconds=self.config.get('cache.lease_seconds', 30.0)
+        )
+        
+        # 进行中的查询计数；为 0 时视为空闲，预取任务才会发请求
+        self._active_queries = 0
+        self._idle_event = asyncio.Event()
+        self._idle_event.set()
+        
+        # 流量录制/回放（用于确定性的性能回归测试）
+        recording_mode = self.config.get('recording.mode', 'off')
+        if recording_mode != 'off':
+            self.cassette: Optional[TrafficCassette] = TrafficCassette(
+                self.config.get('recording.path', 'cassettes/session.json'),
+                recording_mode,
+                self.config.get('recording.replay_latency', 'recorded')
+            )
+            logger.info(f"📼 流量{'回放' if self.cassette.replaying else '录制'}模式: {self.cassette.path}")
+        else:
+            self.cassette = None
+        
+        # 交互模式下并发执行的查询：编号 -> 任务
+        self._query_counter = 0
+        self.query_tasks: Dict[int, asyncio.Task] = {}
+        
         # 记忆系统
-        if self.config.get('memory.session_enabled', True):
-            max_context = self.config.get('memory.max_context_messages', 20)
-            history_path = self.config.get('memory.history_path', 'conversation_history.json')
-            self.memory = ConversationMemory(history_path, max_context)
+        memory_settings = self.config.settings.memory
+        if memory_settings.session_enabled:
+            archive = None
+            if memory_settings.archive_dir:
+                archive = HistoryArchive(memory_settings.archive_dir, memory_settings.archive_compression)
+            self.memory = ConversationMemory(memory_settings.history_path, memory_settings.max_context_messages,
+                                             memory_settings.summary_max_chars, memory_settings.max_history_sessions,
+                                             archive, save_debounce=memory_settings.history_save_debounce)
         else:
             self.memory = None
         
+        # 车票余量快照归档（可选）：记录每次实际查询到的余票，供分析售罄规律
+        if self.config.get('ticket_archive.enabled', False):
+            self.ticket_archive = TicketSnapshotArchive(
+                self.config.get('ticket_archive.directory', 'ticket_archive'),
+                batch_results=self.config.get('ticket_archive.batch_results', 50),
+                flush_seconds=self.config.get('ticket_archive.flush_seconds', 60.0)
+            )
+        else:
+            self.ticket_archive = None
+        
         # 用户配置
-        if self.config.get('memory.persistent_enabled', True):
-            profile_path = self.config.get('memory.user_profile_path', 'user_profile.json')
-            self.profile = UserProfileManager(profile_path)
+        if memory_settings.persistent_enabled:
+            self.profile = UserProfileManager(memory_settings.user_profile_path, memory_settings.profile_save_debounce)
         else:
             self.profile = None
         
+        # Token 记账与预算
+        self.accountant = TokenAccountant(
+            self.profile,
+            per_query_tokens=self.config.get('budget.per_query_tokens', 0),
+            per_day_tokens=self.config.get('budget.per_day_tokens', 0),
+            degrade_ratio=self.config.get('budget.degrade_ratio', 0.8),
+            pricing=self.config.get('budget.pricing', {})
+        )
+        self.fallback_model = self.config.get('budget.fallback_model', '')
+        
+        # 工具循环控制
+        self.loop_controller = ToolLoopController(
+            min_iterations=self.config.get('loop_control.min_iterations', 2),
+            window=self.config.get('loop_control.window', 20),
+            margin=self.config.get('loop_control.margin', 1),
+            max_repeats=self.config.get('loop_control.max_repeats', 2),
+            finalize_after_tickets=self.config.get('loop_control.finalize_after_tickets', True),
+            adaptive=self.config.get('loop_control.adaptive', True)
+        )
+        
+        # 按查询挑选发送给 LLM 的工具子集
+        self.tool_selector = ToolSelector(
+            always=self.config.get('tool_routing.always'),
+            rules=self.config.get('tool_routing.rules')
+        ) if self.config.get('tool_routing.enabled', True) else None
+        
+        # 第一轮 LLM 请求期间推测执行的工具调用
+        self.speculation = SpeculativeCalls(
+            ttl=self.config.get('speculation.ttl', 30),
+            max_pending=self.config.get('speculation.max_pending', 4),
+            window=self.config.get('speculation.window', 20),
+            max_waste_ratio=self.config.get('speculation.max_waste_ratio', 0.5)
+        ) if self.config.get('speculation.enabled', True) else None
+        
         # 城市代码映射器
         city_codes_file = self.config.get('city_codes_file', 'city_codes.json')
         self.station_mapper = StationCodeMapper(city_codes_file)
-        logging.info(f"📍 已加载 {len(self.station_mapper.get_available_cities())} 个城市代码映射")
+        logger.info(f"📍 已加载 {len(self.station_mapper.get_available_cities())} 个城市代码映射")
         
-        # 初始化OpenAI客户端
+        # 初始化 LLM 端点与路由
         self.api_key = os.getenv('DEEPSEEK_API_KEY')
-        self.base_url = self.config.get('llm.base_url') or os.getenv('BASE_URL', 'https://api.deepseek.com')
-        self.model = self.config.get('llm.model') or os.getenv('MODEL', 'deepseek-chat')
+        self.base_url = self.config.settings.llm.base_url or os.getenv('BASE_URL', 'https://api.deepseek.com')
+        self.model = self.config.settings.llm.model or os.getenv('MODEL', 'deepseek-chat')
         
         if not self.api_key:
             raise ValueError("请设置环境变量 DEEPSEEK_API_KEY")
         
-        # 配置 HTTP 客户端（支持代理和 SSL 设置）
+        self.http_client = self._build_http_client()
+        self.llm_router = LLMRouter(
+            self._build_llm_endpoints(self.http_client),
+            hedge_enabled=self.config.get('llm.routing.hedge_enabled', False),
+            hedge_default_delay=self.config.get('llm.routing.hedge_default_delay', 3.0),
+            hedge_min_delay=self.config.get('llm.routing.hedge_min_delay', 0.5)
+        )
+        # 兼容旧代码：client 指向首选端点
+        self.client = self.llm_router.endpoints[0].client
+        
+        # 配置热加载后应用可在线调整的参数
+        self.config.add_listener(self._on_config_reload)
+        
+        logger.info(f"🚀 MCP客户端初始化完成 (V2.0) - Python {sys.version_info.major}.{sys.version_info.minor}")
+    
+    def _build_http_client(self):
+        """配置异步 HTTP 客户端（支持代理和 SSL 设置），各 LLM 端点共用；取消请求时关闭对应连接"""
         import httpx
         
         # 读取代理配置
@@ -364,192 +4152,269 @@ class Train12306MCPClient:
                 http_client_config['proxies']['http://'] = http_proxy
             if https_proxy:
                 http_client_config['proxies']['https://'] = https_proxy
-            logging.info(f"🌐 使用代理: HTTP={http_proxy}, HTTPS={https_proxy}")
+            logger.info(f"🌐 使用代理: HTTP={http_proxy}, HTTPS={https_proxy}")
+        
+        if not verify_ssl:
+            logger.warning("⚠️ SSL 验证已禁用（不推荐用于生产环境）")
+        
+        return httpx.AsyncClient(**http_client_config)
+    
+    def _build_llm_endpoints(self, http_client) -> List[LLMEndpoint]:
+        """根据 llm.endpoints 创建端点列表；未配置时使用 llm.base_url / llm.model 单端点"""
+        endpoint_configs = self.config.get('llm.endpoints') or [{
+            "name": self.config.get('llm.provider', 'deepseek'),
+            "base_url": self.base_url,
+            "model": self.model
+        }]
+        window = self.config.get('llm.routing.window', 50)
+        max_error_rate = self.config.get('llm.routing.max_error_rate', 0.5)
+        cooldown = self.config.get('llm.routing.cooldown_seconds', 30.0)
+        
+        endpoints = []
+        for ep_config in endpoint_configs:
+            api_key = os.getenv(ep_config.get('api_key_env', 'DEEPSEEK_API_KEY'))
+            if not api_key:
+                logger.warning(f"⚠️ LLM 端点 {ep_config.get('name')} 缺少 API Key，已跳过")
+                continue
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=ep_config.get('base_url', self.base_url),
+                http_client=http_client
+            )
+            endpoints.append(LLMEndpoint(
+                ep_config.get('name', ep_config.get('base_url', 'llm')),
+                client,
+                ep_config.get('model', self.model),
+                window=window,
+                max_error_rate=max_error_rate,
+                cooldown_seconds=cooldown
+            ))
+        return endpoints
+    
+    def _setup_logging(self):
+        """设置日志系统"""
+        setup_logging(self.config)
+    
+    def _build_cache_backend(self) -> CacheBackend:
+        """按 cache.backend 创建缓存后端：memory（进程内）或 sqlite（同一主机的多个进程共享）"""
+        backend = self.config.get('cache.backend', 'memory')
+        max_entries = self.config.get('cache.max_entries', 512)
+        if backend == 'sqlite':
+            path = self.config.get('cache.path', 'tool_cache.sqlite3')
+            try:
+                logger.info(f"🗄️ 使用共享工具缓存: {path}")
+                return SQLiteCacheBackend(path, max_entries)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ 打开共享缓存失败，改用进程内缓存: {e}")
+        elif backend != 'memory':
+            logger.warning(f"⚠️ 未知的缓存后端 {backend}，使用进程内缓存")
+        return MemoryCacheBackend(max_entries)
+    
+    def _build_mcp_servers(self) -> List[MCPServerConnection]:
+        """
+        根据 mcp_servers 创建服务器连接；未配置时使用 mcp_server.url 单服务器
+        第一个服务器的工具默认不加前缀（保持 get-tickets 等原名），其余服务器默认以名称为前缀
+        """
+        server_configs = self.config.get('mcp_servers') or [{
+            "name": "12306",
+            "url": self.config.settings.mcp_server.url
+        }]
+        
+        servers = []
+        for i, server_config in enumerate(server_configs):
+            if not server_config.get('enabled', True):
+                continue
+            if not server_config.get('url'):
+                logger.warning(f"⚠️ MCP 服务器 {server_config.get('name')} 缺少 url，已跳过")
+                continue
+            name = server_config.get('name', f"server{i + 1}")
+            prefix = server_config.get('prefix', name if servers else "")
+            servers.append(MCPServerConnection(name, server_config['url'], prefix))
+        if not servers:
+            raise ValueError("至少需要配置一个 MCP 服务器")
+        return servers
+    
+    def _configure_rate_limits(self):
+        """按 rate_limit 配置各服务器的限速调度器（未启用时不限速，但仍遵守服务器的 Retry-After）"""
+        settings = self.config.settings.rate_limit
+        for server in self.servers:
+            server.limiter.configure(
+                settings.default_rate if settings.enabled else 0,
+                settings.default_burst,
+                settings.tools if settings.enabled else {},
+                settings.background_reserve
+            )
+    
+    def _on_config_reload(self, old: Settings, new: Settings):
+        """
+        配置热加载回调：重试、超时等在每次请求时从快照读取，自动生效；
+        这里处理初始化时固化在各组件中的参数
+        """
+        self.tool_cache.ttl_by_tool = self.config.get('cache.tool_ttl', self.tool_cache.ttl_by_tool)
+        self.tool_cache.max_entries = self.config.get('cache.max_entries', self.tool_cache.max_entries)
         
-        if not verify_ssl:
-            logging.warning("⚠️ SSL 验证已禁用（不推荐用于生产环境）")
+        self.accountant.per_query_tokens = self.config.get('budget.per_query_tokens', 0)
+        self.accountant.per_day_tokens = self.config.get('budget.per_day_tokens', 0)
+        self.accountant.degrade_ratio = self.config.get('budget.degrade_ratio', 0.8)
+        self.accountant.pricing = self.config.get('budget.pricing', {})
+        self.fallback_model = self.config.get('budget.fallback_model', '')
         
-        http_client = httpx.Client(**http_client_config)
+        self.loop_controller.min_iterations = self.config.get('loop_control.min_iterations', 2)
+        self.loop_controller.margin = self.config.get('loop_control.margin', 1)
+        self.loop_controller.max_repeats = self.config.get('loop_control.max_repeats', 2)
+        self.loop_controller.finalize_after_tickets = self.config.get('loop_control.finalize_after_tickets', True)
+        self.loop_controller.adaptive = self.config.get('loop_control.adaptive', True)
         
-        self.client = OpenAI(
-            api_key=self.api_key, 
-            base_url=self.base_url,
-            http_client=http_client
-        )
+        if self.speculation is not None:
+            self.speculation.ttl = self.config.get('speculation.ttl', 30)
+            self.speculation.max_pending = self.config.get('speculation.max_pending', 4)
+            self.speculation.window = self.config.get('speculation.window', 20)
+            self.speculation.max_waste_ratio = self.config.get('speculation.max_waste_ratio', 0.5)
         
-        logging.info(f"🚀 MCP客户端初始化完成 (V2.0) - Python {sys.version_info.major}.{sys.version_info.minor}")
-    
-    def _setup_logging(self):
-        """设置日志系统"""
-        log_level = self.config.get('logging.level', 'INFO')
-        log_format = self.config.get('logging.format', '%(asctime)s - %(levelname)s - %(message)s')
+        self.llm_router.hedge_enabled = self.config.get('llm.routing.hedge_enabled', False)
+        self.llm_router.hedge_default_delay = self.config.get('llm.routing.hedge_default_delay', 3.0)
+        self.llm_router.hedge_min_delay = self.config.get('llm.routing.hedge_min_delay', 0.5)
         
-        logging.basicConfig(
-            level=getattr(logging, log_level),
-            format=log_format,
-            handlers=[logging.StreamHandler()]
-        )
-    
-    def _next_request_id(self) -> int:
-        """生成下一个请求ID"""
-        self.request_id += 1
-        return self.request_id
+        self._configure_rate_limits()
+        
+        # 连接池参数变化时各服务器换用新会话；旧会话上的请求完成后再关闭
+        old_conn, new_conn = old.mcp_server.connection, new.mcp_server.connection
+        if (old_conn.pool_size, old_conn.keepalive_timeout) != (new_conn.pool_size, new_conn.keepalive_timeout):
+            for server in self.servers:
+                if server.session is not None:
+                    server.replace_session(new_conn)
+            logger.info(f"🔄 连接池已更新: pool_size={new_conn.pool_size}")
     
     async def connect(self):
-        """建立与MCP服务器的连接（增强版：支持自动重连）"""
-        retry_attempts = self.config.get('mcp_server.connection.retry_attempts', 3)
-        retry_delay = self.config.get('mcp_server.connection.retry_delay', 1.0)
+        """并发连接所有 MCP 服务器；单个服务器慢或不可用不会阻塞其他服务器"""
+        connection = self.config.settings.mcp_server.connection
+        names = ", ".join(f"{server.name}({server.url})" for server in self.servers)
+        logger.info(f"🔗 正在连接到 MCP 服务器: {names}")
         
-        for attempt in range(retry_attempts):
-            try:
-                self.session = aiohttp.ClientSession()
-                logging.info(f"🔗 正在连接到 12306-MCP 服务器: {self.mcp_server_url}")
-                
-                # 启动SSE监听任务
-                if self.config.get('mcp_server.connection.sse_reconnect_enabled', True):
-                    self.sse_task = asyncio.create_task(self._listen_sse_with_reconnect())
-                
-                # 启动心跳任务
-                heartbeat_interval = self.config.get('mcp_server.connection.heartbeat_interval', 60)
-                if heartbeat_interval > 0:
-                    self.heartbeat_task = asyncio.create_task(self._heartbeat_loop(heartbeat_interval))
-                
-                # 初始化MCP连接
-                await self._initialize()
-                
-                # 获取可用工具列表
-                await self._fetch_tools()
-                
-                self.is_connected = True
-                logging.info(f"✅ 连接成功,已加载 {len(self.tools_cache)} 个工具")
-                
-                # 加载最近的对话历史（如果启用）
-                if self.memory and self.config.get('memory.load_recent_history', True):
-                    recent_count = self.config.get('memory.recent_history_count', 3)
-                    recent_context = self.memory.get_recent_context(recent_count)
-                    if recent_context:
-                        logging.info("📚 已加载最近对话记录")
-                
-                return
-                
-            except Exception as e:
-                logging.error(f"❌ 连接失败 (尝试 {attempt + 1}/{retry_attempts}): {e}")
-                if attempt < retry_attempts - 1:
-                    wait_time = retry_delay * (2 ** attempt)
-                    logging.info(f"⏳ {wait_time:.1f}秒后重试...")
-                    await asyncio.sleep(wait_time)
-                else:
-                    await self.cleanup()
-                    raise
+        self._server_connect_tasks = [asyncio.ensure_future(self._connect_server(server)) for server in self.servers]
+        # 等待所有服务器连接完成；超过 connect_wait 后只要有服务器可用就先行启动，其余在后台继续连接
+        done, pending = await asyncio.wait(self._server_connect_tasks, timeout=connection.connect_wait)
+        while pending and not any(server.connected for server in self.servers):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        
+        if not any(server.connected for server in self.servers):
+            await self.cleanup()
+            raise ConnectionError("无法连接任何 MCP 服务器")
+        if pending:
+            logger.warning(f"⏳ {len(pending)} 个 MCP 服务器仍在连接，将在后台继续")
+        
+        self.is_connected = True
+        logger.info(f"✅ 连接成功,已加载 {len(self.tools_cache)} 个工具")
+        
+        # 加载最近的对话历史（如果启用）
+        memory_settings = self.config.settings.memory
+        if self.memory and memory_settings.load_recent_history:
+            if memory_settings.history_retrieval == "relevant":
+                # 在线程池中建立检索索引（归档的会话可能很多），不阻塞事件循环
+                await asyncio.get_event_loop().run_in_executor(None, self.memory.build_index)
+            elif self.memory.get_recent_context(memory_settings.recent_history_count):
+                logger.info("📚 已加载最近对话记录")
+        self._schedule_compaction()
+        
+        # 空闲时预取常用路线的车票
+        if self.profile and self.config.get('prefetch.enabled', True):
+            self.prefetch_task = asyncio.create_task(self._prefetch_frequent_routes())
+        
+        # 监听配置文件变化
+        if self.config.get('hot_reload.enabled', True) and self.config_watch_task is None:
+            self.config_watch_task = asyncio.create_task(
+                self.config.watch(self.config.get('hot_reload.interval', 2.0))
+            )
     
-    async def _listen_sse_with_reconnect(self):
-        """监听SSE事件流（增强版：支持自动重连）"""
-        sse_url = f"{self.mcp_server_url}/sse"
-        reconnect_interval = self.config.get('mcp_server.connection.sse_reconnect_interval', 5)
+    async def _connect_server(self, server: MCPServerConnection) -> bool:
+        """连接单个服务器（失败时指数退避重试），成功后注册其工具并启动 SSE 监听；心跳负责之后的健康检查和重连"""
+        connection = self.config.settings.mcp_server.connection
+        retry_attempts = connection.retry_attempts
+        retry_delay = connection.retry_delay
         
-        while self.is_connected:
-            try:
-                logging.info("🔌 连接SSE事件流...")
-                async with EventSource(sse_url, session=self.session) as event_source:
-                    async for event in event_source:
-                        if event.data and event.data.strip():
-                            logging.debug(f"收到SSE事件: {event.data[:100]}")
-            except asyncio.CancelledError:
+        for attempt in range(retry_attempts):
+            if server.session is None:
+                server.open_session(connection)
+            if await self._initialize(server) and await self._fetch_tools(server):
+                server.connected = True
+                self._rebuild_tool_registry()
+                if connection.sse_reconnect_enabled and server.sse_task is None:
+                    server.sse_task = asyncio.ensure_future(server.listen_sse(connection.sse_reconnect_interval))
                 break
-            except Exception as e:
-                if self.is_connected:
-                    logging.warning(f"⚠️ SSE连接断开: {e}，{reconnect_interval}秒后重连...")
-                    await asyncio.sleep(reconnect_interval)
-                else:
-                    break
+            
+            logger.error(f"❌ 连接 {server.name} 失败 (尝试 {attempt + 1}/{retry_attempts})")
+            if attempt < retry_attempts - 1:
+                wait_time = min(retry_delay * (2 ** attempt), connection.max_retry_delay)
+                logger.info(f"⏳ {wait_time:.1f}秒后重试...")
+                await asyncio.sleep(wait_time)
+        
+        if connection.heartbeat_interval > 0 and server.heartbeat_task is None:
+            server.heartbeat_task = asyncio.ensure_future(self._heartbeat_loop(server, connection.heartbeat_interval))
+        return server.connected
     
-    async def _heartbeat_loop(self, interval: int):
-        """心跳循环：定期检查连接状态"""
-        while self.is_connected:
+    async def _heartbeat_loop(self, server: MCPServerConnection, interval: float):
+        """心跳循环：定期检查服务器状态；不可用时从工具表中摘除，恢复后重新注册"""
+        while True:
             try:
                 await asyncio.sleep(interval)
-                # 发送一个轻量级的请求来保持连接
-                await self._make_mcp_request("ping", {})
-                logging.debug("💓 心跳检查成功")
+                if server.connected:
+                    # 发送一个轻量级的请求来保持连接
+                    result = await self._make_mcp_request("ping", {}, server=server, background=True)
+                    if result is None and server.last_error:
+                        server.connected = False
+                        self._rebuild_tool_registry()
+                        rpc_logger.warning(f"⚠️ MCP 服务器 {server.name} 不可用，已暂停其工具")
+                    else:
+                        rpc_logger.debug("💓 心跳检查成功 [%s]", server.name)
+                elif await self._initialize(server) and await self._fetch_tools(server):
+                    server.connected = True
+                    self._rebuild_tool_registry()
+                    rpc_logger.info(f"✅ MCP 服务器 {server.name} 已重新连接")
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                logging.warning(f"⚠️ 心跳检查失败: {e}")
-    
-    def _parse_sse_response(self, body: str) -> Optional[Dict[str, Any]]:
-        """解析SSE格式的响应"""
-        try:
-            if body.startswith('event:'):
-                lines = body.strip().split('\n')
-                for line in lines:
-                    if line.startswith('data:'):
-                        json_str = line[len('data:'):].strip()
-                        return json.loads(json_str)
-            elif body.startswith('data:'):
-                json_str = body[len('data:'):].strip()
-                return json.loads(json_str)
-            else:
-                return json.loads(body)
-        except json.JSONDecodeError as e:
-            logging.error(f"⚠️ JSON解析失败: {e}")
-            return None
+                rpc_logger.warning(f"⚠️ 心跳检查失败 [{server.name}]: {e}")
     
-    async def _make_mcp_request(self, method: str, params: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
-        """发送标准MCP JSON-RPC 2.0请求（增强版：支持重试）"""
-        if not self.session:
+    async def _make_mcp_request(self, method: str, params: Dict[str, Any] = None,
+                                server: Optional[MCPServerConnection] = None,
+                                background: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        向指定服务器（默认第一个）发送MCP请求；启用录制/回放时记录或回放请求与响应
+        background=True 的请求（心跳、预取）在限速排队时让位于交互查询
+        """
+        server = server or self.servers[0]
+        if server.session is None:
             raise RuntimeError("客户端未连接")
         
-        retry_attempts = self.config.get('mcp_server.connection.retry_attempts', 3)
-        retry_delay = self.config.get('mcp_server.connection.retry_delay', 1.0)
-        timeout = self.config.get('mcp_server.connection.timeout_seconds', 30)
-        
-        mcp_url = f"{self.mcp_server_url}/mcp"
-        payload = {
-            "jsonrpc": "2.0",
-            "id": self._next_request_id(),
-            "method": method,
-            "params": params or {}
-        }
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json, text/event-stream',
-        }
+        if self.cassette is None:
+            return await self._send_mcp_request(server, method, params, background)
         
-        last_error = None
-        for attempt in range(retry_attempts):
+        request = {"method": method, "params": params or {}}
+        if server is not self.servers[0]:
+            request["server"] = server.name
+        if self.cassette.replaying:
             try:
-                async with self.session.post(
-                    mcp_url, 
-                    json=payload, 
-                    headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=timeout)
-                ) as response:
-                    response.raise_for_status()
-                    body = await response.text()
-                    data = self._parse_sse_response(body)
-                    
-                    if data:
-                        if 'error' in data:
-                            error = data['error']
-                            logging.error(f"❌ MCP错误: {error.get('message', 'Unknown error')}")
-                            return None
-                        return data.get('result')
-                    return None
-                    
-            except (aiohttp.ClientResponseError, aiohttp.ClientError, asyncio.TimeoutError) as e:
-                last_error = e
-                logging.warning(f"⚠️ 请求失败 (尝试 {attempt + 1}/{retry_attempts}): {e}")
-                
-                if attempt < retry_attempts - 1:
-                    wait_time = retry_delay * (2 ** attempt)
-                    await asyncio.sleep(wait_time)
-                    continue
+                return await self.cassette.replay("mcp", request)
+            except LookupError as e:
+                rpc_logger.error(f"❌ {e}: {method}")
+                return None
         
-        logging.error(f"❌ 请求最终失败: {last_error}")
-        return None
+        started = time.monotonic()
+        result = await self._send_mcp_request(server, method, params, background)
+        self.cassette.record("mcp", request, result, time.monotonic() - started)
+        return result
+    
+    async def _send_mcp_request(self, server: MCPServerConnection, method: str,
+                                params: Dict[str, Any] = None, background: bool = False) -> Optional[Dict[str, Any]]:
+        """发送MCP请求；每次请求读取一次当前快照，热加载后的重试/超时参数立即生效"""
+        return await server.request(
+            method, params,
+            self.config.settings.mcp_server.connection,
+            self.config.get('deadline.min_attempt_seconds', 1.0),
+            RateLimiter.BACKGROUND if background else RateLimiter.INTERACTIVE
+        )
     
-    async def _initialize(self):
+    async def _initialize(self, server: MCPServerConnection) -> bool:
         """初始化MCP连接"""
         result = await self._make_mcp_request(
             "initialize",
@@ -560,65 +4425,241 @@ class Train12306MCPClient:
                     "name": "12306-mcp-client-v2",
                     "version": "2.0.0"
                 }
-            }
+            },
+            server=server
         )
         
         if result:
-            server_info = result.get('serverInfo', {})
-            logging.info(f"✅ MCP初始化成功")
-            logging.info(f"   服务器: {server_info.get('name', 'unknown')}")
-            logging.info(f"   版本: {server_info.get('version', 'unknown')}")
-    
-    async def _fetch_tools(self):
-        """获取可用工具列表"""
-        result = await self._make_mcp_request("tools/list")
-        
-        if result and 'tools' in result:
-            tools = result['tools']
-            logging.info(f"\n📋 可用工具:")
-            for tool in tools:
-                tool_name = tool.get('name', 'unknown')
-                tool_desc = tool.get('description', '')[:60]
-                logging.info(f"   • {tool_name}: {tool_desc}...")
-            
-            self.tools_cache = []
-            for tool in tools:
-                input_schema = tool.get("inputSchema", {})
-                self.tools_cache.append({
-                    "type": "function",
-                    "function": {
-                        "name": tool.get("name", "unknown_tool"),
-                        "description": tool.get("description", ""),
-                        "parameters": input_schema
-                    }
-                })
+            server.server_info = result.get('serverInfo', {})
+            rpc_logger.info(f"✅ MCP初始化成功 [{server.name}]")
+            rpc_logger.info(f"   服务器: {server.server_info.get('name', 'unknown')}")
+            rpc_logger.info(f"   版本: {server.server_info.get('version', 'unknown')}")
+        return bool(result)
+    
+    async def _fetch_tools(self, server: MCPServerConnection) -> bool:
+        """获取服务器的可用工具列表"""
+        result = await self._make_mcp_request("tools/list", server=server)
+        
+        if not result or 'tools' not in result:
+            return False
+        
+        server.tools = result['tools']
+        rpc_logger.info("📋 [%s] 获取到 %d 个可用工具", server.name, len(server.tools))
+        if rpc_logger.isEnabledFor(logging.DEBUG):
+            for tool in server.tools:
+                rpc_logger.debug("   • %s: %.60s...", tool.get('name', 'unknown'), tool.get('description', ''))
+        return True
+    
+    def _rebuild_tool_registry(self):
+        """合并各服务器的工具：路由表包含所有已知工具，发给 LLM 的工具表只包含可用服务器的工具"""
+        tools_cache = []
+        routes: Dict[str, Tuple[MCPServerConnection, str]] = {}
+        for server in self.servers:
+            for tool in server.tools:
+                tool_name = tool.get("name", "unknown_tool")
+                public_name = server.public_name(tool_name)
+                if public_name in routes:
+                    public_name = f"{server.name}__{tool_name}"
+                    logger.warning(f"⚠️ 工具名冲突，{server.name} 的 {tool_name} 注册为 {public_name}")
+                routes[public_name] = (server, tool_name)
+                if server.connected:
+                    tools_cache.append({
+                        "type": "function",
+                        "function": {
+                            "name": public_name,
+                            "description": tool.get("description", ""),
+                            "parameters": tool.get("inputSchema", {})
+                        }
+                    })
+        ticket_route = routes.get('get-tickets')
+        if ticket_route is not None and ticket_route[0].connected:
+            tools_cache.extend(definition for name, (definition, _) in self.local_tools.items() if name not in routes)
+        self.tool_routes = routes
+        self.tools_cache = tools_cache
+        if self.tool_selector is not None:
+            self.tool_selector.update(tools_cache)
+    
+    def _select_tools(self, query: str, extra: Optional[set] = None, widen: bool = False) -> List[Dict[str, Any]]:
+        """本轮发送给 LLM 的工具：未启用工具路由时为全部工具"""
+        if self.tool_selector is None:
+            return self.tools_cache
+        return self.tool_selector.select(query, extra, widen)
+
+    async def call_tool(self, tool_name: str, arguments: Dict[str, Any], background: bool = False,
+                        record_route: bool = True, speculative: bool = False) -> Any:
+        """
+        调用MCP工具（增强版：智能重试 + 结果缓存）；background=True 表示预取等后台调用
+        相同参数的并发调用（包括共享缓存的其他进程）只会向服务器发送一次请求
+        record_route=False 时不计入常用路线（如换乘搜索中查询的枢纽区段）
+        speculative=True 表示推测调用本身：按交互优先级发送（模型很可能马上需要结果），不计入常用路线
+        """
+        if speculative:
+            record_route = False
+        elif not background and self.speculation is not None:
+            result = await self.speculation.take(tool_name, arguments, lambda value: not self._is_error_result(value))
+            if result is not None:
+                rpc_logger.info("🎯 使用推测调用的结果: %s", tool_name)
+                return result
+        result, cached = await self.tool_cache.get_or_compute(
+            tool_name, arguments,
+            lambda: self._invoke_tool(tool_name, arguments, background),
+            lambda value: not self._is_error_result(value)
+        )
+        if cached:
+            rpc_logger.info("⚡ 命中工具缓存: %s", tool_name)
+        elif self.ticket_archive is not None and tool_name == 'get-tickets' and not self._is_error_result(result):
+            self.ticket_archive.record(arguments, result)
+        if not background and record_route and not self._is_error_result(result):
+            self._record_route(tool_name, arguments)
+        return result
     
-    async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
-        """调用MCP工具（增强版：智能重试）"""
-        logging.info(f"\n🔧 调用工具: {tool_name}")
-        logging.debug(f"📝 参数: {json.dumps(arguments, ensure_ascii=False, indent=2)}")
+    async def _invoke_tool(self, tool_name: str, arguments: Dict[str, Any], background: bool = False) -> Any:
+        """把工具调用路由到所属服务器；本地工具直接在客户端执行"""
+        route = self.tool_routes.get(tool_name)
+        if route is None and tool_name in self.local_tools:
+            return await self.local_tools[tool_name][1](arguments)
+        if route is None:
+            return {"error": f"未知工具: {tool_name}"}
+        server, server_tool_name = route
+        if not server.connected:
+            return {"error": f"MCP 服务器 {server.name} 暂不可用"}
+        
+        rpc_logger.info("🔧 调用工具: %s", tool_name)
+        if rpc_logger.isEnabledFor(logging.DEBUG):
+            rpc_logger.debug("📝 参数: %s", json_codec.dumps_text(arguments, indent=True))
         
         result = await self._make_mcp_request(
             "tools/call",
             {
-                "name": tool_name,
+                "name": server_tool_name,
                 "arguments": arguments
-            }
+            },
+            server=server,
+            background=background
         )
         
         if result:
-            logging.info(f"✅ 工具执行成功")
+            rpc_logger.info("✅ 工具执行成功")
             return result
         
         return {"error": "工具调用失败，已自动重试"}
+    
+    @staticmethod
+    def _is_error_result(result: Any) -> bool:
+        """判断工具结果是否为错误（MCP isError 标记或以 Error 开头的文本）"""
+        if not isinstance(result, dict):
+            return True
+        if result.get('isError') or 'error' in result:
+            return True
+        content = result.get('content')
+        if isinstance(content, list) and content and isinstance(content[0], dict):
+            text = str(content[0].get('text', ''))
+            return text.lstrip().lower().startswith('error')
+        return False
+    
+    def _record_route(self, tool_name: str, arguments: Dict[str, Any]):
+        """从成功的 get-tickets 调用中记录路线"""
+        if tool_name != 'get-tickets' or not self.profile:
+            return
+        from_station = arguments.get('fromStation')
+        to_station = arguments.get('toStation')
+        if not from_station or not to_station:
+            return
+        self.profile.record_route(
+            from_station, to_station,
+            self.station_mapper.get_city(from_station),
+            self.station_mapper.get_city(to_station)
+        )
+    
+    async def _speculate(self, user_message: str, tools: List[Dict[str, Any]]):
+        """
+        推测模型第一轮会调用的工具（当前日期、问题中提到的城市的车站代码）并提前执行，
+        与第一轮 LLM 请求并行；已在工具缓存中的调用不再推测
+        """
+        names = {tool['function']['name'] for tool in tools}
+        predicted = []
+        if 'get-current-date' in names:
+            predicted.append(('get-current-date', {}))
+        cities = self.station_mapper.find_cities(user_message)
+        if cities and 'get-station-code-of-citys' in names:
+            predicted.append(('get-station-code-of-citys', {"citys": "|".join(cities)}))
+        for tool_name, arguments in predicted:
+            if await self.tool_cache.contains(tool_name, arguments):
+                continue
+            if self.speculation.start(tool_name, arguments, functools.partial(
+                    self.call_tool, tool_name, arguments, speculative=True)):
+                logger.debug("🎯 推测调用 %s %s", tool_name, arguments)
+    
+    def _prefetch_candidates(self) -> List[Dict[str, Any]]:
+        """生成预取候选：常用路线 × 可能的出行日期"""
+        max_routes = self.config.get('prefetch.max_routes', 3)
+        days_ahead = self.config.get('prefetch.days_ahead', [0, 1])
+        
+        routes = [(r['from'], r['to']) for r in self.profile.get_frequent_routes(max_routes)]
+        
+        # 用户设置的默认出发/到达城市也作为一条候选路线
+        prefs = self.profile.profile.get('preferences', {})
+        default_from = self.station_mapper.get_code(prefs.get('default_departure_city', ''))
+        default_to = self.station_mapper.get_code(prefs.get('default_arrival_city', ''))
+        if default_from and default_to and (default_from, default_to) not in routes:
+            routes.append((default_from, default_to))
+        
+        today = datetime.now().date()
+        candidates = []
+        for offset in days_ahead:
+            date_str = (today + timedelta(days=offset)).strftime('%Y-%m-%d')
+            for from_station, to_station in routes:
+                candidates.append({"date": date_str, "fromStation": from_station, "toStation": to_station})
+        return candidates
+    
+    async def _prefetch_frequent_routes(self):
+        """空闲时预取常用路线车票到工具缓存（限速，可取消，有查询进行时暂停）"""
+        idle_delay = self.config.get('prefetch.idle_delay', 5)
+        request_interval = self.config.get('prefetch.request_interval', 2.0)
+        
+        try:
+            await asyncio.sleep(idle_delay)
+            candidates = self._prefetch_candidates()
+            if not candidates:
+                return
+            
+            prefetched = 0
+            for arguments in candidates:
+                if not self.is_connected:
+                    break
+                if await self.tool_cache.contains('get-tickets', arguments):
+                    continue
+                # 有用户查询时让路，等待空闲后再继续
+                await self._idle_event.wait()
+                await self.call_tool('get-tickets', arguments, background=True)
+                prefetched += 1
+                await asyncio.sleep(request_interval)
+            
+            if prefetched:
+                logger.info(f"🔮 已预取 {prefetched} 条常用路线车票")
+        except asyncio.CancelledError:
+            logger.debug("预取任务已取消")
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ 预取常用路线失败: {e}")
+    
+    def cancel_prefetch(self):
+        """取消进行中的预取任务"""
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
 
-    def _build_system_prompt(self) -> str:
-        """构建系统提示（增强版：集成用户偏好和历史）"""
-        if not self.tools_cache:
+    def _build_system_prompt(self, user_message: str = "", tools: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        构建系统提示（增强版：集成用户偏好和历史）；user_message 用于检索相关的历史对话，
+        tools 为本次发送的工具子集（默认全部工具）
+        """
+        if tools is None:
+            tools = self.tools_cache
+        if not tools:
             return "You are a helpful assistant."
 
         tool_descriptions = []
-        for tool in self.tools_cache:
+        for tool in tools:
             func = tool.get('function', {})
             tool_name = func.get('name', 'unknown')
             tool_desc = func.get('description', '')
@@ -692,88 +4733,172 @@ class Train12306MCPClient:
 4. **严格格式**：调用工具时参数必须正确
 """
         
+        # 可以批量查票时，提示模型一次查询所有日期和路线
+        if any(tool['function']['name'] == TicketFanout.TOOL_NAME for tool in tools):
+            base_prompt += (f"5. **批量查询**：用户比较多个日期或多条路线（如“下周哪天最便宜”）时，"
+                            f"调用一次 `{TicketFanout.TOOL_NAME}` 查询全部组合，不要逐日调用 `get-tickets`\n")
+        
         # 添加用户偏好上下文
         if self.profile:
             user_context = self.profile.get_user_context()
             if user_context:
                 base_prompt += f"\n{user_context}"
         
-        # 添加最近对话历史
-        if self.memory and self.config.get('memory.load_recent_history', True):
-            recent_context = self.memory.get_recent_context(
-                self.config.get('memory.recent_history_count', 3)
-            )
+        # 添加当前会话早前内容的摘要
+        if self.memory:
+            session_summary = self.memory.get_session_summary()
+            if session_summary:
+                base_prompt += f"\n{session_summary}"
+        
+        # 添加相关（或最近）的历史对话
+        memory_settings = self.config.settings.memory
+        if self.memory and memory_settings.load_recent_history:
+            if memory_settings.history_retrieval == "relevant" and user_message:
+                recent_context = self.memory.get_relevant_context(
+                    user_message, memory_settings.retrieval_max_tokens, memory_settings.retrieval_top_k)
+            else:
+                recent_context = self.memory.get_recent_context(memory_settings.recent_history_count)
             if recent_context:
                 base_prompt += f"\n{recent_context}"
         
         return base_prompt
 
-    async def chat(self, user_message: str, max_iterations: int = None) -> str:
-        """与AI对话（增强版：会话记忆）"""
-        if not self.session:
+    async def chat(self, user_message: str, max_iterations: int = None,
+                   deadline_seconds: Optional[float] = None) -> str:
+        """
+        与AI对话（增强版：会话记忆）
+        deadline_seconds: 本次查询的总时间上限，默认读取 deadline.query_seconds（0 表示不限制）
+        """
+        if deadline_seconds is None:
+            deadline_seconds = self.config.get('deadline.query_seconds', 0)
+        if self.cassette is not None and not self.cassette.replaying:
+            self.cassette.conversation.append(user_message)
+        token = _current_deadline.set(Deadline(deadline_seconds) if deadline_seconds else None)
+        
+        self._active_queries += 1
+        self._idle_event.clear()
+        try:
+            return await self._chat(user_message, max_iterations)
+        finally:
+            _current_deadline.reset(token)
+            self._active_queries -= 1
+            if self._active_queries == 0:
+                self._idle_event.set()
+    
+    async def _chat(self, user_message: str, max_iterations: int = None) -> str:
+        """对话主流程：多轮 LLM 推理与工具调用"""
+        if not self.is_connected:
             raise RuntimeError("客户端未连接,请先调用 connect()")
 
         if not self.tools_cache:
             return "❌ 错误: 未加载任何工具,请检查MCP服务器"
         
         if max_iterations is None:
-            max_iterations = self.config.get('llm.max_iterations', 5)
-        
-        # 记录用户消息
-        if self.memory:
-            self.memory.add_message("user", user_message)
+            max_iterations = self.loop_controller.allowed_iterations(self.config.settings.llm.max_iterations)
         
         # 更新用户统计
         if self.profile:
             self.profile.update_query_stats()
         
-        # 构建系统提示
-        system_prompt = self._build_system_prompt()
+        # 挑选本次查询的工具子集并构建系统提示（系统提示只列出首轮发送的工具）
+        tools = self._select_tools(user_message)
+        system_prompt = self._build_system_prompt(user_message, tools)
         
-        # 获取当前会话历史
+        # 获取当前会话历史；本轮问答在完成后才整体写入记忆，并发查询之间互不打乱
+        messages = [{"role": "system", "content": system_prompt}]
         if self.memory:
-            messages = [{"role": "system", "content": system_prompt}]
             messages.extend(self.memory.get_current_session(include_system=False))
-        else:
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ]
+        messages.append({"role": "user", "content": user_message})
         
-        logging.info(f"\n💬 [用户] {user_message}")
+        logger.info("💬 [用户] %s", user_message)
+        
+        query_usage = self.accountant.start_query()
+        
+        # 每日预算已用完：跳过 LLM，尝试直接查票
+        if self.accountant.day_exhausted():
+            logger.warning("⚠️ 今日 Token 预算已用完，使用直接查询模式")
+            final_response = await self._direct_ticket_query(user_message) or \
+                "⚠️ 今日查询额度已用完，请明天再试，或直接说明出发城市、到达城市和日期。"
+            self._remember_turn(user_message, final_response)
+            return final_response
 
+        loop_state = self.loop_controller.start_query(self.station_mapper.find_cities(user_message))
+        # 模型调用了子集外的工具时加入子集；工具返回错误时之后发送全部工具
+        extra_tools: set = set()
+        widen_tools = False
+        widen_on_error = self.config.get('tool_routing.widen_on_error', True)
+        deadline = current_deadline()
+        min_llm_seconds = self.config.get('deadline.min_llm_seconds', 2.0)
+        stop_reason = None
         for i in range(max_iterations):
-            logging.info(f"🤔 [AI] 正在思考... (第 {i+1} 轮)")
+            if not self.accountant.can_continue(query_usage):
+                stop_reason = "budget"
+                break
+            if deadline is not None and deadline.remaining() < min_llm_seconds:
+                stop_reason = "deadline"
+                break
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=self.tools_cache,
-                tool_choice="auto"
-            )
+            logger.info("🤔 [AI] 正在思考... (第 %d 轮)", i + 1)
+            
+            # 查票已完成或模型陷入重复调用时，要求模型直接作答
+            finalize = loop_state.should_finalize()
+            if finalize:
+                logger.info("🏁 已获得所需结果，要求模型直接生成回复")
+            
+            if i > 0:
+                tools = self._select_tools(user_message, extra_tools, widen_tools)
+            if self.tool_selector is not None:
+                self.tool_selector.record(tools)
+            # 推测调用与第一轮 LLM 请求并行发起（检查工具缓存时不阻塞事件循环）
+            speculating = None
+            if i == 0 and not finalize and self.speculation is not None:
+                speculating = asyncio.ensure_future(self._speculate(user_message, tools))
+            
+            # OpenAI 兼容接口不接受空的 tools 列表，没有工具时不发送 tools / tool_choice
+            tool_args = {"tools": tools, "tool_choice": "none" if finalize else "auto"} if tools else {}
+            try:
+                response, model = await self._llm_create(
+                    model=self._select_model(query_usage),
+                    messages=messages,
+                    **tool_args
+                )
+            except (asyncio.TimeoutError, APITimeoutError):
+                if deadline is None:
+                    raise
+                stop_reason = "deadline"
+                break
+            finally:
+                # LLM 已经返回（或失败）时还没发起的推测不再有意义
+                if speculating is not None and not speculating.done():
+                    speculating.cancel()
+            self.accountant.record(query_usage, response.usage, model)
             
             assistant_message = response.choices[0].message
             
             if not assistant_message.tool_calls:
                 final_response = assistant_message.content or "任务已完成。"
-                logging.info("✅ [AI] 任务完成, 生成最终回复。")
+                logger.info("✅ [AI] 任务完成, 生成最终回复。")
+                self.loop_controller.record_outcome(i + 1, exhausted=False)
                 
-                # 记录助手回复
-                if self.memory:
-                    self.memory.add_message("assistant", final_response)
+                # 记录本轮问答
+                self._remember_turn(user_message, final_response)
                 
                 return final_response
 
             messages.append(assistant_message)
 
+            sent = {tool['function']['name'] for tool in tools}
             for tool_call in assistant_message.tool_calls:
                 function_name = tool_call.function.name
+                if function_name not in sent:
+                    logger.info("🧰 模型调用了未发送的工具 %s，之后的轮次加入该工具", function_name)
+                    extra_tools.add(function_name)
                 
                 try:
-                    function_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError:
+                    function_args = json_codec.loads(tool_call.function.arguments)
+                except ValueError:
                     error_message = f"❌ 工具 '{function_name}' 的参数格式错误"
-                    logging.error(error_message)
+                    logger.error(error_message)
                     messages.append({
                         "tool_call_id": tool_call.id,
                         "role": "tool",
@@ -782,18 +4907,20 @@ class Train12306MCPClient:
                     })
                     continue
 
-                tool_result = await self.call_tool(function_name, function_args)
-                
-                if isinstance(tool_result, dict) and "content" in tool_result:
-                    content_list = tool_result["content"]
-                    if isinstance(content_list, list) and len(content_list) > 0:
-                        content_text = content_list[0].get("text", json.dumps(tool_result, ensure_ascii=False))
-                    else:
-                        content_text = json.dumps(tool_result, ensure_ascii=False)
+                # 本次查询中参数完全相同的调用直接复用结果
+                content_text = loop_state.lookup(function_name, function_args)
+                if content_text is not None:
+                    logger.info("♻️ 重复调用 %s，复用上次结果", function_name)
                 else:
-                    content_text = str(tool_result)
+                    tool_result = await self.call_tool(function_name, function_args)
+                    content_text = await self._tool_message_text(function_name, function_args, tool_result)
+                    failed = self._is_error_result(tool_result)
+                    loop_state.remember(function_name, function_args, content_text, ok=not failed)
+                    if failed and widen_on_error and not widen_tools and len(tools) < len(self.tools_cache):
+                        logger.info("🧰 工具 %s 返回错误，之后的轮次发送全部工具", function_name)
+                        widen_tools = True
                 
-                logging.debug(f"  > 工具结果: {content_text[:250]}...")
+                logger.debug("  > 工具结果: %.250s...", content_text)
 
                 messages.append({
                     "tool_call_id": tool_call.id,
@@ -802,21 +4929,343 @@ class Train12306MCPClient:
                     "content": content_text,
                 })
         
-        logging.warning(f"⚠️ 达到最大迭代次数 ({max_iterations})，强制生成最终回复。")
-        final_response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-        )
-        final_text = final_response.choices[0].message.content or "已达到最大处理轮次。"
+        if stop_reason is None:
+            self.loop_controller.record_outcome(max_iterations, exhausted=True)
         
-        # 记录助手回复
-        if self.memory:
-            self.memory.add_message("assistant", final_text)
+        if stop_reason == "budget":
+            logger.warning("⚠️ 本次查询 Token 预算即将耗尽，停止工具调用")
+            final_text = self._fallback_answer(messages, "⚠️ 已达到本次查询的 Token 预算")
+        elif stop_reason == "deadline":
+            logger.warning(f"⏰ 查询到达时间上限 ({deadline.seconds:g}秒)，返回目前的结果")
+            final_text = self._fallback_answer(messages, "⏰ 查询已到达时间上限")
+        else:
+            logger.warning(f"⚠️ 达到最大迭代次数 ({max_iterations})，强制生成最终回复。")
+            final_text = None
+            has_time = deadline is None or deadline.remaining() >= min_llm_seconds
+            if has_time and self.accountant.can_continue(query_usage):
+                try:
+                    final_response, model = await self._llm_create(
+                        model=self._select_model(query_usage),
+                        messages=messages,
+                    )
+                    self.accountant.record(query_usage, final_response.usage, model)
+                    final_text = final_response.choices[0].message.content or "已达到最大处理轮次。"
+                except (asyncio.TimeoutError, APITimeoutError):
+                    if deadline is None:
+                        raise
+            if final_text is None:
+                final_text = self._fallback_answer(messages, "⚠️ 已达到最大处理轮次")
+        
+        # 记录本轮问答
+        self._remember_turn(user_message, final_text)
         
         return final_text
+    
+    async def _llm_create(self, **kwargs) -> Tuple[Any, str]:
+        """通过 LLM 路由器发送请求；启用录制/回放时记录或回放请求与响应"""
+        if self.cassette is None:
+            return await self.llm_router.create(**kwargs)
+        
+        request = {k: v for k, v in kwargs.items() if k != 'timeout'}
+        if self.cassette.replaying:
+            data = await self.cassette.replay("llm", request)
+            return ChatCompletion.model_validate(data['completion']), data['model']
+        
+        started = time.monotonic()
+        response, model = await self.llm_router.create(**kwargs)
+        self.cassette.record("llm", request, {"completion": response, "model": model}, time.monotonic() - started)
+        return response, model
+    
+    def _remember_turn(self, user_message: str, response: str):
+        """把一轮完整的问答写入会话记忆（被取消的查询不会留下半截记录）"""
+        if self.memory:
+            self.memory.add_message("user", user_message)
+            self.memory.add_message("assistant", response)
+            self._schedule_compaction()
+    
+    def _schedule_compaction(self):
+        """有需要压缩的记忆时启动后台压缩任务（不占用用户查询的时间）"""
+        if not self.memory or self.config.settings.memory.summary_method == "off":
+            return
+        if self.compaction_task is not None and not self.compaction_task.done():
+            return
+        if self.memory.needs_compaction(self.config.settings.memory.recent_history_count):
+            self.compaction_task = asyncio.create_task(self._compact_memory())
+    
+    async def _compact_memory(self):
+        """后台压缩会话记忆，直到没有待处理的消息"""
+        # 任务从查询中创建时会继承该查询的截止时间，摘要调用不应受其限制
+        _current_deadline.set(None)
+        recent_count = self.config.settings.memory.recent_history_count
+        try:
+            while self.memory.needs_compaction(recent_count):
+                await self.memory.compact(self._summarize, recent_count)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            memory_logger.warning(f"⚠️ 会话记忆压缩失败: {e}")
+    
+    async def _summarize(self, previous: str, messages: List[Dict[str, Any]]) -> str:
+        """生成滚动摘要：默认使用 LLM，失败或预算用完时退回抽取式摘要"""
+        memory_settings = self.config.settings.memory
+        max_chars = memory_settings.summary_max_chars
+        if memory_settings.summary_method != "llm" or self.accountant.day_exhausted():
+            return ConversationMemory.extractive_summary(previous, messages, max_chars)
+        
+        dialogue = "\n".join(f"{msg['role']}: {msg['content'][:500]}" for msg in messages)
+        prompt = (f"已有摘要:\n{previous or '（无）'}\n\n新增对话:\n{dialogue}\n\n"
+                  f"请输出合并后的新摘要，不超过{max_chars}字。")
+        try:
+            # 摘要对质量要求不高，配置了降级模型时使用更便宜的模型
+            response, model = await self._llm_create(
+                model=self.fallback_model,
+                messages=[
+                    {"role": "system", "content": "你是对话摘要助手。把火车票查询对话压缩为简短的中文摘要，"
+                                                  "保留出发地、目的地、日期、车次、席别偏好和未解决的问题，不要编造信息。"},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            self.accountant.record(self.accountant.start_query(), response.usage, model)
+            summary = (response.choices[0].message.content or "").strip()
+            if summary:
+                return summary[:max_chars]
+        except Exception as e:
+            memory_logger.warning(f"⚠️ LLM 摘要失败，改用抽取式摘要: {e}")
+        return ConversationMemory.extractive_summary(previous, messages, max_chars)
 
+    @staticmethod
+    def _tool_result_text(tool_result: Any) -> str:
+        """把工具结果转换为发送给 LLM 的文本"""
+        if isinstance(tool_result, dict) and "content" in tool_result:
+            content_list = tool_result["content"]
+            if isinstance(content_list, list) and len(content_list) > 0 and "text" in content_list[0]:
+                return content_list[0]["text"]
+            return json_codec.dumps_text(tool_result)
+        return str(tool_result)
+    
+    async def _tool_message_text(self, tool_name: str, arguments: Dict[str, Any], tool_result: Any) -> str:
+        """
+        发送给 LLM 的工具结果：车票查询结果先在本地筛选排序，只保留前 k 趟车；
+        没有直达车次时附上换乘方案
+        """
+        if tool_name == 'get-tickets' and not self._is_error_result(tool_result):
+            ranked = self._rank_tickets(arguments, tool_result)
+            if ranked is not None:
+                return ranked
+            transfers = await self._transfer_text(arguments, tool_result)
+            if transfers is not None:
+                return self._tool_result_text(tool_result) + "\n\n" + transfers
+        return self._tool_result_text(tool_result)
+    
+    def _ticket_criteria(self, arguments: Dict[str, Any]) -> TicketCriteria:
+        """由 get-tickets 参数和用户偏好生成筛选排序条件"""
+        return TicketCriteria.from_request(
+            arguments,
+            self.profile.profile.get('preferences', {}) if self.profile else {},
+            sort=tuple(self.config.get('ticket_ranking.sort', ["preference", "arrive", "price"])),
+            limit=self.config.get('ticket_ranking.top_k', 10)
+        )
+    
+    def _rank_tickets(self, arguments: Dict[str, Any], tool_result: Any) -> Optional[str]:
+        """按查询参数和用户偏好筛选排序 get-tickets 的结果；未启用或无法解析时返回 None"""
+        if not self.config.get('ticket_ranking.enabled', True):
+            return None
+        table = TicketTable.from_results([(tool_result, arguments.get('date', ''))])
+        if not len(table):
+            return None
+        return table.render(self._ticket_criteria(arguments))
+    
+    async def _fetch_tickets(self, from_code: str, to_code: str, date: str) -> Any:
+        """换乘搜索中的单段查询：经过工具缓存和限速，不计入常用路线"""
+        result = await self.call_tool('get-tickets', {"date": date, "fromStation": from_code, "toStation": to_code},
+                                      record_route=False)
+        return None if self._is_error_result(result) else result
+    
+    async def plan_itinerary(self, from_city: str, to_city: str, date: str,
+                             arguments: Optional[Dict[str, Any]] = None) -> List[Itinerary]:
+        """搜索 from_city → to_city 的直达和一次换乘方案（帕累托最优集，按总历时排序）"""
+        planner = ItineraryPlanner(
+            self._fetch_tickets, self.station_mapper,
+            max_hubs=self.config.get('itinerary.max_hubs', 4),
+            max_detour=self.config.get('itinerary.max_detour', 1.4),
+            min_connection=self.config.get('itinerary.min_connection_minutes', 20),
+            cross_station_connection=self.config.get('itinerary.cross_station_connection_minutes', 60),
+            max_wait=self.config.get('itinerary.max_wait_minutes', 360),
+            max_total=self.config.get('itinerary.max_total_hours', 36) * 60,
+            max_total_ratio=self.config.get('itinerary.max_total_ratio', 2.0),
+            concurrency=self.config.get('itinerary.concurrency', 8)
+        )
+        return await planner.plan(from_city, to_city, date, self._ticket_criteria(arguments or {"date": date}))
+    
+    def _ticket_fanout(self) -> TicketFanout:
+        return TicketFanout(
+            self._fetch_tickets,
+            concurrency=self.config.get('ticket_fanout.concurrency', 8),
+            max_queries=self.config.get('ticket_fanout.max_queries', 31),
+            max_days=self.config.get('ticket_fanout.max_days', 15)
+        )
+    
+    async def search_tickets(self, from_stations: List[str], to_stations: List[str],
+                             dates: List[str]) -> TicketSearchResult:
+        """
+        并发查询多个日期 × 多条路线的车票并合并为一张表（经过工具缓存和限速）；
+        每条查到车票的路线只计一次常用路线
+        """
+        result = await self._ticket_fanout().search(from_stations, to_stations, dates)
+        found = {(a, b) for (_, a, b), table in zip(result.queries, result.tables) if table is not None}
+        for a, b in found:
+            self._record_route('get-tickets', {"fromStation": a, "toStation": b})
+        return result
+    
+    async def _ticket_fanout_tool(self, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        """本地工具 get-tickets-range：批量查票后返回按日期/路线的汇总和合并排序后的车次"""
+        try:
+            from_stations, to_stations, dates = self._ticket_fanout().parse_arguments(arguments)
+            result = await self.search_tickets(from_stations, to_stations, dates)
+        except (TypeError, ValueError) as e:
+            return {"content": [{"type": "text", "text": f"Error: {e}"}], "isError": True}
+        if result.failed == len(result.queries):
+            return {"content": [{"type": "text", "text": "Error: 所有日期和路线的查询均失败"}], "isError": True}
+        criteria = self._ticket_criteria(arguments)
+        sort_key = arguments.get('sortBy') or 'price'
+        if sort_key in TicketTable.SORT_LABELS:
+            criteria.sort = (sort_key,) + tuple(key for key in criteria.sort if key.lstrip('-') != sort_key)
+        text = TicketFanout.render(result, criteria, lambda code: self.station_mapper.get_city(code) or code)
+        return {"content": [{"type": "text", "text": text}]}
+    
+    async def sellout_profile(self, from_code: Optional[str] = None, to_code: Optional[str] = None,
+                              seat: Optional[str] = None) -> List[Dict[str, Any]]:
+        """统计车票快照归档中各车次的售罄规律（先写入缓冲中的快照，扫描在线程池中执行）"""
+        archive = self.ticket_archive
+        if archive is None:
+            return []
+        await archive.flush()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, lambda: archive.sellout_profile(archive.scan(from_code, to_code, seat=seat)))
+    
+    async def _transfer_text(self, arguments: Dict[str, Any], tool_result: Any) -> Optional[str]:
+        """get-tickets 没有任何车次时搜索换乘方案；出发/到达站不是已知城市代码或没有方案时返回 None"""
+        if not self.config.get('itinerary.enabled', True):
+            return None
+        # 结果中仍有车次信息（只是格式无法解析）时不算"没有直达车"
+        if re.search(r'\b[GDCZTK]\d{1,4}\b', self._tool_result_text(tool_result)):
+            return None
+        from_city = self.station_mapper.get_city(arguments.get('fromStation', ''))
+        to_city = self.station_mapper.get_city(arguments.get('toStation', ''))
+        date = arguments.get('date', '')
+        if not from_city or not to_city or not re.match(r'^\d{4}-\d{2}-\d{2}$', date):
+            return None
+        itineraries = [it for it in await self.plan_itinerary(from_city, to_city, date, arguments) if it.transfers]
+        if not itineraries:
+            return None
+        seats = self._ticket_criteria(arguments).seats
+        top = itineraries[:self.config.get('itinerary.top_k', 5)]
+        return (f"🔁 {from_city}→{to_city} 没有直达车次，以下为一次换乘的方案（总历时、换乘次数、票价均不劣于其他方案）：\n"
+                + "\n".join(it.describe(seats) for it in top))
+    
+    def _select_model(self, query_usage: Dict[str, Any]) -> Optional[str]:
+        """选择本轮使用的模型：接近预算上限且配置了降级模型时切换到更便宜的模型，否则使用端点默认模型"""
+        if self.fallback_model and self.accountant.should_degrade(query_usage):
+            logger.info(f"💸 用量接近预算，降级使用模型: {self.fallback_model}")
+            return self.fallback_model
+        return None
+    
+    @staticmethod
+    def _fallback_answer(messages: List[Any], notice: str) -> str:
+        """预算或时间耗尽时的降级回复：返回目前最有价值的工具结果（优先车票查询结果）"""
+        tool_messages = [m for m in messages if isinstance(m, dict) and m.get('role') == 'tool']
+        ticket_messages = [m for m in tool_messages if m.get('name') in ('get-tickets', TicketFanout.TOOL_NAME)]
+        best = (ticket_messages or tool_messages or [None])[-1]
+        if best is not None:
+            return f"{notice}，以下为查询到的原始结果：\n{best['content'][:2000]}"
+        return f"{notice}，请缩小查询范围后重试。"
+    
+    @staticmethod
+    def _parse_travel_date(text: str) -> str:
+        """从文本中解析出行日期（支持 今天/明天/后天/大后天 和 YYYY-MM-DD），默认今天"""
+        match = re.search(r'(\d{4})-(\d{1,2})-(\d{1,2})', text)
+        if match:
+            year, month, day = (int(g) for g in match.groups())
+            return f"{year:04d}-{month:02d}-{day:02d}"
+        offset = 0
+        for keyword, days in (("大后天", 3), ("后天", 2), ("明天", 1), ("今天", 0)):
+            if keyword in text:
+                offset = days
+                break
+        return (datetime.now().date() + timedelta(days=offset)).strftime('%Y-%m-%d')
+    
+    async def _direct_ticket_query(self, user_message: str) -> Optional[str]:
+        """不经过 LLM 的直接查票：从问题中识别两个城市和日期后调用 get-tickets"""
+        cities = self.station_mapper.find_cities(user_message)
+        if len(cities) < 2:
+            return None
+        from_code = self.station_mapper.get_code(cities[0])
+        to_code = self.station_mapper.get_code(cities[1])
+        date = self._parse_travel_date(user_message)
+        
+        arguments = {"date": date, "fromStation": from_code, "toStation": to_code}
+        result = await self.call_tool('get-tickets', arguments)
+        if self._is_error_result(result):
+            return None
+        text = self._rank_tickets(arguments, result)
+        if text is None:
+            content = result.get('content', [])
+            text = content[0].get('text', '') if content else ''
+            transfers = await self._transfer_text(arguments, result)
+            if transfers is not None:
+                text = f"{text}\n\n{transfers}"
+        return f"🚄 {date} {cities[0]} → {cities[1]}\n{text}"
+    
+    def _start_query(self, user_input: str) -> int:
+        """在后台启动一个查询，完成后按编号打印结果"""
+        self._query_counter += 1
+        query_id = self._query_counter
+        task = asyncio.ensure_future(self._run_query(query_id, user_input))
+        self.query_tasks[query_id] = task
+        task.add_done_callback(lambda _: self.query_tasks.pop(query_id, None))
+        return query_id
+    
+    async def _run_query(self, query_id: int, user_input: str):
+        """执行一个查询并打印带编号的结果"""
+        try:
+            response = await self.chat(user_input)
+            print(f"\n🤖 [AI回复 #{query_id}]\n{response}")
+        except asyncio.CancelledError:
+            print(f"\n🛑 查询 #{query_id} 已取消")
+            raise
+        except Exception as e:
+            logger.error(f"\n❌ 查询 #{query_id} 出错: {e}", exc_info=True)
+    
+    def cancel_query(self, query_id: Optional[int] = None) -> bool:
+        """取消指定（默认最近一个）进行中的查询，连同其未完成的 LLM 和 MCP 请求"""
+        if not self.query_tasks:
+            return False
+        if query_id is None:
+            query_id = max(self.query_tasks)
+        task = self.query_tasks.get(query_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+    
+    async def _cancel_all_queries(self):
+        """取消所有进行中的查询并等待其结束"""
+        tasks = list(self.query_tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _on_sigint(self, loop_task: asyncio.Task):
+        """Ctrl-C：有查询在运行时只取消最近的查询，否则退出对话循环"""
+        if self.cancel_query():
+            print("\n⏹️ 已发送取消请求（再次 Ctrl-C 取消下一个，输入 quit 退出）")
+        else:
+            loop_task.cancel()
+    
     async def chat_loop(self):
-        """交互式对话循环（增强版）- Python 3.7+ 兼容"""
+        """交互式对话循环（增强版）：查询在后台并发执行，可随时输入新问题或取消进行中的查询"""
         print("\n" + "="*70)
         print("🚄 12306-MCP 智能火车票查询助手 V2.0")
         print("="*70)
@@ -825,110 +5274,221 @@ class Train12306MCPClient:
         print("💡 输入 'clear' 清空当前会话")
         print("💡 输入 'profile' 查看用户配置")
         print("💡 输入 'history' 查看对话历史")
+        print("💡 输入 'stats' 查看用量统计")
+        print("💡 输入 'jobs' 查看进行中的查询，'cancel [编号]' 取消查询（Ctrl-C 取消最近的查询）")
+        if self.ticket_archive is not None:
+            print("💡 输入 'sellout [出发站代码 到达站代码]' 查看归档快照中的售罄规律")
         print("="*70 + "\n")
         
-        while True:
-            try:
-                # 使用兼容的异步输入函数
-                user_input = await async_input("\n❓ 请输入问题: ")
-                
-                if user_input.lower() in ['quit', 'exit', 'q']:
-                    print("\n👋 再见!")
+        max_concurrent = self.config.get('chat.max_concurrent_queries', 3)
+        loop = asyncio.get_event_loop()
+        
+        # Unix 下接管 Ctrl-C，只取消查询而不是结束整个程序；Windows 不支持时保持原有行为
+        sigint_installed = False
+        try:
+            loop.add_signal_handler(signal.SIGINT, self._on_sigint, asyncio.current_task())
+            sigint_installed = True
+        except (NotImplementedError, RuntimeError):
+            pass
+        
+        try:
+            while True:
+                try:
+                    # 使用兼容的异步输入函数
+                    user_input = await async_input("\n❓ 请输入问题: ")
+                    command = user_input.strip().lower()
+                    
+                    if command in ['quit', 'exit', 'q']:
+                        print("\n👋 再见!")
+                        break
+                    
+                    if command == 'tools':
+                        print("\n📋 可用工具:")
+                        for i, tool in enumerate(self.tools_cache, 1):
+                            func = tool['function']
+                            print(f"{i}. {func['name']}")
+                            print(f"   {func['description'][:80]}...")
+                        continue
+                    
+                    if command == 'clear':
+                        if self.memory:
+                            self.memory.clear_session()
+                            self._schedule_compaction()
+                            print("✅ 当前会话已清空")
+                        os.system('cls' if os.name == 'nt' else 'clear')
+                        continue
+                    
+                    if command == 'profile':
+                        if self.profile:
+                            print("\n👤 用户配置:")
+                            print(json.dumps(self.profile.profile, ensure_ascii=False, indent=2))
+                        else:
+                            print("⚠️ 用户配置未启用")
+                        continue
+                    
+                    if command == 'history':
+                        if self.memory:
+                            print("\n📚 对话历史:")
+                            print(f"当前会话消息数: {len(self.memory.current_session)}")
+                            print(f"历史会话数: {len(self.memory.history)}")
+                        else:
+                            print("⚠️ 对话记忆未启用")
+                        continue
+                    
+                    if command == 'stats':
+                        print("\n📊 用量统计:")
+                        print(json.dumps(self.get_stats(), ensure_ascii=False, indent=2))
+                        continue
+                    
+                    if command == 'jobs':
+                        if self.query_tasks:
+                            print(f"\n⏳ 进行中的查询: {', '.join(f'#{n}' for n in sorted(self.query_tasks))}")
+                        else:
+                            print("\n✅ 没有进行中的查询")
+                        continue
+                    
+                    if command == 'cancel' or command.startswith('cancel '):
+                        arg = command[len('cancel'):].strip().lstrip('#')
+                        query_id = int(arg) if arg.isdigit() else None
+                        if not self.cancel_query(query_id):
+                            print("⚠️ 没有可取消的查询")
+                        continue
+                    
+                    if command == 'sellout' or command.startswith('sellout '):
+                        if self.ticket_archive is None:
+                            print("⚠️ 车票快照归档未启用（ticket_archive.enabled）")
+                            continue
+                        codes = user_input.strip().split()[1:3]
+                        profile = await self.sellout_profile(*(code.upper() for code in codes))
+                        print(f"\n📈 售罄规律（{' → '.join(codes) or '全部路线'}）:")
+                        for row in profile[:20]:
+                            median = row['median_hours_before']
+                            print(f"  {row['train']} {row['seat']}: 观察 {row['departures']} 个班次，"
+                                  f"售罄 {row['sold_out']} 个" + (f"，中位数为发车前 {median:.1f} 小时" if median is not None else ""))
+                        if not profile:
+                            print("  （暂无快照）")
+                        continue
+                    
+                    if not command:
+                        continue
+                    
+                    if len(self.query_tasks) >= max_concurrent:
+                        print(f"⚠️ 已有 {len(self.query_tasks)} 个查询在运行，请等待完成或取消后再提交")
+                        continue
+                    
+                    # 在后台处理用户查询，立即返回继续接收输入
+                    query_id = self._start_query(user_input)
+                    print(f"🚀 查询 #{query_id} 已提交")
+                    
+                except (KeyboardInterrupt, EOFError):
+                    print("\n\n👋 检测到退出信号")
                     break
-                
-                if user_input.lower() == 'tools':
-                    print("\n📋 可用工具:")
-                    for i, tool in enumerate(self.tools_cache, 1):
-                        func = tool['function']
-                        print(f"{i}. {func['name']}")
-                        print(f"   {func['description'][:80]}...")
-                    continue
-                
-                if user_input.lower() == 'clear':
-                    if self.memory:
-                        self.memory.clear_session()
-                        print("✅ 当前会话已清空")
-                    os.system('cls' if os.name == 'nt' else 'clear')
-                    continue
-                
-                if user_input.lower() == 'profile':
-                    if self.profile:
-                        print("\n👤 用户配置:")
-                        print(json.dumps(self.profile.profile, ensure_ascii=False, indent=2))
-                    else:
-                        print("⚠️ 用户配置未启用")
-                    continue
-                
-                if user_input.lower() == 'history':
-                    if self.memory:
-                        print("\n📚 对话历史:")
-                        print(f"当前会话消息数: {len(self.memory.current_session)}")
-                        print(f"历史会话数: {len(self.memory.history)}")
-                    else:
-                        print("⚠️ 对话记忆未启用")
-                    continue
-                
-                if not user_input.strip():
-                    continue
-                
-                # 处理用户查询
-                response = await self.chat(user_input)
-                print(f"\n🤖 [AI回复]\n{response}")
-                
-            except (KeyboardInterrupt, EOFError):
-                print("\n\n👋 检测到退出信号")
-                break
-            except Exception as e:
-                logging.error(f"\n❌ 错误: {e}", exc_info=True)
+                except asyncio.CancelledError:
+                    print("\n\n👋 检测到退出信号")
+                    break
+                except Exception as e:
+                    logger.error(f"\n❌ 错误: {e}", exc_info=True)
+        finally:
+            if sigint_installed:
+                loop.remove_signal_handler(signal.SIGINT)
+            await self._cancel_all_queries()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """汇总运行统计：Token 用量、工具缓存命中情况、LLM 端点和 MCP 服务器状态"""
+        return {
+            "tokens": self.accountant.summary(),
+            "tool_cache": {
+                "hits": self.tool_cache.hits,
+                "misses": self.tool_cache.misses
+            },
+            "llm": self.llm_router.stats(),
+            "mcp_servers": [server.stats() for server in self.servers],
+            "ticket_snapshots": self.ticket_archive.snapshots_written if self.ticket_archive is not None else None,
+            "tool_routing": self.tool_selector.stats() if self.tool_selector is not None else None,
+            "speculation": self.speculation.stats() if self.speculation is not None else None
+        }
     
     async def cleanup(self):
         """清理资源（增强版）"""
         self.is_connected = False
         
-        if self.heartbeat_task and not self.heartbeat_task.done():
-            self.heartbeat_task.cancel()
+        if self.config_watch_task and not self.config_watch_task.done():
+            self.config_watch_task.cancel()
+            try:
+                await self.config_watch_task
+            except asyncio.CancelledError:
+                pass
+        self.config_watch_task = None
+        
+        if self.compaction_task and not self.compaction_task.done():
+            self.compaction_task.cancel()
             try:
-                await self.heartbeat_task
+                await self.compaction_task
             except asyncio.CancelledError:
                 pass
+        self.compaction_task = None
         
-        if self.sse_task and not self.sse_task.done():
-            self.sse_task.cancel()
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
             try:
-                await self.sse_task
+                await self.prefetch_task
             except asyncio.CancelledError:
                 pass
         
-        # 保存记忆
+        if self.speculation is not None:
+            await self.speculation.close()
+        
+        for task in self._server_connect_tasks:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._server_connect_tasks = []
+        
+        # 保存记忆（等待后台保存完成并落盘剩余变化）
         if self.memory:
-            self.memory.save_history()
+            await self.memory.close()
+        
+        if self.ticket_archive is not None:
+            await self.ticket_archive.flush()
         
-        # 保存用户配置
+        # 保存录制的流量
+        if self.cassette is not None:
+            self.cassette.save()
+        
+        # 保存用户配置（等待后台写入完成并落盘剩余修改）
         if self.profile:
-            self.profile.save()
+            await self.profile.close()
         
-        if self.session and not self.session.closed:
-            await self.session.close()
-            logging.info("✅ 连接已关闭")
+        await asyncio.gather(*(server.close() for server in self.servers))
+        await self.http_client.aclose()
+        self.tool_cache.backend.close()
+        logger.info("✅ 连接已关闭")
 
 
 async def main():
     """主函数"""
     config_path = os.getenv('CONFIG_PATH', 'config.json')
     
-    client = Train12306MCPClient(config_path)
+    try:
+        client = Train12306MCPClient(config_path)
+    except ValueError as e:
+        # 配置无效或缺少 API Key：直接退出
+        raise SystemExit(f"❌ 启动失败: {e}")
     
     try:
         await client.connect()
         
         if not client.tools_cache:
-            logging.warning("⚠️ 警告: 未能获取工具列表")
+            logger.warning("⚠️ 警告: 未能获取工具列表")
             return
         
         await client.chat_loop()
         
     except Exception as e:
-        logging.error(f"❌ 程序错误: {e}", exc_info=True)
+        logger.error(f"❌ 程序错误: {e}", exc_info=True)
     finally:
         await client.cleanup()
 
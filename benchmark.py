@@ -0,0 +1,799 @@
+#!/usr/bin/env python3
+"""
+性能基准：测量客户端各组件的开销，不需要 MCP 服务器和 API Key
+
+用法:
+    python benchmark.py                 # 运行全部基准
+    python benchmark.py cache json      # 只运行指定的基准（cache / json / compression / memory / tickets / snapshots / tools）
+    python benchmark.py cache --quick   # 减少迭代次数，快速检查
+    python benchmark.py > bench_output.txt
+"""
+
+import argparse
+import asyncio
+import gzip
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+from client_loader import load_client_module
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+client_module = load_client_module()
+
+
+def print_table(title: str, headers: List[str], rows: List[List[Any]]):
+    widths = [max(len(str(h)), *(len(str(row[i])) for row in rows)) + 2 for i, h in enumerate(headers)]
+    print(f"\n## {title}")
+    print("".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    print("-" * sum(widths))
+    for row in rows:
+        print("".join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+# ---------------------------------------------------------------------------
+# 工具结果缓存
+# ---------------------------------------------------------------------------
+
+SAMPLE_TICKETS = {
+    "content": [{
+        "type": "text",
+        "text": "\n".join(
+            f"G{100 + i} 北京南(BJP) -> 上海虹桥(AOH) 0{i % 10}:00 -> 1{i % 10}:30 历时 05:30 "
+            f"商务座: 有票 1748元 一等座: 有票 933元 二等座: 有票 553元"
+            for i in range(20)
+        )
+    }]
+}
+TTL = {"get-tickets": 300}
+
+
+def make_backend(kind: str, path: str, max_entries: int = 512):
+    if kind == "sqlite":
+        return client_module.SQLiteCacheBackend(path, max_entries)
+    return client_module.MemoryCacheBackend(max_entries)
+
+
+def bench_cache_hit_latency(kind: str, path: str, iterations: int) -> Dict[str, float]:
+    """单进程命中延迟：反复读取同一批已缓存的车票结果"""
+    cache = client_module.ToolResultCache(TTL, 512, backend=make_backend(kind, path))
+    arguments = [{"date": "2026-10-20", "fromStation": "BJP", "toStation": f"S{i:02d}"} for i in range(50)]
+    for args in arguments:
+        cache.set("get-tickets", args, SAMPLE_TICKETS)
+
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        cache.get("get-tickets", arguments[i % len(arguments)])
+        samples.append(time.perf_counter() - started)
+    cache.backend.close()
+    return {
+        "mean_us": statistics.mean(samples) * 1e6,
+        "p50_us": percentile(samples, 0.5) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6
+    }
+
+
+def _cache_worker(kind: str, path: str, seed: int, ops: int, keys: int, concurrency: int,
+                  compute_seconds: float, barrier, results):
+    """多进程吞吐测试的工作进程：并发执行 get_or_compute，统计实际计算次数"""
+    cache = client_module.ToolResultCache(TTL, 512, backend=make_backend(kind, path), lease_seconds=5.0)
+    rng = random.Random(seed)
+    plan = [rng.randrange(keys) for _ in range(ops)]
+    computes = [0]
+
+    async def compute():
+        computes[0] += 1
+        await asyncio.sleep(compute_seconds)
+        return SAMPLE_TICKETS
+
+    async def run():
+        queue = list(plan)
+
+        async def lane():
+            while queue:
+                key = queue.pop()
+                await cache.get_or_compute(
+                    "get-tickets", {"date": "2026-10-20", "fromStation": "BJP", "toStation": f"S{key:02d}"},
+                    compute, lambda value: True
+                )
+
+        await asyncio.gather(*(lane() for _ in range(concurrency)))
+
+    barrier.wait()
+    started = time.perf_counter()
+    asyncio.run(run())
+    results.put((time.perf_counter() - started, computes[0]))
+    cache.backend.close()
+
+
+def bench_cache_throughput(kind: str, path: str, processes: int, ops: int, keys: int,
+                           concurrency: int = 8, compute_seconds: float = 0.02) -> Dict[str, float]:
+    """多进程吞吐：多个进程以随机顺序请求同一批键，比较总吞吐和实际调用工具的次数"""
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(processes)
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=_cache_worker, args=(kind, path, seed, ops, keys, concurrency,
+                                                compute_seconds, barrier, results))
+        for seed in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    elapsed = max(e for e, _ in outcomes)
+    return {
+        "ops_per_sec": processes * ops / elapsed,
+        "tool_calls": sum(c for _, c in outcomes),
+        "ideal_calls": keys
+    }
+
+
+def run_cache(quick: bool):
+    iterations = 2000 if quick else 20000
+    processes, ops, keys = (2, 100, 20) if quick else (4, 500, 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = []
+        for kind in ("memory", "sqlite"):
+            result = bench_cache_hit_latency(kind, os.path.join(tmp, f"hit-{kind}.sqlite3"), iterations)
+            rows.append([kind, f"{result['mean_us']:.1f}", f"{result['p50_us']:.1f}", f"{result['p99_us']:.1f}"])
+        print_table(f"缓存命中延迟（{iterations} 次读取）", ["后端", "平均(µs)", "P50(µs)", "P99(µs)"], rows)
+
+        rows = []
+        for kind in ("memory", "sqlite"):
+            result = bench_cache_throughput(kind, os.path.join(tmp, f"mp-{kind}.sqlite3"), processes, ops, keys)
+            rows.append([kind, f"{result['ops_per_sec']:.0f}", result["tool_calls"], result["ideal_calls"]])
+        print_table(
+            f"多进程吞吐（{processes} 进程 × {ops} 次，{keys} 个键，每次工具调用 20ms）",
+            ["后端", "吞吐(次/秒)", "实际工具调用", "理想工具调用"], rows
+        )
+
+
+# ---------------------------------------------------------------------------
+# JSON 编解码
+# ---------------------------------------------------------------------------
+
+def make_ticket_rows(count: int) -> List[Dict[str, Any]]:
+    """结构化的车票数据（与 MCP 服务器 get-tickets 返回的字段一致）"""
+    rows = []
+    for i in range(count):
+        rows.append({
+            "train_no": f"24000G{100 + i:04d}",
+            "start_train_code": f"G{100 + i}",
+            "start_time": f"{6 + i % 16:02d}:{i * 7 % 60:02d}",
+            "arrive_time": f"{11 + i % 12:02d}:{i * 13 % 60:02d}",
+            "lishi": "05:30",
+            "from_station": "北京南", "to_station": "上海虹桥",
+            "from_station_telecode": "VNP", "to_station_telecode": "AOH",
+            "prices": [
+                {"seat_name": "商务座", "short": "swz", "num": "有", "price": 1748.0, "discount": None},
+                {"seat_name": "一等座", "short": "zy", "num": str(i % 20), "price": 933.0, "discount": None},
+                {"seat_name": "二等座", "short": "ze", "num": "有", "price": 553.0, "discount": None}
+            ],
+            "dw_flag": ["复兴号", "智能动车组"]
+        })
+    return rows
+
+
+def make_json_payloads() -> Dict[str, Any]:
+    """各编解码路径上的典型数据"""
+    rows = make_ticket_rows(120)
+    text = "\n".join(
+        f"{r['start_train_code']} {r['from_station']}({r['from_station_telecode']}) -> {r['to_station']}"
+        f"({r['to_station_telecode']}) {r['start_time']} -> {r['arrive_time']} 历时 {r['lishi']} "
+        + " ".join(f"{p['seat_name']}: {p['num']} {p['price']:.0f}元" for p in r["prices"])
+        for r in rows
+    )
+    response = {"jsonrpc": "2.0", "id": 7, "result": {"content": [{"type": "text", "text": text}]}}
+    sessions = [
+        {
+            "timestamp": f"2026-10-{1 + s % 28:02d}T10:00:00",
+            "summary": "北京到上海的高铁查询，偏好二等座",
+            "messages": [
+                {"role": "user" if m % 2 == 0 else "assistant",
+                 "content": f"第{m}条消息：明天北京到上海的高铁还有二等座吗？" * (1 if m % 2 == 0 else 6),
+                 "timestamp": "2026-10-19T10:00:00"}
+                for m in range(20)
+            ]
+        }
+        for s in range(50)
+    ]
+    profile = {
+        "user_id": "default_user",
+        "preferences": {"default_departure_city": "深圳", "preferred_seat_type": "二等座",
+                        "preferred_train_types": ["G", "D"]},
+        "frequent_routes": [
+            {"from": f"城市{i}", "to": f"城市{i + 1}", "count": i, "last_used": "2026-10-19T10:00:00"}
+            for i in range(30)
+        ],
+        "token_usage": {f"2026-10-{d:02d}": {"prompt": 12000 + d, "completion": 800 + d} for d in range(1, 29)}
+    }
+    request = {"jsonrpc": "2.0", "id": 8, "method": "tools/call",
+               "params": {"name": "get-tickets",
+                          "arguments": {"date": "2026-10-20", "fromStation": "VNP", "toStation": "AOH",
+                                        "trainFilterFlags": "GD", "sortFlag": "startTime"}}}
+    return {
+        "request": request,
+        "response": response,
+        "structured": {"content": [{"type": "json", "data": rows}]},
+        "history": sessions,
+        "profile": profile
+    }
+
+
+def json_cases(codec, payloads: Dict[str, Any]) -> List[Any]:
+    """(名称, 数据大小, 被测函数)：覆盖 RPC 请求/响应、工具结果文本、历史和用户配置的编解码"""
+    response_bytes = codec.dumps(payloads["response"])
+    sse_bytes = b"event: message\ndata: " + response_bytes + b"\n\n"
+    history_bytes = codec.dumps(payloads["history"], indent=True)
+    profile_bytes = codec.dumps(payloads["profile"], indent=True)
+    parse = client_module.MCPServerConnection._parse_sse_response
+    return [
+        ("RPC 请求编码", len(codec.dumps(payloads["request"])), lambda: codec.dumps(payloads["request"])),
+        ("RPC 响应解码 (JSON)", len(response_bytes), lambda: parse(response_bytes)),
+        ("RPC 响应解码 (SSE)", len(sse_bytes), lambda: parse(sse_bytes)),
+        ("结构化工具结果转文本", len(codec.dumps(payloads["structured"])),
+         lambda: codec.dumps_text(payloads["structured"])),
+        ("对话历史保存 (indent)", len(history_bytes), lambda: codec.dumps(payloads["history"], indent=True)),
+        ("对话历史加载", len(history_bytes), lambda: codec.loads(history_bytes)),
+        ("用户配置保存 (indent)", len(profile_bytes), lambda: codec.dumps(payloads["profile"], indent=True)),
+        ("用户配置加载", len(profile_bytes), lambda: codec.loads(profile_bytes))
+    ]
+
+
+def time_call(func: Callable[[], Any], min_seconds: float) -> float:
+    """每次调用的耗时（秒）：先估算循环次数，再取多轮中的最小值"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_seconds / 5:
+            break
+        number *= 2
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def run_json(quick: bool):
+    min_seconds = 0.05 if quick else 0.5
+    payloads = make_json_payloads()
+    codecs = [name for name in ("json", "orjson", "msgspec")
+              if name == "json" or getattr(client_module, name) is not None]
+    original = client_module.json_codec
+
+    results: Dict[str, List[Any]] = {}
+    try:
+        for name in codecs:
+            codec = client_module.set_json_codec(name)
+            for case, size, func in json_cases(codec, payloads):
+                results.setdefault(case, [f"{size / 1024:.1f}"]).append(time_call(func, min_seconds))
+    finally:
+        client_module.json_codec = original
+
+    rows = []
+    for case, (size, *timings) in results.items():
+        row = [case, size] + [f"{t * 1e6:.1f}" for t in timings]
+        if len(timings) > 1:
+            row.append(f"{timings[0] / min(timings[1:]):.1f}x")
+        rows.append(row)
+    headers = ["路径", "大小(KB)"] + [f"{name}(µs)" for name in codecs]
+    if len(codecs) > 1:
+        headers.append("加速")
+    print_table(f"JSON 编解码（可用实现: {', '.join(codecs)}）", headers, rows)
+
+
+# ---------------------------------------------------------------------------
+# 压缩：传输与历史归档
+# ---------------------------------------------------------------------------
+
+def response_codecs() -> List[Any]:
+    """(名称, 压缩函数, 解压函数)：解压方式与 aiohttp 处理 Content-Encoding 时一致"""
+    codecs = [
+        ("gzip-1", lambda data: gzip.compress(data, compresslevel=1),
+         lambda data: zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)),
+        ("gzip-6", lambda data: gzip.compress(data, compresslevel=6),
+         lambda data: zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)),
+        ("deflate", lambda data: zlib.compress(data, 6), lambda data: zlib.decompressobj().decompress(data))
+    ]
+    try:
+        import brotli
+        codecs.append(("br-5", lambda data: brotli.compress(data, quality=5), brotli.decompress))
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        compressor, decompressor = zstandard.ZstdCompressor(level=3), zstandard.ZstdDecompressor()
+        codecs.append(("zstd-3", compressor.compress, decompressor.decompress))
+    except ImportError:
+        pass
+    return codecs
+
+
+def bench_transport(min_seconds: float) -> List[List[Any]]:
+    payloads = make_json_payloads()
+    bodies = {
+        "车票响应 (文本)": client_module.json_codec.dumps(payloads["response"]),
+        "车票响应 (结构化)": client_module.json_codec.dumps(payloads["structured"]),
+        "tools/call 请求": client_module.json_codec.dumps(payloads["request"])
+    }
+    rows = []
+    for label, body in bodies.items():
+        for name, compress, decompress in response_codecs():
+            packed = compress(body)
+            rows.append([
+                label, name, f"{len(body) / 1024:.1f}", f"{len(packed) / 1024:.1f}",
+                f"{(1 - len(packed) / len(body)) * 100:.0f}%",
+                f"{time_call(lambda: compress(body), min_seconds) * 1e6:.0f}",
+                f"{time_call(lambda: decompress(packed), min_seconds) * 1e6:.0f}"
+            ])
+    return rows
+
+
+def bench_archive(sessions: int, tmp: str) -> List[List[Any]]:
+    history = make_json_payloads()["history"]
+    history = (history * (sessions // len(history) + 1))[:sessions]
+    plain = client_module.json_codec.dumps(history, indent=True)
+    rows = [["历史文件 (indent JSON)", f"{len(plain) / 1024:.0f}", "-", "-", "-"]]
+    for fmt in client_module.HistoryArchive.FORMATS:
+        archive = client_module.HistoryArchive(os.path.join(tmp, fmt), fmt)
+        started = time.perf_counter()
+        segment = archive.append(history)
+        write_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        count = sum(1 for _ in archive.iter_sessions())
+        read_ms = (time.perf_counter() - started) * 1000
+        assert count == sessions
+        size = segment.stat().st_size
+        rows.append([f"归档分段 ({fmt})", f"{size / 1024:.0f}", f"{(1 - size / len(plain)) * 100:.0f}%",
+                     f"{write_ms:.1f}", f"{read_ms:.1f}"])
+    return rows
+
+
+def run_compression(quick: bool):
+    min_seconds = 0.05 if quick else 0.3
+    print_table(
+        f"传输压缩（{client_module.accept_encoding_header('auto')} 可自动解压）",
+        ["数据", "编码", "原始(KB)", "压缩后(KB)", "节省", "压缩(µs)", "解压(µs)"],
+        bench_transport(min_seconds)
+    )
+    sessions = 50 if quick else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        print_table(
+            f"历史归档（{sessions} 个会话，流式读取）",
+            ["存储", "大小(KB)", "节省", "写入(ms)", "读取(ms)"],
+            bench_archive(sessions, tmp)
+        )
+
+
+# ---------------------------------------------------------------------------
+# 会话记忆：消息存储的内存占用
+# ---------------------------------------------------------------------------
+
+def make_dialogues(sessions: int, turns: int) -> List[List[str]]:
+    """每个会话 turns 轮问答的正文（各不相同的字符串，两种存储共享同一批对象）"""
+    return [
+        [f"会话{s}第{i}条：" + ("明天北京到上海的高铁还有二等座吗？" if i % 2 == 0 else "G1 07:00 二等座有票 553元；G3 08:00 无票") * 2
+         for i in range(turns * 2)]
+        for s in range(sessions)
+    ]
+
+
+def legacy_session(contents: List[str]) -> List[Dict[str, str]]:
+    """旧的表示：每条消息一个字典，带 ISO 时间戳字符串"""
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": content,
+             "timestamp": datetime.now().isoformat()} for i, content in enumerate(contents)]
+
+
+def compact_session(contents: List[str]):
+    log = client_module.MessageLog()
+    for i, content in enumerate(contents):
+        log.append("user" if i % 2 == 0 else "assistant", content)
+    return log
+
+
+def allocated_bytes(build: Callable[[], Any]) -> int:
+    """build() 新分配且仍然存活的字节数"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_message_store(sessions: int, turns: int, window: int) -> List[List[Any]]:
+    dialogues = make_dialogues(sessions, turns)
+    messages = sessions * turns * 2
+    content_bytes = sum(sys.getsizeof(c) for contents in dialogues for c in contents)
+    legacy = allocated_bytes(lambda: [legacy_session(contents) for contents in dialogues])
+    compact = allocated_bytes(lambda: [compact_session(contents) for contents in dialogues])
+    logs = [compact_session(contents) for contents in dialogues]
+    views = allocated_bytes(lambda: [log.llm_view(window) for log in logs])
+    scale = 10000 / sessions
+    rows = [["消息正文（两种存储共享）", f"{content_bytes * scale / 2 ** 20:.1f}", f"{content_bytes / messages:.0f}", "-"]]
+    for label, size in (("字典 + ISO 时间戳（旧）", legacy), ("MessageLog", compact), (f"MessageLog + 查询中的 LLM 视图（{window} 条）", compact + views)):
+        rows.append([label, f"{size * scale / 2 ** 20:.1f}", f"{size / messages:.0f}", f"{size / legacy:.2f}x"])
+    return rows
+
+
+def bench_session_access(window: int, min_seconds: float) -> List[List[Any]]:
+    contents = make_dialogues(1, window)[0]
+    legacy = legacy_session(contents)
+    log = compact_session(contents)
+    legacy_store: List[Dict[str, str]] = []
+    compact_store = client_module.MessageLog()
+
+    def legacy_view():
+        messages = legacy[-window:] if len(legacy) > window else legacy
+        return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+
+    def uncached_view():
+        log._view = None
+        return log.llm_view(window)
+
+    return [[label, f"{time_call(func, min_seconds) * 1e6:.2f}"] for label, func in (
+        ("add_message（字典 + ISO 时间戳，旧）", lambda: legacy_store.append(
+            {"role": "user", "content": contents[0], "timestamp": datetime.now().isoformat()})),
+        ("add_message（MessageLog）", lambda: compact_store.append("user", contents[0])),
+        (f"get_current_session 重建 {window} 条（旧）", legacy_view),
+        ("get_current_session 追加后首次（新）", uncached_view),
+        ("get_current_session 缓存命中（新）", lambda: log.llm_view(window))
+    )]
+
+
+CITIES = ["北京", "上海", "广州", "深圳", "杭州", "南京", "成都", "武汉", "西安", "郑州", "重庆", "天津", "长沙", "沈阳"]
+
+
+def make_travel_memory(sessions: int, tmp: str):
+    """sessions 个单轮查票会话（随机城市对和问法），全部放在历史中（不落盘）"""
+    rng = random.Random(7)
+    memory = client_module.ConversationMemory(os.path.join(tmp, "history.json"), max_sessions=sessions)
+    for n in range(sessions):
+        a, b = rng.sample(CITIES, 2)
+        question = rng.choice([f"{a}到{b}明天的高铁", f"查一下{a}去{b}的二等座",
+                               f"后天从{a}出发到{b}有票吗", f"{a}到{b}最便宜的车次"])
+        log = client_module.MessageLog()
+        log.append("user", question)
+        log.append("assistant", f"为您找到{a}到{b}的车次 G{n % 900}")
+        memory.history.append({"session_id": f"s{n}", "messages": log})
+    return memory
+
+
+def bench_history_retrieval(sessions: int, queries: int, tmp: str) -> List[List[Any]]:
+    memory = make_travel_memory(sessions, tmp)
+    rng = random.Random(11)
+    pairs = [rng.sample(CITIES, 2) for _ in range(queries)]
+    questions = [f"{a}到{b}下周五还有卧铺吗" for a, b in pairs]
+    started = time.perf_counter()
+    index = memory.build_index()
+    build_ms = (time.perf_counter() - started) * 1000
+
+    def measure(get_context: Callable[[str], str]) -> List[Any]:
+        started = time.perf_counter()
+        contexts = [get_context(question) for question in questions]
+        elapsed = (time.perf_counter() - started) / queries
+        tokens = statistics.mean(index.estimate_tokens(context) for context in contexts)
+        # 注入的片段中同时提到本次出发、到达城市的比例
+        relevant = statistics.mean(
+            (sum(1 for line in context.splitlines()[2:] if a in line and b in line) /
+             max(1, len(context.splitlines()[2:]))) for context, (a, b) in zip(contexts, pairs))
+        return [f"{elapsed * 1000:.2f}", f"{tokens:.0f}", f"{relevant * 100:.0f}%"]
+
+    rows = [[f"{sessions:,}", "最近 3 个会话", "-"] + measure(lambda q: memory.get_recent_context(3))]
+    backends = [("numpy", client_module.np), ("python", None)] if client_module.np is not None else [("python", None)]
+    original = client_module.np
+    try:
+        for name, module in backends:
+            client_module.np = module
+            rows.append([f"{sessions:,}", f"BM25 检索（{name}）", f"{build_ms:.0f}"] +
+                        measure(lambda q: memory.get_relevant_context(q, 300, 5)))
+    finally:
+        client_module.np = original
+    return rows
+
+
+def run_memory(quick: bool):
+    sessions = 2000 if quick else 10000
+    turns, window = 6, 20
+    print_table(
+        f"消息存储内存（按每 10k 个会话换算，实测 {sessions} 个会话 × {turns * 2} 条消息）",
+        ["表示", "每 10k 会话(MB)", "每条消息(B)", "相对旧格式"],
+        bench_message_store(sessions, turns, window)
+    )
+    # 视图只在查询进行中存在：回答写入记忆（追加消息）时即被释放，空闲的会话只保留紧凑的列存储
+    print_table("会话访问耗时", ["操作", "耗时(µs)"], bench_session_access(window, 0.05 if quick else 0.3))
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in ((1000, 10000) if quick else (1000, 10000, 50000)):
+            rows.extend(bench_history_retrieval(count, 50, tmp))
+    print_table(
+        "历史对话注入：最近会话 vs 按当前问题检索（token 为估算值）",
+        ["历史会话数", "方式", "建索引(ms)", "每次查询(ms)", "注入 token", "同路线片段占比"],
+        rows
+    )
+
+
+# ---------------------------------------------------------------------------
+# 车票结果筛选排序
+# ---------------------------------------------------------------------------
+
+def make_ticket_text(rows: List[Dict[str, Any]]) -> str:
+    """12306-mcp get-tickets 的文本格式"""
+    lines = ["车次|出发站 -> 到达站|出发时间 -> 到达时间|历时"]
+    for r in rows:
+        lines.append(f"{r['start_train_code']}(实际车次train_no: {r['train_no']}) {r['from_station']}"
+                     f"(telecode: {r['from_station_telecode']}) -> {r['to_station']}(telecode: {r['to_station_telecode']}) "
+                     f"{r['start_time']} -> {r['arrive_time']} 历时：{r['lishi']}")
+        for p in r["prices"]:
+            status = "有票" if p["num"] == "有" else (f"剩余{p['num']}张票" if p["num"] != "0" else "无票")
+            lines.append(f"- {p['seat_name']}: {status} {p['price']}元")
+    return "\n".join(lines)
+
+
+def make_ticket_results(days: int, routes: int) -> List[Any]:
+    """days 天 × routes 条路线的 get-tickets 结果（每次 120 趟车，时刻和历时各不相同）"""
+    results = []
+    for d in range(days):
+        for r in range(routes):
+            rows = make_ticket_rows(120)
+            for i, row in enumerate(rows):
+                row["start_time"] = f"{(i * 7 + r * 3) % 24:02d}:{(i * 11 + d) % 60:02d}"
+                row["lishi"] = f"{2 + (i + r) % 10:02d}:{i * 13 % 60:02d}"
+            text = make_ticket_text(rows)
+            results.append(({"content": [{"type": "text", "text": text}]}, f"2026-10-{20 + d:02d}"))
+    return results
+
+
+def bench_ticket_ranking(days: int, routes: int, min_seconds: float) -> List[List[Any]]:
+    Table, Criteria = client_module.TicketTable, client_module.TicketCriteria
+    results = make_ticket_results(days, routes)
+    criteria = Criteria.from_request({"earliestStartTime": 7}, {"preferred_seat_type": "二等座",
+                                                                "preferred_train_types": ["G", "D"]})
+    raw_chars = sum(len(result["content"][0]["text"]) for result, _ in results)
+    backends = [("numpy", client_module.np), ("python", None)] if client_module.np is not None else [("python", None)]
+    rows = []
+    original = client_module.np
+    try:
+        for name, module in backends:
+            client_module.np = module
+            table = Table.from_results(results)
+            parse = time_call(lambda: Table.from_results(results), min_seconds)
+            select = time_call(lambda: table.select(criteria), min_seconds)
+            rendered = table.render(criteria)
+            rows.append([f"{days} 天 × {routes} 条路线", len(table), name, f"{parse * 1000:.2f}",
+                         f"{select * 1000:.3f}", f"{raw_chars / 1024:.0f}", f"{len(rendered) / 1024:.1f}"])
+    finally:
+        client_module.np = original
+    return rows
+
+
+def run_tickets(quick: bool):
+    min_seconds = 0.05 if quick else 0.3
+    scales = [(1, 1), (7, 1), (7, 9)] if quick else [(1, 1), (7, 1), (7, 9), (30, 9)]
+    rows = []
+    for days, routes in scales:
+        rows.extend(bench_ticket_ranking(days, routes, min_seconds))
+    print_table(
+        "车票结果筛选排序（二等座有票、7 点后出发，偏好车型 > 最早到达 > 票价，取前 10 趟）",
+        ["结果集", "车次数", "实现", "解析建表(ms)", "筛选排序(ms)", "原始文本(KB)", "交给 LLM(KB)"],
+        rows
+    )
+
+
+# ---------------------------------------------------------------------------
+# 车票快照归档
+# ---------------------------------------------------------------------------
+
+def make_snapshot_batches(routes: int, days: int, polls: int, batch: int = 50) -> List[List[Any]]:
+    """
+    routes 条路线 × days 个出行日期，每个日期在发车前每 6 小时轮询一次、共 polls 次
+    （每次 120 趟车 × 3 个席别，一等座余票随轮询递减直至售罄），按 batch 个结果一批
+    """
+    texts = []
+    for p in range(polls):
+        rows = make_ticket_rows(120)
+        for i, row in enumerate(rows):
+            row["prices"][1]["num"] = str(max(0, (i % 20) * 3 - p * 2))
+        texts.append({"content": [{"type": "text", "text": make_ticket_text(rows)}]})
+    results = []
+    for d in range(days):
+        date = f"2026-11-{1 + d:02d}"
+        departs = datetime.strptime(date, "%Y-%m-%d").timestamp()
+        for r in range(routes):
+            for p in range(polls):
+                results.append(("VNP", f"X{r:02d}", date, texts[p], departs - (polls - p) * 6 * 3600))
+    return [results[i:i + batch] for i in range(0, len(results), batch)]
+
+
+def bench_snapshot_archive(routes: int, days: int, polls: int, tmp: str) -> List[List[List[Any]]]:
+    archive = client_module.TicketSnapshotArchive(tmp)
+    batches = make_snapshot_batches(routes, days, polls)
+    started = time.perf_counter()
+    for batch in batches:
+        archive.write(batch)
+    write_seconds = time.perf_counter() - started
+    segments = archive.segments()
+    size = sum(path.stat().st_size for segment in segments for path in segment.iterdir())
+    write_rows = [[f"{archive.snapshots_written:,}", len(segments), f"{size / 1024 / 1024:.1f}",
+                   f"{write_seconds:.2f}", f"{archive.snapshots_written / write_seconds:,.0f}"]]
+
+    queries = [
+        ("扫描一条路线", lambda: archive.scan("VNP", "X00")),
+        ("按车次+席别扫描全部路线", lambda: archive.scan(train="G105", seat="一等座")),
+        ("扫描全部 + 售罄规律", lambda: archive.sellout_profile(archive.scan())),
+    ]
+    backends = [("numpy", client_module.np), ("python", None)] if client_module.np is not None else [("python", None)]
+    query_rows = []
+    original = client_module.np
+    try:
+        for name, module in backends:
+            client_module.np = module
+            for label, query in queries:
+                started = time.perf_counter()
+                result = query()
+                elapsed = time.perf_counter() - started
+                query_rows.append([label, name, f"{len(result):,}", f"{elapsed * 1000:.1f}"])
+    finally:
+        client_module.np = original
+    return [write_rows, query_rows]
+
+
+def run_snapshots(quick: bool):
+    routes, days, polls = (4, 7, 12) if quick else (10, 30, 28)
+    with tempfile.TemporaryDirectory() as tmp:
+        write_rows, query_rows = bench_snapshot_archive(routes, days, polls, tmp)
+    print_table(
+        f"车票快照归档写入（{routes} 条路线 × {days} 天 × {polls} 次轮询，每批 50 个结果，线程池中执行的部分）",
+        ["快照行数", "分段数", "磁盘(MB)", "解析+写入(s)", "行/秒"],
+        write_rows
+    )
+    print_table("车票快照归档查询", ["查询", "实现", "结果行数", "耗时(ms)"], query_rows)
+
+
+# ---------------------------------------------------------------------------
+# 工具子集选择
+# ---------------------------------------------------------------------------
+def make_mcp_tools() -> List[Dict[str, Any]]:
+    """近似 12306-mcp 的 tools/list（描述和参数结构），加上本地批量查票工具和另一个服务器的天气工具"""
+    def tool(name: str, description: str, properties: Dict[str, str], required: List[str]) -> Dict[str, Any]:
+        return {"type": "function", "function": {"name": name, "description": description, "parameters": {
+            "type": "object",
+            "properties": {key: {"type": "string", "description": desc} for key, desc in properties.items()},
+            "required": required
+        }}}
+
+    ticket_filters = {
+        "trainFilterFlags": "车次筛选条件，默认为空，即不筛选。支持多个标志同时筛选。例如用户说“高铁票”，则应使用 \"G\"。"
+                            "可选标志：[G(高铁/城际),D(动车),Z(直达特快),T(特快),K(快速),O(其他),F(复兴号),S(智能动车组)]",
+        "earliestStartTime": "最早出发时间（0-24），默认为0。",
+        "latestStartTime": "最迟出发时间（0-24），默认为24。",
+        "sortFlag": "排序方式，默认为空，即不排序。仅支持单一标识。可选标志：[startTime(出发时间从早到晚), "
+                    "arriveTime(抵达时间从早到晚), duration(历时从短到长)]",
+        "sortReverse": "是否逆向排序结果，默认为false。仅在设置了sortFlag时生效。",
+        "limitedNum": "返回的余票数量限制，默认为0，即不限制。",
+        "format": "返回结果格式，默认为text，建议使用text与csv。可选标志：[text, csv, json]",
+    }
+    station_args = {
+        "date": "查询日期，格式为 \"yyyy-MM-dd\"。如果用户提供的是相对日期（如“明天”），请务必先调用 "
+                "`get-current-date` 接口获取当前日期，并计算出目标日期。",
+        "fromStation": "出发地的 `station_code` 。必须是通过 `get-station-code-by-names` 或 "
+                       "`get-station-code-of-citys` 接口查询得到的编码，严禁直接使用中文地名。",
+        "toStation": "到达地的 `station_code` 。必须是通过 `get-station-code-by-names` 或 "
+                     "`get-station-code-of-citys` 接口查询得到的编码，严禁直接使用中文地名。",
+    }
+    return [
+        tool("get-current-date", "获取当前日期，以上海时区（Asia/Shanghai, UTC+8）为准，返回格式为 \"yyyy-MM-dd\"。"
+             "主要用于解析用户提到的相对日期（如“明天”、“下周三”），为其他需要日期的接口提供准确的日期输入。", {}, []),
+        tool("get-stations-code-in-city", "通过中文城市名查询该城市 **所有** 火车站的名称及其对应的 `station_code`，"
+             "结果是一个包含多个车站信息的列表。", {"city": "中文城市名称，例如：\"北京\", \"上海\""}, ["city"]),
+        tool("get-station-code-of-citys", "通过中文城市名查询代表该城市的 `station_code`。此接口主要用于在用户提供"
+             "**城市名**作为出发地或到达地时，为接口准备 `station_code` 参数。",
+             {"citys": "要查询的城市，比如\"北京\"。若要查询多个城市，请用|分割，比如\"北京|上海\"。"}, ["citys"]),
+        tool("get-station-code-by-names", "通过具体的中文车站名查询其 `station_code` 和车站名。此接口主要用于在用户提供"
+             "**具体车站名**作为出发地或到达地时，为接口准备 `station_code` 参数。",
+             {"stationNames": "具体的中文车站名称，例如：\"北京南\", \"上海虹桥\"。若要查询多个站点，请用|分割，"
+                              "比如\"北京南|上海虹桥\"。"}, ["stationNames"]),
+        tool("get-station-by-telecode", "通过车站的 `station_telecode` 查询车站的详细信息，包括名称、拼音、所属城市等。"
+             "此接口主要用于在已知 `telecode` 的情况下获取更完整的车站数据，或用于特殊查询及调试目的。"
+             "一般用户对话流程中较少直接触发。", {"stationTelecode": "车站的 `station_telecode` (3位字母编码)"},
+             ["stationTelecode"]),
+        tool("get-tickets", "查询12306余票信息。", dict(station_args, **ticket_filters),
+             ["date", "fromStation", "toStation"]),
+        tool("get-interline-tickets", "查询12306中转余票信息。尚且只支持查询前十条。",
+             dict(station_args, middleStation="中转地的 `station_code` ，可选。", showWZ="是否显示无座车，默认不显示无座车。",
+                  **ticket_filters), ["date", "fromStation", "toStation"]),
+        tool("get-train-route-stations", "查询特定列车车次在指定区间内的途径车站、到站时间、出发时间及停留时间等详细经停信息。"
+             "当用户询问某趟具体列车的经停站时使用此接口。",
+             {"trainCode": "要查询的车次 `train_code`，例如\"G1033\"。", "departDate": "列车出发的日期 (\"yyyy-MM-dd\")。",
+              "format": "返回结果格式，默认为text，建议使用text。可选标志：[text, json]"}, ["trainCode", "departDate"]),
+        client_module.TicketFanout.TOOL,
+        tool("weather__get-forecast", "查询城市未来几天的天气预报，包括气温、降水和风力，可用于判断出行天气。",
+             {"city": "城市名称", "days": "预报天数"}, ["city"]),
+    ]
+
+
+TOOL_QUERIES = [
+    "明天北京到上海的高铁", "后天杭州去南京的二等座还有吗", "下周哪天从北京去上海最便宜",
+    "成都到乌鲁木齐没有直达，帮我找中转", "G1033 经停哪些站", "北京有哪些火车站",
+    "北京南到上海虹桥明早的车", "周末去广州，那边天气怎么样", "BJP 是哪个站", "深圳到长沙今晚的动车",
+]
+
+
+def bench_tool_selection(min_seconds: float) -> List[List[Any]]:
+    tools = make_mcp_tools()
+    selector = client_module.ToolSelector()
+    selector.update(tools)
+    estimate = client_module.SessionIndex.estimate_tokens
+
+    def payload_tokens(selected: List[Dict[str, Any]]) -> int:
+        # 请求中的工具定义 + 系统提示中的工具列表
+        listing = "\n".join(f"- {t['function']['name']}: {t['function']['description']}" for t in selected)
+        return sum(estimate(client_module.json_codec.dumps_text(t)) for t in selected) + estimate(listing)
+
+    full = payload_tokens(tools)
+    rows = []
+    for query in TOOL_QUERIES:
+        selected = selector.select(query)
+        elapsed = time_call(lambda: selector.select(query), min_seconds)
+        tokens = payload_tokens(selected)
+        names = [t["function"]["name"] for t in selected if t["function"]["name"] not in selector.always]
+        rows.append([query, f"{len(selected)}/{len(tools)}", ", ".join(names) or "-", full, tokens,
+                     f"{(1 - tokens / full) * 100:.0f}%", f"{elapsed * 1e6:.0f}"])
+    return rows
+
+
+def run_tools(quick: bool):
+    rows = bench_tool_selection(0.02 if quick else 0.2)
+    print_table(
+        "按问题挑选工具子集：每次 LLM 请求的工具定义 + 系统提示工具列表（token 为估算值，始终发送的 3 个工具未列出）",
+        ["问题", "工具数", "额外选入", "全部(token)", "子集(token)", "节省", "选择耗时(µs)"],
+        rows
+    )
+
+
+BENCHMARKS: Dict[str, Callable[[bool], None]] = {
+    "cache": run_cache,
+    "json": run_json,
+    "compression": run_compression,
+    "memory": run_memory,
+    "tickets": run_tickets,
+    "snapshots": run_snapshots,
+    "tools": run_tools,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客户端组件性能基准")
+    parser.add_argument("names", nargs="*", help=f"要运行的基准: {', '.join(BENCHMARKS)}（默认全部）")
+    parser.add_argument("--quick", action="store_true", help="减少迭代次数")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"未知的基准: {', '.join(unknown)}")
+
+    print(f"# 性能基准  Python {sys.version.split()[0]}  {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name](args.quick)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+加载主客户端模块 MCP-SSE-Client.py（文件名包含连字符，无法直接 import）
+pre-fork 服务、流量回放、基准测试和测试脚本共用；同一进程中只加载一次
+"""
+import importlib.util
+import sys
+from pathlib import Path
+
+MODULE_NAME = "mcp_sse_client"
+
+
+def load_client_module():
+    """加载主客户端模块；已加载时直接返回，各脚本拿到的是同一个模块对象"""
+    module = sys.modules.get(MODULE_NAME)
+    if module is not None:
+        return module
+    path = Path(__file__).with_name("MCP-SSE-Client.py")
+    spec = importlib.util.spec_from_file_location(MODULE_NAME, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[MODULE_NAME] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[MODULE_NAME]
+        raise
+    return module
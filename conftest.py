@@ -0,0 +1,65 @@
+"""
+测试脚本共用的辅助函数：加载主客户端模块、按 12306-mcp 的文本格式拼出车票查询结果、
+创建未连接的客户端，以及模拟 LLM 响应
+pytest 会自动加载本文件；直接运行测试脚本时通过 from conftest import ... 使用
+"""
+import json
+import os
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from client_loader import load_client_module
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "test")
+client_module = load_client_module()
+
+# 车票文本中的电报码只需是大写字母，常用车站使用真实代码
+TELECODES = {"北京": "BJP", "北京南": "VNP", "上海": "SHH", "上海虹桥": "AOH", "南京": "NJH", "南京南": "NKH"}
+
+
+def train(code: str, start: str = "08:00", arrive: str = "12:30", lishi: str = "04:30",
+          origin: str = "北京南", destination: str = "上海虹桥",
+          seats: Optional[Dict[str, int]] = None, price: float = 553.0) -> Tuple:
+    """一趟车（交给 ticket_result）；seats 为 {席别: 余票数}，99 及以上显示为"有票"，缺省为二等座有票"""
+    return code, start, arrive, lishi, origin, destination, seats or {"二等座": 99}, price
+
+
+def ticket_result(*trains: Tuple, header: bool = False) -> Dict[str, Any]:
+    """按 12306-mcp 的文本格式拼出 get-tickets 结果；header=True 时带表头行"""
+    lines = ["车次 | 出发站 -> 到达站 | 出发时间 -> 到达时间 | 历时"] if header else []
+    for code, start, arrive, lishi, origin, destination, seats, price in trains:
+        lines.append(f"{code}(实际车次train_no: 24000000{code}) {origin}(telecode: {TELECODES.get(origin, 'AAA')}) -> "
+                     f"{destination}(telecode: {TELECODES.get(destination, 'BBB')}) {start} -> {arrive} 历时：{lishi}")
+        for seat, count in seats.items():
+            status = "有票" if count >= 99 else (f"剩余{count}张票" if count > 0 else "无票")
+            lines.append(f"- {seat}: {status} {price}元")
+    return {"content": [{"type": "text", "text": "\n".join(lines)}]}
+
+
+def make_client(tmp: str, **sections: Any):
+    """
+    在临时目录中创建未连接的客户端：不读写仓库中的历史和用户配置，只输出警告日志；
+    sections 为额外的配置节，如 budget={"per_day_tokens": 100}
+    """
+    config = {
+        "memory": {"history_path": os.path.join(tmp, "history.json"), "persistent_enabled": False},
+        "logging": {"level": "WARNING"},
+    }
+    config.update(sections)
+    path = os.path.join(tmp, "config.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    return client_module.Train12306MCPClient(path)
+
+
+def tool_call(call_id: str, name: str, arguments: Dict[str, Any]) -> SimpleNamespace:
+    """模拟响应中的一次工具调用"""
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+
+def completion(content: Optional[str] = None, tool_calls: Optional[List[SimpleNamespace]] = None,
+               prompt_tokens: int = 10, completion_tokens: int = 5) -> SimpleNamespace:
+    """模拟 chat.completions 响应"""
+    message = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                           usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
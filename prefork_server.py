@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+"""
+多进程预派生（pre-fork）服务：监督进程监听端口后派生 N 个工作进程，
+每个工作进程运行自己的事件循环和 Train12306MCPClient，共享同一个监听套接字，由内核分发连接
+
+用法:
+    python prefork_server.py                          # 按 config.json 的 server 配置启动
+    python prefork_server.py --workers 16 --port 8080
+    CONFIG_PATH=prod.json python prefork_server.py
+
+HTTP 接口:
+    POST /chat     {"message": "明天北京到上海的高铁", "deadline_seconds": 30}
+                   -> {"answer": "...", "worker": 3, "elapsed": 2.41}
+    GET  /health   处理该请求的工作进程的状态（没有可用 MCP 服务器时返回 503）
+
+信号（发给监督进程）:
+    SIGHUP         滚动重启：逐个启动新工作进程（重新读取配置），新进程就绪后再优雅停止旧进程
+    SIGTERM/SIGINT 优雅停止：工作进程先用 drain_seconds 让客户端断开长连接，再停止接受新连接并等待进行中的请求完成
+
+说明:
+    - 工作进程之间不共享会话：HTTP 接口是无状态的，每个请求是一次独立查询（不读写对话历史和用户配置）
+    - rate_limit 中的速率按工作进程数平分，保证所有进程合计不超过配置的上游限速
+    - 多个工作进程共享工具缓存需要 cache.backend = "sqlite"
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from client_loader import load_client_module
+
+
+# 在派生前加载：工作进程直接继承已导入的模块，不必各自重新导入
+client_module = load_client_module()
+
+logger = logging.getLogger("mcp_client.server")
+
+
+def worker_config(base: Dict[str, Any], index: int, workers: int) -> Dict[str, Any]:
+    """
+    生成工作进程使用的配置：关闭进程间会冲突的功能（会话记忆、用户配置、录制、配置热加载），
+    日志写到各自的文件，上游限速按进程数平分
+    """
+    config = copy.deepcopy(base)
+    config.setdefault("hot_reload", {})["enabled"] = False
+    memory = config.setdefault("memory", {})
+    memory["session_enabled"] = False
+    memory["persistent_enabled"] = False
+    config.setdefault("recording", {})["mode"] = "off"
+
+    log_settings = config.setdefault("logging", {})
+    if log_settings.get("file"):
+        path = Path(log_settings["file"])
+        log_settings["file"] = str(path.with_name(f"{path.stem}.worker{index}{path.suffix}"))
+
+    rate_limit = config.get("rate_limit")
+    if rate_limit and workers > 1:
+        if rate_limit.get("default_rate"):
+            rate_limit["default_rate"] = rate_limit["default_rate"] / workers
+        if rate_limit.get("default_burst"):
+            rate_limit["default_burst"] = max(rate_limit["default_burst"] / workers, 1.0)
+        for limit in (rate_limit.get("tools") or {}).values():
+            if limit.get("rate"):
+                limit["rate"] = limit["rate"] / workers
+            if limit.get("burst"):
+                limit["burst"] = max(limit["burst"] / workers, 1.0)
+    return config
+
+
+class WorkerApp:
+    """工作进程：一个 Train12306MCPClient 加一个 aiohttp 应用，通过管道向监督进程发送心跳"""
+
+    def __init__(self, index: int, config_path: str, sock: socket.socket, beat_fd: int,
+                 health_interval: float, graceful_timeout: float, max_concurrency: int,
+                 drain_seconds: float = 2.0, backlog: int = 1024):
+        self.index = index
+        self.config_path = config_path
+        self.sock = sock
+        self.beat_fd = beat_fd
+        self.health_interval = health_interval
+        self.graceful_timeout = graceful_timeout
+        self.drain_seconds = drain_seconds
+        self.backlog = backlog
+        self.max_concurrency = max_concurrency
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.client = None
+        self.ready = False
+        self.draining = False
+        self.started = time.time()
+        self.active = 0
+        self.served = 0
+        self.errors = 0
+
+    def status(self) -> Dict[str, Any]:
+        servers = self.client.servers if self.client is not None else []
+        return {
+            "worker": self.index,
+            "pid": os.getpid(),
+            "ready": self.ready,
+            "healthy": self.ready and any(server.connected for server in servers),
+            "uptime": round(time.time() - self.started, 1),
+            "active": self.active,
+            "served": self.served,
+            "errors": self.errors,
+            "mcp_servers": {server.name: server.connected for server in servers}
+        }
+
+    def send_beat(self):
+        """写一行 JSON 心跳；管道写满（监督进程暂时没读）时丢弃本次心跳，不阻塞事件循环"""
+        try:
+            os.write(self.beat_fd, (json.dumps(self.status()) + "\n").encode("utf-8"))
+        except BlockingIOError:
+            pass
+
+    async def _heartbeat_loop(self):
+        while True:
+            self.send_beat()
+            await asyncio.sleep(self.health_interval)
+
+    async def handle_chat(self, request):
+        from aiohttp import web
+
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": "请求体必须是 JSON"}, status=400)
+        message = (body.get("message") or "").strip() if isinstance(body, dict) else ""
+        if not message:
+            return web.json_response({"error": "缺少 message"}, status=400)
+
+        started = time.monotonic()
+        self.active += 1
+        try:
+            async with self.semaphore:
+                answer = await self.client.chat(message, deadline_seconds=body.get("deadline_seconds"))
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"❌ [worker {self.index}] 查询失败: {e}", exc_info=True)
+            return web.json_response({"error": str(e), "worker": self.index}, status=500)
+        finally:
+            self.active -= 1
+
+        self.served += 1
+        return web.json_response({
+            "answer": answer,
+            "worker": self.index,
+            "elapsed": round(time.monotonic() - started, 3)
+        })
+
+    async def handle_health(self, request):
+        from aiohttp import web
+
+        status = self.status()
+        return web.json_response(status, status=200 if status["healthy"] else 503)
+
+    async def run(self):
+        from aiohttp import web
+
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        @web.middleware
+        async def drain_middleware(request, handler):
+            # 停止期间的响应都带 Connection: close，客户端随后改用其他工作进程，避免复用即将关闭的长连接
+            # （须在响应头生成之前设置，on_response_prepare 信号触发时已经太晚）
+            response = await handler(request)
+            if self.draining:
+                response.force_close()
+            return response
+
+        heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+        runner = None
+        try:
+            self.client = client_module.Train12306MCPClient(self.config_path)
+            await self.client.connect()
+
+            app = web.Application(middlewares=[drain_middleware])
+            app.router.add_post("/chat", self.handle_chat)
+            app.router.add_get("/health", self.handle_health)
+            runner = web.AppRunner(app, access_log=None, shutdown_timeout=self.graceful_timeout)
+            await runner.setup()
+            # 开始服务时会再次对共享套接字调用 listen(backlog)，需要与监督进程的设置一致
+            site = web.SockSite(runner, self.sock, backlog=self.backlog)
+            await site.start()
+            self.ready = True
+            self.send_beat()
+            logger.info(f"✅ 工作进程 {self.index} 就绪 (pid {os.getpid()})")
+
+            await stop.wait()
+            logger.info(f"🛑 工作进程 {self.index} 正在停止，等待进行中的请求完成")
+            # 先停止接受新连接（监听套接字仍由其他工作进程服务），再让已有长连接在排空期内自然断开
+            await site.stop()
+            self.draining = True
+            await asyncio.sleep(self.drain_seconds)
+        finally:
+            self.ready = False
+            # 先关闭监听并等待进行中的请求，再释放客户端资源
+            if runner is not None:
+                await runner.cleanup()
+            if self.client is not None:
+                await self.client.cleanup()
+            heartbeat.cancel()
+            try:
+                await heartbeat
+            except asyncio.CancelledError:
+                pass
+
+
+class WorkerProcess:
+    """监督进程记录的工作进程状态"""
+
+    def __init__(self, index: int, pid: int, beat_fd: int):
+        self.index = index
+        self.pid = pid
+        self.beat_fd = beat_fd
+        self.started = time.monotonic()
+        self.last_beat = self.started
+        self.ready = False
+        self.retiring = False
+        self.status: Dict[str, Any] = {}
+        self._buffer = b""
+
+    def read_beats(self) -> bool:
+        """读取管道中的心跳，返回管道是否仍然打开"""
+        try:
+            data = os.read(self.beat_fd, 65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            return False
+        *lines, self._buffer = (self._buffer + data).split(b"\n")
+        for line in lines:
+            try:
+                self.status = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            self.last_beat = time.monotonic()
+            # 记录是否曾经就绪（停止阶段的心跳会报告未就绪），用于区分启动失败和运行中退出
+            self.ready = self.ready or bool(self.status.get("ready"))
+        return True
+
+
+class PreforkSupervisor:
+    """
+    监督进程：持有监听套接字并派生工作进程；按心跳检查每个工作进程的健康状况，
+    异常退出或心跳超时的进程会被替换（连续快速崩溃时指数退避），SIGHUP 触发滚动重启
+    """
+
+    def __init__(self, config_path: str, host: str, port: int, workers: int,
+                 max_concurrency: int = 16, health_interval: float = 2.0, health_timeout: float = 15.0,
+                 startup_timeout: float = 60.0, graceful_timeout: float = 30.0, drain_seconds: float = 2.0,
+                 status_file: Optional[str] = None, backlog: int = 1024):
+        self.config_path = config_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.startup_timeout = startup_timeout
+        self.graceful_timeout = graceful_timeout
+        self.drain_seconds = drain_seconds
+        self.status_file = status_file
+        self.backlog = backlog
+        self.sock: Optional[socket.socket] = None
+        self.config_manager = client_module.ConfigManager(config_path)
+        self.runtime_dir = tempfile.mkdtemp(prefix="prefork-")
+        # 每次读取配置生成一代派生配置文件；各工作进程编号记录自己使用的代，
+        # 重启（包括崩溃后重启）时沿用该代，新一代的配置只在新进程就绪后才生效
+        self._generation = 0
+        self._worker_generation: Dict[int, int] = {i: 0 for i in range(workers)}
+        self.processes: Dict[int, WorkerProcess] = {}
+        self.restarts: Dict[int, int] = {i: 0 for i in range(workers)}
+        self._crashes: Dict[int, int] = {i: 0 for i in range(workers)}
+        self._respawn_at: Dict[int, float] = {}
+        self._stopping = False
+        self._reload_requested = False
+
+    def _bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def _write_worker_configs(self) -> int:
+        """
+        读取（或重新读取）主配置，为每个工作进程生成新一代派生配置文件，返回代号；
+        配置文件缺失或无效时抛出异常（不会退回默认配置）
+        """
+        base = self.config_manager._read_snapshot().raw
+        generation = self._generation + 1
+        for index in range(self.workers):
+            client_module.atomic_write_text(
+                self._worker_config_path(index, generation),
+                json.dumps(worker_config(base, index, self.workers), ensure_ascii=False, indent=2)
+            )
+        self._generation = generation
+        return generation
+
+    def _worker_config_path(self, index: int, generation: int) -> str:
+        return os.path.join(self.runtime_dir, f"worker-{index}.gen{generation}.json")
+
+    def _remove_unused_configs(self):
+        """删除已没有工作进程使用的各代派生配置文件"""
+        in_use = {os.path.basename(self._worker_config_path(index, generation))
+                  for index, generation in self._worker_generation.items()}
+        for name in os.listdir(self.runtime_dir):
+            if name.startswith("worker-") and name not in in_use:
+                try:
+                    os.remove(os.path.join(self.runtime_dir, name))
+                except OSError:
+                    pass
+
+    def _spawn(self, index: int, generation: Optional[int] = None) -> WorkerProcess:
+        """派生工作进程；generation 默认为该编号当前使用的配置代"""
+        if generation is None:
+            generation = self._worker_generation[index]
+        config_path = self._worker_config_path(index, generation)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # 工作进程：恢复默认信号处理，关闭监督进程持有的其他管道后运行自己的事件循环
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(sig, signal.SIG_DFL)
+            os.close(read_fd)
+            for process in self.processes.values():
+                os.close(process.beat_fd)
+            os.set_blocking(write_fd, False)
+            code = 0
+            try:
+                worker = WorkerApp(index, config_path, self.sock, write_fd,
+                                   self.health_interval, self.graceful_timeout, self.max_concurrency,
+                                   self.drain_seconds, self.backlog)
+                asyncio.run(worker.run())
+            except BaseException as e:
+                logger.error(f"❌ 工作进程 {index} 异常退出: {e}", exc_info=True)
+                code = 1
+            finally:
+                # os._exit 不执行 atexit：先停止客户端模块的日志队列线程，写出队列中剩余的日志
+                client_module._stop_log_listener()
+                logging.shutdown()
+                os._exit(code)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        process = WorkerProcess(index, pid, read_fd)
+        self.processes[pid] = process
+        logger.info(f"🚀 已启动工作进程 {index} (pid {pid})")
+        return process
+
+    def _terminate(self, process: WorkerProcess, sig: int = signal.SIGTERM):
+        process.retiring = True
+        try:
+            os.kill(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _on_exit(self, process: WorkerProcess, status: int):
+        os.close(process.beat_fd)
+        if process.retiring or self._stopping:
+            return
+        # 意外退出：启动后很快就退出的算作崩溃，连续崩溃时指数退避，避免崩溃循环占满 CPU
+        if time.monotonic() - process.started < self.startup_timeout and not process.ready:
+            self._crashes[process.index] += 1
+        else:
+            self._crashes[process.index] = 0
+        delay = min(2 ** self._crashes[process.index] - 1, 30)
+        logger.warning(f"⚠️ 工作进程 {process.index} (pid {process.pid}) 意外退出，状态 {status}，{delay} 秒后重启")
+        self._respawn_at[process.index] = time.monotonic() + delay
+
+    def _reap(self):
+        while self.processes:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            process = self.processes.pop(pid, None)
+            if process is not None:
+                self._on_exit(process, status)
+
+    def _pump(self, timeout: float):
+        """等待心跳（最多 timeout 秒），然后回收已退出的进程并检查心跳超时"""
+        fds = {process.beat_fd: process for process in self.processes.values()}
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except InterruptedError:
+            readable = []
+        for fd in readable:
+            fds[fd].read_beats()
+        self._reap()
+
+        now = time.monotonic()
+        for process in list(self.processes.values()):
+            if process.retiring:
+                continue
+            limit = self.health_timeout if process.ready else self.startup_timeout
+            if now - process.last_beat > limit:
+                logger.error(f"💀 工作进程 {process.index} (pid {process.pid}) {limit:.0f} 秒无心跳，强制重启")
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # 防止在回收前重复处理
+                process.last_beat = now
+
+    def _respawn_due(self):
+        now = time.monotonic()
+        for index, due in list(self._respawn_at.items()):
+            if due <= now:
+                del self._respawn_at[index]
+                self.restarts[index] += 1
+                self._spawn(index)
+
+    def _rolling_restart(self):
+        """逐个替换工作进程：新进程就绪后才停止旧进程，任何时刻都有进程在接受连接"""
+        logger.info("🔄 收到 SIGHUP，开始滚动重启")
+        try:
+            generation = self._write_worker_configs()
+        except Exception as e:
+            logger.error(f"❌ 读取配置或生成工作进程配置失败，取消滚动重启: {e}")
+            return
+        try:
+            for index in range(self.workers):
+                old = [p for p in self.processes.values() if p.index == index and not p.retiring]
+                new = self._spawn(index, generation)
+                # 就绪之前按"退役中"处理：启动失败退出时不会被当作崩溃、用未经验证的新配置重启
+                new.retiring = True
+                deadline = time.monotonic() + self.startup_timeout
+                while not self._stopping and new.pid in self.processes and not new.ready and \
+                        time.monotonic() < deadline:
+                    self._pump(0.2)
+                if self._stopping:
+                    return
+                if not new.ready:
+                    logger.error(f"❌ 新工作进程 {index} 未能就绪，保留旧进程和旧配置并停止滚动重启")
+                    self._terminate(new, signal.SIGKILL)
+                    return
+                new.retiring = False
+                self._worker_generation[index] = generation
+                for process in old:
+                    self._terminate(process)
+                self.restarts[index] += 1
+            logger.info("✅ 滚动重启完成")
+        finally:
+            self._remove_unused_configs()
+
+    def _write_status(self):
+        if not self.status_file:
+            return
+        now = time.monotonic()
+        status = {
+            "pid": os.getpid(),
+            "listen": f"{self.host}:{self.port}",
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "workers": [
+                {
+                    "index": p.index,
+                    "pid": p.pid,
+                    "ready": p.ready,
+                    "retiring": p.retiring,
+                    "last_beat_age": round(now - p.last_beat, 1),
+                    "restarts": self.restarts[p.index],
+                    "status": p.status
+                }
+                for p in sorted(self.processes.values(), key=lambda p: p.index)
+            ]
+        }
+        try:
+            client_module.atomic_write_text(self.status_file, json.dumps(status, ensure_ascii=False, indent=2))
+        except OSError as e:
+            logger.warning(f"⚠️ 写入状态文件失败: {e}")
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def _shutdown(self):
+        logger.info("🛑 正在停止所有工作进程")
+        # 关闭监督进程持有的监听套接字：工作进程都停止接受后新连接立即被拒绝，而不是在队列中等到最后被重置
+        self.sock.close()
+        for process in self.processes.values():
+            self._terminate(process)
+        # 工作进程先排空长连接，再最多等待 graceful_timeout 完成进行中的请求，之后还要关闭客户端
+        deadline = time.monotonic() + self.drain_seconds + self.graceful_timeout + 10
+        while self.processes and time.monotonic() < deadline:
+            self._pump(0.2)
+        for process in self.processes.values():
+            logger.warning(f"⚠️ 工作进程 {process.index} (pid {process.pid}) 未按时退出，强制结束")
+            self._terminate(process, signal.SIGKILL)
+        while self.processes:
+            self._pump(0.2)
+
+    def run(self):
+        self.sock = self._bind()
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        logger.info(f"🌐 监听 http://{self.host}:{self.port}，启动 {self.workers} 个工作进程")
+
+        try:
+            # 启动时配置无效直接报错退出
+            generation = self._write_worker_configs()
+            self._worker_generation = {index: generation for index in range(self.workers)}
+            for index in range(self.workers):
+                self._spawn(index)
+            last_status = 0.0
+            while not self._stopping:
+                self._pump(min(self.health_interval, 1.0))
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self._rolling_restart()
+                self._respawn_due()
+                if time.monotonic() - last_status >= self.health_interval:
+                    self._write_status()
+                    last_status = time.monotonic()
+            self._shutdown()
+        finally:
+            self.sock.close()
+            shutil.rmtree(self.runtime_dir, ignore_errors=True)
+        logger.info("✅ 服务已停止")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程 HTTP 服务（pre-fork）")
+    parser.add_argument("--config", default=os.getenv("CONFIG_PATH", "config.json"), help="配置文件路径")
+    parser.add_argument("--host", help="监听地址（默认 server.host）")
+    parser.add_argument("--port", type=int, help="监听端口（默认 server.port）")
+    parser.add_argument("--workers", type=int, help="工作进程数（默认 server.workers，0 表示 CPU 核数）")
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork"):
+        print("❌ pre-fork 模式需要 os.fork（Linux/macOS）")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        config = client_module.ConfigManager(args.config)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    workers = args.workers if args.workers is not None else config.get("server.workers", 0)
+    supervisor = PreforkSupervisor(
+        args.config,
+        args.host or config.get("server.host", "127.0.0.1"),
+        args.port if args.port is not None else config.get("server.port", 8080),
+        workers if workers > 0 else (os.cpu_count() or 1),
+        max_concurrency=config.get("server.max_concurrency", 16),
+        health_interval=config.get("server.health_interval", 2.0),
+        health_timeout=config.get("server.health_timeout", 15.0),
+        startup_timeout=config.get("server.startup_timeout", 60.0),
+        graceful_timeout=config.get("server.graceful_timeout", 30.0),
+        drain_seconds=config.get("server.drain_seconds", 2.0),
+        status_file=config.get("server.status_file", "server_status.json")
+    )
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
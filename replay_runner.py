@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+回放运行器：用录制的 MCP / LLM 流量重新执行对话语料，统计客户端自身的开销
+（墙钟时间、CPU 时间、内存分配峰值），用于在不同提交之间跟踪性能回归
+
+录制：在 config.json 中设置 "recording": {"mode": "record", "path": "cassettes/xxx.json"} 后正常使用客户端
+回放：
+    python replay_runner.py cassettes/
+    python replay_runner.py cassettes/a.json cassettes/b.json --latency recorded --repeat 5
+    python replay_runner.py cassettes/ --output report.json --baseline last_report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+from client_loader import load_client_module
+
+
+def deep_merge(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    """递归合并配置字典"""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def build_replay_config(base_config: Dict[str, Any], cassette: Path, latency: str, work_dir: str) -> str:
+    """生成回放用的配置文件：关闭网络后台任务，记忆文件写到临时目录，保证每次运行的初始状态一致"""
+    config = deep_merge(base_config, {
+        "recording": {"mode": "replay", "path": str(cassette), "replay_latency": latency},
+        "mcp_server": {"connection": {"sse_reconnect_enabled": False, "heartbeat_interval": 0}},
+        "prefetch": {"enabled": False},
+        "hot_reload": {"enabled": False},
+        "deadline": {"query_seconds": 0},
+        "memory": {
+            "history_path": os.path.join(work_dir, "conversation_history.json"),
+            "user_profile_path": os.path.join(work_dir, "user_profile.json"),
+            # 归档也写到临时目录：不读取本机已有的归档（检索到的历史会影响提示词），也不向其中写入
+            "archive_dir": os.path.join(work_dir, "history_archive"),
+            # 后台摘要不调用 LLM：否则摘要请求会按录制顺序消耗 LLM 录制条目，回放结果不确定
+            "summary_method": "extractive"
+        },
+        "logging": {"level": "WARNING", "file": None}
+    })
+    config_path = os.path.join(work_dir, "config.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    return config_path
+
+
+async def run_conversation(client_module, config_path: str) -> Dict[str, Any]:
+    """完整执行一次录制的对话：连接、逐条提问、清理"""
+    client = client_module.Train12306MCPClient(config_path)
+    try:
+        await client.connect()
+        for message in client.cassette.conversation:
+            await client.chat(message)
+        return {"queries": len(client.cassette.conversation), "misses": client.cassette.misses}
+    finally:
+        await client.cleanup()
+
+
+def measure(client_module, base_config: Dict[str, Any], cassette: Path, latency: str, repeat: int) -> Dict[str, Any]:
+    """测量一个录制文件：先多次计时取中位数，再单独运行一次统计内存分配（tracemalloc 会拖慢计时）"""
+    walls, cpus = [], []
+    info: Dict[str, Any] = {}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            config_path = build_replay_config(base_config, cassette, latency, work_dir)
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            info = asyncio.run(run_conversation(client_module, config_path))
+            walls.append(time.perf_counter() - wall_start)
+            cpus.append(time.process_time() - cpu_start)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_path = build_replay_config(base_config, cassette, latency, work_dir)
+        tracemalloc.start()
+        try:
+            asyncio.run(run_conversation(client_module, config_path))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "cassette": cassette.name,
+        "queries": info.get("queries", 0),
+        "replay_misses": info.get("misses", 0),
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "cpu_ms": round(statistics.median(cpus) * 1000, 2),
+        "peak_alloc_kb": round(peak / 1024, 1)
+    }
+
+
+def collect_cassettes(paths: List[str]) -> List[Path]:
+    cassettes = []
+    for raw in paths:
+        path = Path(raw)
+        if path.is_dir():
+            cassettes.extend(sorted(path.glob("*.json")))
+        else:
+            cassettes.append(path)
+    return cassettes
+
+
+def format_delta(current: float, previous: float) -> str:
+    if not previous:
+        return ""
+    return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+
+def print_report(results: List[Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]):
+    print(f"\n{'='*90}")
+    print(f"{'录制文件':<30}{'查询数':>6}{'墙钟(ms)':>18}{'CPU(ms)':>18}{'内存峰值(KB)':>18}")
+    print(f"{'='*90}")
+    for result in results:
+        previous = baseline.get(result["cassette"], {})
+        wall = f"{result['wall_ms']}{format_delta(result['wall_ms'], previous.get('wall_ms'))}"
+        cpu = f"{result['cpu_ms']}{format_delta(result['cpu_ms'], previous.get('cpu_ms'))}"
+        peak = f"{result['peak_alloc_kb']}{format_delta(result['peak_alloc_kb'], previous.get('peak_alloc_kb'))}"
+        print(f"{result['cassette']:<30}{result['queries']:>6}{wall:>18}{cpu:>18}{peak:>18}")
+        if result["replay_misses"]:
+            print(f"   ⚠️ {result['replay_misses']} 个请求未精确匹配，已按录制顺序回放")
+    print(f"{'='*90}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的对话并统计客户端开销")
+    parser.add_argument("paths", nargs="+", help="录制文件或包含录制文件的目录")
+    parser.add_argument("--config", default="config.json", help="基础配置文件")
+    parser.add_argument("--latency", choices=["zero", "recorded"], default="zero",
+                        help="回放延迟：zero 只测客户端开销，recorded 还原录制时的网络耗时")
+    parser.add_argument("--repeat", type=int, default=3, help="每个录制文件计时运行的次数（取中位数）")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前输出的 JSON 结果对比")
+    args = parser.parse_args()
+
+    # 回放不访问真实 LLM，但客户端初始化需要 API Key
+    os.environ.setdefault("DEEPSEEK_API_KEY", "replay")
+    client_module = load_client_module()
+
+    base_config: Dict[str, Any] = {}
+    if Path(args.config).exists():
+        with open(args.config, 'r', encoding='utf-8') as f:
+            base_config = json.load(f)
+
+    baseline: Dict[str, Dict[str, Any]] = {}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = {item["cassette"]: item for item in json.load(f)["results"]}
+
+    cassettes = collect_cassettes(args.paths)
+    if not cassettes:
+        print("❌ 没有找到录制文件")
+        sys.exit(1)
+
+    results = [measure(client_module, base_config, cassette, args.latency, args.repeat) for cassette in cassettes]
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "latency": args.latency,
+                "repeat": args.repeat,
+                "results": results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
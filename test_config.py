@@ -0,0 +1,146 @@
+"""
+测试脚本：验证配置编译为只读快照（类型转换、校验）、启动时无效配置直接报错，以及热加载时的整体替换
+不需要 MCP 服务器和 API Key
+
+运行: python test_config.py  或  pytest test_config.py
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+from conftest import client_module, make_client
+
+
+def write_config(path, config):
+    with open(path, "w", encoding="utf-8") as f:
+        if isinstance(config, str):
+            f.write(config)
+        else:
+            json.dump(config, f)
+
+
+def compile_error(raw):
+    """编译 raw，返回错误信息（编译成功时返回 None）"""
+    try:
+        client_module._compile_settings(client_module.Settings, raw)
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def test_compile_nested_settings():
+    """嵌套配置编译为数据类：缺省字段取默认值，整数转为浮点字段，未声明的键忽略"""
+    settings = client_module._compile_settings(client_module.Settings, {
+        "mcp_server": {"url": "http://mcp", "connection": {"retry_delay": 2, "pool_size": 8}},
+        "llm": {"max_iterations": 3, "endpoints": [{"name": "a"}]},
+        "budget": {"per_query_tokens": 100},
+    })
+    assert settings.mcp_server.url == "http://mcp"
+    connection = settings.mcp_server.connection
+    assert connection.retry_delay == 2.0 and isinstance(connection.retry_delay, float)
+    assert connection.pool_size == 8 and connection.timeout_seconds == 30.0
+    assert settings.llm.max_iterations == 3 and settings.memory == client_module.MemorySettings()
+
+
+def test_compile_rejects_invalid_values():
+    """类型错误、负数、非对象和数据类自身的取值校验都报错，并指出配置项路径"""
+    cases = {
+        "mcp_server.connection.retry_attempts": {"mcp_server": {"connection": {"retry_attempts": "3"}}},
+        "memory.session_enabled": {"memory": {"session_enabled": 1}},
+        "llm.max_iterations": {"llm": {"max_iterations": True}},
+        "mcp_server.connection.timeout_seconds": {"mcp_server": {"connection": {"timeout_seconds": -1}}},
+        "mcp_server.url": {"mcp_server": {"url": 12306}},
+        "memory": {"memory": []},
+    }
+    for key, raw in cases.items():
+        error = compile_error(raw)
+        assert error is not None and key in error, (key, error)
+    assert "必须 >= 1" in compile_error({"llm": {"max_iterations": 0}})
+    assert "relevant 或 recent" in compile_error({"memory": {"history_retrieval": "all"}})
+    assert compile_error({}) is None
+
+
+def test_startup_fails_fast_on_invalid_file():
+    """启动时文件不存在使用默认配置；JSON 错误或取值无效时抛出 ValueError，不以默认配置运行"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.json")
+        manager = client_module.ConfigManager(path)
+        assert manager.get("llm.model") == "deepseek-chat"
+        for content, expected in (("{bad json", "无效"),
+                                  ({"llm": {"max_iterations": 0}, "memory": {"max_context_messages": 5}},
+                                   "llm.max_iterations")):
+            write_config(path, content)
+            try:
+                client_module.ConfigManager(path)
+            except ValueError as e:
+                assert expected in str(e) and path in str(e), e
+            else:
+                raise AssertionError(f"无效配置未报错: {content}")
+
+
+def test_hot_reload_swaps_snapshot():
+    """热加载成功时整体替换快照并通知回调；无效配置保留旧快照，回调出错不影响替换"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.json")
+        write_config(path, {"llm": {"max_iterations": 3}, "budget": {"per_query_tokens": 100}})
+        manager = client_module.ConfigManager(path)
+        changes = []
+        manager.add_listener(lambda old, new: changes.append((old.llm.max_iterations, new.llm.max_iterations)))
+        manager.add_listener(lambda old, new: 1 / 0)
+
+        write_config(path, {"llm": {"max_iterations": 7}, "budget": {"per_query_tokens": 200}})
+        assert asyncio.run(manager.reload()) is True
+        assert changes == [(3, 7)]
+        assert manager.settings.llm.max_iterations == 7 and manager.get("budget.per_query_tokens") == 200
+
+        old_snapshot = manager._snapshot
+        for content in ("{bad json", {"llm": {"max_iterations": -1}}):
+            write_config(path, content)
+            assert asyncio.run(manager.reload()) is False
+            assert manager._snapshot is old_snapshot and manager.get("budget.per_query_tokens") == 200
+        # 记录无效文件的修改时间，watch 不会对同一个文件反复重载
+        assert manager._snapshot.mtime == manager._file_mtime()
+        assert changes == [(3, 7)]
+
+
+def test_client_applies_reloaded_settings():
+    """客户端在热加载后更新初始化时固化在组件中的参数（预算、降级模型、循环控制）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        assert client.accountant.per_query_tokens == 0 and client.loop_controller.max_repeats == 2
+
+        path = client.config.config_path
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        config.update(budget={"per_query_tokens": 5000, "fallback_model": "cheap-model"},
+                      loop_control={"max_repeats": 4})
+        write_config(path, config)
+        assert asyncio.run(client.config.reload()) is True
+        assert client.accountant.per_query_tokens == 5000 and client.fallback_model == "cheap-model"
+        assert client.loop_controller.max_repeats == 4
+
+
+def main():
+    tests = [
+        test_compile_nested_settings,
+        test_compile_rejects_invalid_values,
+        test_startup_fails_fast_on_invalid_file,
+        test_hot_reload_swaps_snapshot,
+        test_client_applies_reloaded_settings,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
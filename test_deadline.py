@@ -0,0 +1,166 @@
+"""
+测试脚本：验证查询截止时间（剩余时间、收紧超时、随任务传递）、MCP 请求在剩余时间不足时跳过重试，
+以及查询到达时间上限时返回已查到的结果
+使用本地假 MCP 端点（可配置失败和延迟），不需要真实 MCP 服务器和 API Key
+
+运行: python test_deadline.py  或  pytest test_deadline.py
+"""
+import asyncio
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from conftest import client_module, completion, make_client, ticket_result, tool_call, train
+
+
+TICKETS = ticket_result(train("G1", "09:00", "13:37", "04:37", price=662.0))
+
+
+class FakeMCPEndpoint:
+    """假 MCP 端点：按 script 依次处理请求，"fail" 返回 500，数字表示延迟若干秒后成功，用完后一律成功"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = 0
+        self.url = None
+        self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        body = await request.json()
+        step = self.script.pop(0) if self.script else 0
+        if step == "fail":
+            return web.Response(status=500)
+        await asyncio.sleep(step)
+        return web.json_response({"jsonrpc": "2.0", "id": body["id"], "result": {"ok": True}})
+
+    async def __aenter__(self) -> "FakeMCPEndpoint":
+        app = web.Application()
+        app.router.add_post("/mcp", self._handle)
+        # 退出时不等待仍在延迟中的请求处理完
+        self._runner = web.AppRunner(app, shutdown_timeout=0.1)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
+
+
+def run_request(script, deadline_seconds=None, **connection):
+    """在可选的截止时间内向假端点发送一次请求，返回 (结果, 端点收到的请求数, 耗时)"""
+    settings = client_module.ConnectionSettings(**dict({"retry_delay": 0.1}, **connection))
+
+    async def run():
+        async with FakeMCPEndpoint(script) as endpoint:
+            server = client_module.MCPServerConnection("fake", endpoint.url)
+            server.open_session(settings)
+            if deadline_seconds is not None:
+                client_module._current_deadline.set(client_module.Deadline(deadline_seconds))
+            started = time.monotonic()
+            try:
+                result = await server.request("tools/list", None, settings)
+            finally:
+                await server.session.close()
+            return result, endpoint.calls, time.monotonic() - started
+    return asyncio.run(run())
+
+
+def test_deadline_remaining_and_cap():
+    """剩余时间随时间减少且不小于 0；cap 把单次超时收紧到剩余时间以内"""
+    deadline = client_module.Deadline(0.2)
+    assert not deadline.expired and 0.1 < deadline.remaining() <= 0.2
+    assert deadline.cap(30.0) <= 0.2 and deadline.cap(0.05) == 0.05
+    time.sleep(0.25)
+    assert deadline.expired and deadline.remaining() == 0.0 and deadline.cap(30.0) == 0.0
+
+
+def test_current_deadline_follows_tasks():
+    """截止时间随 contextvars 传递给查询内派生的任务，不影响其他查询"""
+    async def query(seconds):
+        client_module._current_deadline.set(client_module.Deadline(seconds))
+        child = await asyncio.ensure_future(asyncio.sleep(0, result=client_module.current_deadline()))
+        return child.seconds
+
+    async def run():
+        assert client_module.current_deadline() is None
+        results = await asyncio.gather(query(5), query(10))
+        return results, client_module.current_deadline()
+
+    assert asyncio.run(run()) == ([5, 10], None)
+
+
+def test_request_retries_without_deadline():
+    """没有截止时间时按 retry_attempts 重试，直到成功"""
+    result, calls, _ = run_request(["fail", "fail"], retry_attempts=3)
+    assert result == {"ok": True} and calls == 3
+
+
+def test_request_skips_retry_when_time_is_short():
+    """剩余时间不够退避后再完整尝试一次时放弃重试；剩余时间不足 min_attempt_seconds 时不发送请求"""
+    result, calls, elapsed = run_request(["fail", "fail"], deadline_seconds=1.5, retry_attempts=3, retry_delay=1.0)
+    assert result is None and calls == 1 and elapsed < 0.5, (calls, elapsed)
+    result, calls, _ = run_request([], deadline_seconds=0.5, retry_attempts=3)
+    assert result is None and calls == 0
+
+
+def test_request_timeout_capped_by_deadline():
+    """单次请求的超时不超过查询剩余时间，服务器迟迟不响应时在截止时间返回"""
+    result, calls, elapsed = run_request([5], deadline_seconds=1.5, retry_attempts=3, timeout_seconds=30)
+    assert result is None and calls == 1 and elapsed < 2.0, (calls, elapsed)
+
+
+def test_chat_returns_partial_answer_at_deadline():
+    """查询到达时间上限时不再请求 LLM，返回已查到的车票结果"""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp, speculation={"enabled": False}, tool_routing={"enabled": False},
+                             deadline={"min_llm_seconds": 0.5})
+        client.is_connected = True
+        client.tools_cache = [{"type": "function", "function": {"name": "get-tickets", "parameters": {}}}]
+        requests = []
+
+        async def llm_create(**kwargs):
+            requests.append(kwargs)
+            call = tool_call("c1", "get-tickets", {"date": "2026-10-20", "fromStation": "BJP", "toStation": "SHH"})
+            return completion(tool_calls=[call]), "fake-model"
+
+        async def slow_call_tool(name, arguments, **kwargs):
+            await asyncio.sleep(0.7)
+            return TICKETS
+
+        client._llm_create = llm_create
+        client.call_tool = slow_call_tool
+        started = time.monotonic()
+        answer = asyncio.run(client.chat("明天北京到上海", deadline_seconds=1.0))
+        assert time.monotonic() - started < 1.0
+        assert len(requests) == 1
+        assert answer.startswith("⏰ 查询已到达时间上限") and "G1" in answer, answer
+
+
+def main():
+    tests = [
+        test_deadline_remaining_and_cap,
+        test_current_deadline_follows_tasks,
+        test_request_retries_without_deadline,
+        test_request_skips_retry_when_time_is_short,
+        test_request_timeout_capped_by_deadline,
+        test_chat_returns_partial_answer_at_deadline,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
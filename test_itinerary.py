@@ -0,0 +1,157 @@
+"""
+测试脚本：验证换乘方案搜索的两段拼接（换乘时间、同城异站、总历时上限）、次日补查和帕累托最优筛选
+不需要 MCP 服务器和 API Key
+
+运行: python test_itinerary.py  或  pytest test_itinerary.py
+"""
+import asyncio
+import sys
+
+from conftest import client_module, ticket_result, train
+
+
+DATE = "2026-10-20"
+
+
+def tickets(*trains):
+    """get-tickets 结果；trains: (车次, 出发站, 到达站, 出发时间, 历时, 二等座票价)"""
+    return ticket_result(*(train(code, start, lishi=lishi, origin=origin, destination=destination, price=price)
+                           for code, origin, destination, start, lishi, price in trains))
+
+
+def table(*trains, date: str = DATE):
+    return client_module.TicketTable.from_results([(tickets(*trains), date)])
+
+
+class FakeMapper:
+    """城市名即车站代码，枢纽由构造参数给定"""
+
+    def __init__(self, hubs):
+        self.hubs = hubs
+
+    def get_code(self, city):
+        return city
+
+    def hubs_between(self, from_city, to_city, limit=4, max_detour=1.4):
+        return list(self.hubs)[:limit]
+
+
+def make_planner(**kwargs):
+    async def fetch(a, b, day):
+        return None
+    return client_module.ItineraryPlanner(fetch, FakeMapper([]), **kwargs)
+
+
+def test_join_connection_windows():
+    """同站换乘至少 min_connection 分钟、异站换乘至少 cross_station_connection 分钟，等待不超过 max_wait"""
+    planner = make_planner(min_connection=20, cross_station_connection=60, max_wait=180)
+    # 第一段 08:00-10:00 到达南京南
+    first = table(("G1", "北京南", "南京南", "08:00", "02:00", 300))
+    second = table(
+        ("G11", "南京南", "上海虹桥", "10:10", "01:00", 100),   # 换乘不足 20 分钟
+        ("G13", "南京南", "上海虹桥", "10:30", "01:00", 110),   # 同站，可接
+        ("D15", "南京", "上海", "10:40", "01:30", 80),        # 异站，不足 60 分钟
+        ("D17", "南京", "上海", "11:10", "01:30", 70),        # 异站，可接
+        ("G19", "南京南", "上海虹桥", "13:30", "01:00", 90),   # 等待超过 180 分钟
+    )
+    out = []
+    bound = planner._join(first, second, client_module.TicketCriteria(), out, float("inf"))
+    assert [second.codes[it.legs[1][1]] for it in out] == ["G13", "D17"]
+    assert out[0].minutes == 3 * 60 + 30 and out[0].price == 410 and out[0].transfers == 1
+    # 上限收紧为最快组合的 max_total_ratio 倍
+    assert bound == out[0].minutes * planner.max_total_ratio
+    assert "南京南 等 0h30m" in out[0].describe()
+    assert "南京南→南京 等 1h10m" in out[1].describe()
+
+
+def test_join_respects_bound_and_empty_tables():
+    """超过总历时上限的组合被丢弃；任一段为空时不拼接"""
+    planner = make_planner()
+    first = table(("G1", "甲", "乙", "08:00", "02:00", 100))
+    second = table(("G2", "乙", "丙", "11:00", "02:00", 100))
+    out = []
+    assert planner._join(first, second, client_module.TicketCriteria(), out, 4 * 60) == 4 * 60
+    assert out == []
+    assert planner._join(first, table(), client_module.TicketCriteria(), out, 600) == 600
+    planner._join(first, second, client_module.TicketCriteria(), out, 5 * 60)
+    assert len(out) == 1 and out[0].minutes == 5 * 60
+
+
+def test_pareto_front():
+    """（总历时、换乘次数、票价）被支配的方案被剔除，结果按总历时排序，完全相同的只保留先出现的"""
+    make = client_module.Itinerary
+    fast_direct = make([(None, 0)], 0, 300, 600.0)
+    slow_cheap = make([(None, 0), (None, 1)], 0, 420, 300.0)
+    dominated = make([(None, 0), (None, 1)], 0, 450, 350.0)
+    slow_direct_cheaper = make([(None, 0)], 0, 360, 500.0)
+    duplicate = make([(None, 0)], 0, 300, 600.0)
+    front = client_module.ItineraryPlanner.pareto_front(
+        [dominated, slow_cheap, duplicate, slow_direct_cheaper, fast_direct])
+    assert front == [duplicate, slow_direct_cheaper, slow_cheap]
+    assert client_module.ItineraryPlanner.pareto_front([]) == []
+
+
+def test_plan_with_next_day_connection():
+    """第一段到达后当天无车可接时补查次日第二段，并与直达方案一起做帕累托筛选"""
+    calls = []
+    results = {
+        ("FROM", "TO", DATE): tickets(("Z1", "甲", "丙", "20:00", "14:00", 200)),
+        ("FROM", "HUB", DATE): tickets(("G1", "甲", "乙", "17:00", "03:00", 300)),
+        ("HUB", "TO", DATE): tickets(("G2", "乙", "丙", "07:00", "03:00", 250)),
+        ("HUB", "TO", "2026-10-21"): tickets(("G2", "乙", "丙", "07:00", "03:00", 260)),
+    }
+
+    async def fetch(a, b, day):
+        calls.append((a, b, day))
+        return results.get((a, b, day))
+
+    planner = client_module.ItineraryPlanner(fetch, FakeMapper(["HUB"]), max_wait=12 * 60)
+    front = asyncio.run(planner.plan("FROM", "TO", DATE, client_module.TicketCriteria()))
+    assert ("HUB", "TO", "2026-10-21") in calls and planner.requests == 4
+    assert [(it.transfers, it.minutes, it.price) for it in front] == [(0, 14 * 60, 200.0)]
+
+    # 直达更贵时两种方案都在帕累托前沿上
+    results[("FROM", "TO", DATE)] = tickets(("Z1", "甲", "丙", "20:00", "14:00", 900))
+    front = asyncio.run(planner.plan("FROM", "TO", DATE, client_module.TicketCriteria()))
+    assert [(it.transfers, it.minutes, it.price) for it in front] == [(0, 14 * 60, 900.0), (1, 17 * 60, 560.0)]
+
+
+def test_plan_skips_next_day_when_not_needed():
+    """当天就能接上时不补查次日"""
+    calls = []
+
+    async def fetch(a, b, day):
+        calls.append((a, b, day))
+        return {
+            ("FROM", "HUB"): tickets(("G1", "甲", "乙", "08:00", "02:00", 100)),
+            ("HUB", "TO"): tickets(("G2", "乙", "丙", "10:30", "02:00", 100)),
+        }.get((a, b))
+
+    planner = client_module.ItineraryPlanner(fetch, FakeMapper(["HUB"]))
+    front = asyncio.run(planner.plan("FROM", "TO", DATE, client_module.TicketCriteria()))
+    assert len(calls) == 3 and all(day == DATE for _, _, day in calls)
+    assert [(it.transfers, it.minutes) for it in front] == [(1, 4 * 60 + 30)]
+
+
+def main():
+    tests = [
+        test_join_connection_windows,
+        test_join_respects_bound_and_empty_tables,
+        test_pareto_front,
+        test_plan_with_next_day_connection,
+        test_plan_skips_next_day_when_not_needed,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+测试脚本：验证 LLM 路由器的延迟选路、故障切换、对冲请求、截止时间和取消
+使用本地假 OpenAI 兼容端点（可配置延迟和失败），无需真实 API Key
+
+运行: python test_llm_router.py  或  pytest test_llm_router.py
+"""
+import asyncio
+import sys
+import threading
+import time
+
+import httpx
+from aiohttp import web
+from openai import AsyncOpenAI
+
+from conftest import client_module
+
+
+class FakeLLMEndpoint:
+    """假 LLM 端点：在独立线程的事件循环中运行，支持配置延迟和失败"""
+
+    def __init__(self, name: str, latency: float = 0.0, fail: bool = False):
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+        # 客户端在响应前断开连接的次数
+        self.disconnects = 0
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        body = await request.json()
+        # 分段等待，期间客户端断开连接时记录并放弃响应
+        finish = time.monotonic() + self.latency
+        while time.monotonic() < finish:
+            if request.transport is None or request.transport.is_closing():
+                self.disconnects += 1
+                return web.Response(status=499)
+            await asyncio.sleep(min(0.01, finish - time.monotonic()))
+        if self.fail:
+            return web.json_response({"error": {"message": "fake failure"}}, status=500)
+        return web.json_response({
+            "id": "fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.name},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+        })
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self) -> "FakeLLMEndpoint":
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def endpoint(self, **kwargs):
+        """
+        创建指向该假服务的 LLMEndpoint（关闭 SDK 重试，便于观察故障切换）
+        每个用例多次 asyncio.run，关闭连接复用，避免连接跨事件循环
+        """
+        http_client = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=0))
+        client = AsyncOpenAI(api_key="test", base_url=f"http://127.0.0.1:{self.port}/v1", max_retries=0,
+                             http_client=http_client)
+        return client_module.LLMEndpoint(self.name, client, "fake-model", **kwargs)
+
+
+def ask(router, timings: list = None):
+    """发送一次请求并返回回复内容；timings 用于记录事件循环内的耗时（不含退出时等待线程池）"""
+    async def run():
+        started = time.monotonic()
+        response, model = await router.create(messages=[{"role": "user", "content": "hi"}])
+        if timings is not None:
+            timings.append(time.monotonic() - started)
+        return response.choices[0].message.content
+    return asyncio.run(run())
+
+
+def test_routes_to_fastest_endpoint():
+    """测得延迟后，请求应发往最快的端点"""
+    slow = FakeLLMEndpoint("slow", latency=0.3).start()
+    fast = FakeLLMEndpoint("fast", latency=0.01).start()
+    try:
+        router = client_module.LLMRouter([slow.endpoint(), fast.endpoint()])
+        # 前两次请求分别测得两个端点的延迟
+        ask(router)
+        ask(router)
+        answers = [ask(router) for _ in range(3)]
+        assert answers == ["fast"] * 3, answers
+        assert router.ranked()[0].name == "fast"
+    finally:
+        slow.stop()
+        fast.stop()
+
+
+def test_failover_to_healthy_endpoint():
+    """首选端点失败时切换到下一个端点，错误率过高的端点进入冷却"""
+    broken = FakeLLMEndpoint("broken", fail=True).start()
+    backup = FakeLLMEndpoint("backup", latency=0.05).start()
+    try:
+        router = client_module.LLMRouter([broken.endpoint(cooldown_seconds=60), backup.endpoint()])
+        for _ in range(3):
+            assert ask(router) == "backup"
+        broken_ep = router.endpoints[0]
+        assert broken_ep.error_rate() == 1.0
+        # 失败一次后即排在已测得延迟的端点之后，不再被优先选择
+        assert broken.calls == 1
+        # 失败次数达到阈值后进入冷却
+        broken_ep.record(0.01, False)
+        broken_ep.record(0.01, False)
+        assert not broken_ep.healthy
+        assert router.ranked()[0].name == "backup"
+    finally:
+        broken.stop()
+        backup.stop()
+
+
+def test_failed_only_endpoint_ranked_after_measured():
+    """只失败过（没有成功样本）的端点即使仍算健康，也排在已测得延迟的端点之后；从未请求过的端点排在最前"""
+    endpoints = [client_module.LLMEndpoint(name, None, "fake-model") for name in ("failed", "measured", "new")]
+    failed, measured, new = endpoints
+    failed.record(0.1, False)
+    measured.record(0.5, True)
+    router = client_module.LLMRouter(endpoints)
+    assert failed.healthy
+    assert [ep.name for ep in router.ranked()] == ["new", "measured", "failed"]
+
+
+def test_hedged_request_takes_first_answer():
+    """首选端点超过对冲延迟仍未返回时，向次优端点对冲，并采用先返回的结果"""
+    stalled = FakeLLMEndpoint("stalled", latency=1.0).start()
+    quick = FakeLLMEndpoint("quick", latency=0.05).start()
+    try:
+        router = client_module.LLMRouter(
+            [stalled.endpoint(), quick.endpoint()],
+            hedge_enabled=True, hedge_default_delay=0.1, hedge_min_delay=0.1
+        )
+        timings = []
+        assert ask(router, timings) == "quick"
+        elapsed = timings[0]
+        assert elapsed < 0.8, f"对冲未生效，耗时 {elapsed:.2f}s"
+        assert router.hedged_requests == 1
+        assert stalled.calls == 1 and quick.calls == 1
+    finally:
+        stalled.stop()
+        quick.stop()
+
+
+class EarlyDeadline(client_module.Deadline):
+    """计时器略早于截止时间触发的情形：等待超时返回时 expired 仍为 False"""
+
+    @property
+    def expired(self) -> bool:
+        return False
+
+
+def test_deadline_without_hedge_raises_timeout():
+    """未启用对冲且只有一个端点时，截止时间到期抛出 asyncio.TimeoutError，而不是尝试对冲不存在的端点"""
+    slow = FakeLLMEndpoint("slow", latency=1.0).start()
+    try:
+        router = client_module.LLMRouter([slow.endpoint()])
+
+        async def run(deadline):
+            client_module._current_deadline.set(deadline)
+            started = time.monotonic()
+            try:
+                await router.create(messages=[{"role": "user", "content": "hi"}])
+            except asyncio.TimeoutError:
+                return time.monotonic() - started
+            raise AssertionError("未抛出 asyncio.TimeoutError")
+
+        for deadline_type in (client_module.Deadline, EarlyDeadline):
+            elapsed = asyncio.run(run(deadline_type(0.2)))
+            assert elapsed < 0.6, f"{deadline_type.__name__} 耗时 {elapsed:.2f}s"
+        assert router.hedged_requests == 0
+    finally:
+        slow.stop()
+
+
+def test_cancel_closes_http_request():
+    """取消进行中的查询时，发往 LLM 端点的 HTTP 请求随即断开，而不是等到服务端响应"""
+    slow = FakeLLMEndpoint("slow", latency=3.0).start()
+    try:
+        router = client_module.LLMRouter([slow.endpoint()])
+
+        async def run():
+            task = asyncio.ensure_future(router.create(messages=[{"role": "user", "content": "hi"}]))
+            await asyncio.sleep(0.3)
+            assert slow.calls == 1
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            started = time.monotonic()
+            while not slow.disconnects and time.monotonic() - started < 1.0:
+                await asyncio.sleep(0.02)
+            return time.monotonic() - started
+
+        waited = asyncio.run(run())
+        assert slow.disconnects == 1, f"取消后 {waited:.2f}s 内连接仍未断开"
+        # 被取消的调用不计入延迟和错误率统计
+        assert router.endpoints[0].stats()["samples"] == 0
+    finally:
+        slow.stop()
+
+
+def main():
+    tests = [
+        test_routes_to_fastest_endpoint,
+        test_failover_to_healthy_endpoint,
+        test_failed_only_endpoint_ranked_after_measured,
+        test_hedged_request_takes_first_answer,
+        test_deadline_without_hedge_raises_timeout,
+        test_cancel_closes_http_request,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+测试脚本：验证会话记忆的后台压缩（摘要为空时结束压缩）和不占用事件循环的历史保存
+不需要 MCP 服务器和 API Key
+
+运行: python test_memory.py  或  pytest test_memory.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+
+from conftest import client_module
+
+
+def test_compaction_terminates_on_empty_summary():
+    """摘要为空的会话（消息没有实际内容）压缩一次后不再被选中，压缩循环可以结束"""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = client_module.ConversationMemory(os.path.join(tmp, "history.json"))
+        memory.add_message("user", "   ")
+        memory.add_message("assistant", "\n")
+        memory.clear_session()
+        calls = []
+
+        async def summarize(previous, messages):
+            calls.append(len(messages))
+            return client_module.ConversationMemory.extractive_summary(previous, messages)
+
+        async def run():
+            passes = 0
+            while memory.needs_compaction(3):
+                passes += 1
+                assert passes <= 3, "压缩没有进展"
+                await memory.compact(summarize, 3)
+            await memory.close()
+            return passes
+
+        assert asyncio.run(run()) == 1
+        assert calls == [2]
+        session = memory.history[-1]
+        assert session["summarized"] and session["summary"] == ""
+
+        reloaded = client_module.ConversationMemory(os.path.join(tmp, "history.json"))
+        assert not reloaded.needs_compaction(3)
+
+
+def test_history_saved_off_loop():
+    """事件循环中结束会话不在循环中写文件：防抖后在线程池中归档旧会话并保存，close 时落盘剩余变化"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "history.json")
+        archive = client_module.HistoryArchive(os.path.join(tmp, "archive"))
+        memory = client_module.ConversationMemory(path, max_sessions=1, archive=archive, archive_batch=1,
+                                                  save_debounce=0.05)
+        archive_threads = []
+        append = archive.append
+
+        def record_append(sessions):
+            archive_threads.append(threading.get_ident())
+            return append(sessions)
+
+        archive.append = record_append
+
+        async def run():
+            for n in range(3):
+                memory.add_message("user", f"问题{n}")
+                memory.clear_session()
+            saved_immediately = os.path.exists(path)
+            await asyncio.sleep(0.3)
+            saved_after_debounce = os.path.exists(path)
+            memory.add_message("user", "问题3")
+            memory.clear_session()
+            await memory.close()
+            return saved_immediately, saved_after_debounce
+
+        assert asyncio.run(run()) == (False, True)
+        assert archive_threads and threading.get_ident() not in archive_threads
+        assert [s["messages"][0]["content"] for s in archive.iter_sessions()] == ["问题0", "问题1"]
+        reloaded = client_module.ConversationMemory(path)
+        assert [s["messages"].llm_messages()[0]["content"] for s in reloaded.history] == ["问题2", "问题3"]
+
+
+def main():
+    tests = [
+        test_compaction_terminates_on_empty_summary,
+        test_history_saved_off_loop,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+测试脚本：验证消息的紧凑存储（MessageLog）与历史文件格式的互相转换和 LLM 视图缓存
+不需要 MCP 服务器和 API Key
+
+运行: python test_message_log.py  或  pytest test_message_log.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+from conftest import client_module
+
+
+def test_message_log_round_trip():
+    """MessageLog 与历史文件格式互相转换后角色、正文和时间戳不变；缺失或非法的字段有默认值"""
+    log = client_module.MessageLog()
+    log.append("system", "你是 12306 助手", 1760000000.5)
+    log.append("user", "明天北京到上海", 1760000001.0)
+    log.append("assistant", "", 1760000002.0)
+    log.append("function", "自定义角色", 1760000003.0)
+    records = log.to_records()
+    assert [r["role"] for r in records] == ["system", "user", "assistant", "function"]
+    assert records[0]["timestamp"] == datetime.fromtimestamp(1760000000.5).isoformat()
+
+    restored = client_module.MessageLog.from_records(records)
+    assert restored.to_records() == records
+    assert [restored.created(i) for i in range(len(restored))] == [1760000000.5, 1760000001.0,
+                                                                    1760000002.0, 1760000003.0]
+    assert restored.role(3) is log.role(3) == "function"
+
+    legacy = client_module.MessageLog.from_records([
+        {"role": "user", "content": "旧格式", "timestamp": "2025-01-01T08:00:00"},
+        {"content": None, "timestamp": "昨天"},
+        {"role": "assistant", "content": "没有时间戳"},
+    ])
+    assert legacy.llm_messages() == [{"role": "user", "content": "旧格式"}, {"role": "user", "content": ""},
+                                     {"role": "assistant", "content": "没有时间戳"}]
+    assert legacy.created(0) == datetime(2025, 1, 1, 8).timestamp() and legacy.created(1) == legacy.created(2) == 0.0
+
+
+def test_message_log_views():
+    """llm_messages 按区间转换；llm_view 在消息和窗口不变时复用同一个列表，追加消息后重新生成"""
+    log = client_module.MessageLog()
+    for n in range(5):
+        log.append("user" if n % 2 == 0 else "assistant", f"消息{n}")
+    assert [m["content"] for m in log.llm_messages(1, 3)] == ["消息1", "消息2"]
+    assert list(log.contents("assistant")) == ["消息1", "消息3"]
+
+    view = log.llm_view(3)
+    assert [m["content"] for m in view] == ["消息2", "消息3", "消息4"]
+    assert log.llm_view(3) is view
+    assert [m["content"] for m in log.llm_view(10)] == [f"消息{n}" for n in range(5)]
+    log.append("user", "消息5")
+    assert [m["content"] for m in log.llm_view(3)] == ["消息3", "消息4", "消息5"]
+    assert log.llm_messages(0, 1) is not log.llm_messages(0, 1)
+
+
+def test_history_file_round_trip():
+    """会话保存到历史文件后重新加载，消息内容和顺序不变"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "history.json")
+        memory = client_module.ConversationMemory(path)
+        memory.add_message("user", "后天上海到杭州")
+        memory.add_message("assistant", "G7501 08:00 出发")
+        memory.clear_session()
+        memory.save_history()
+
+        reloaded = client_module.ConversationMemory(path)
+        messages = reloaded.history[-1]["messages"]
+        assert isinstance(messages, client_module.MessageLog)
+        assert messages.llm_messages() == [{"role": "user", "content": "后天上海到杭州"},
+                                           {"role": "assistant", "content": "G7501 08:00 出发"}]
+        assert messages.to_records() == memory.history[-1]["messages"].to_records()
+
+
+def main():
+    tests = [
+        test_message_log_round_trip,
+        test_message_log_views,
+        test_history_file_round_trip,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
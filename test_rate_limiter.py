@@ -0,0 +1,179 @@
+"""
+测试脚本：验证 MCP 请求限速（令牌桶补充、交互请求优先、为交互请求保留令牌）、Retry-After 暂停和限速配置校验
+不需要 MCP 服务器和 API Key
+
+运行: python test_rate_limiter.py  或  pytest test_rate_limiter.py
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from aiohttp import web
+
+from conftest import client_module
+
+
+RateLimiter = client_module.RateLimiter
+
+
+def test_bucket_refills_at_rate():
+    """令牌用完后按 rate 补充：突发 burst 个请求立即放行，之后每个请求约等待 1/rate 秒"""
+    async def run():
+        limiter = RateLimiter(default_rate=20, default_burst=2)
+        started = time.monotonic()
+        for _ in range(4):
+            await limiter.acquire("get-tickets")
+        return time.monotonic() - started, limiter.stats()
+
+    elapsed, stats = asyncio.run(run())
+    assert 0.08 <= elapsed < 0.3, elapsed
+    assert stats["buckets"]["get-tickets"]["acquired"] == 4 and stats["queue_depth"] == 0
+
+
+def test_interactive_before_background():
+    """排队时交互请求先于更早到达的后台请求放行，同一优先级按到达顺序"""
+    async def run():
+        limiter = RateLimiter(default_rate=20, default_burst=1, background_reserve=0)
+        await limiter.acquire("get-tickets")
+        order = []
+
+        async def request(name, priority):
+            await limiter.acquire("get-tickets", priority)
+            order.append(name)
+
+        tasks = []
+        for name, priority in (("bg1", RateLimiter.BACKGROUND), ("bg2", RateLimiter.BACKGROUND),
+                               ("user", RateLimiter.INTERACTIVE)):
+            tasks.append(asyncio.ensure_future(request(name, priority)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order, limiter.stats()["waits"]
+
+    order, waits = asyncio.run(run())
+    assert order == ["user", "bg1", "bg2"], order
+    assert waits["interactive"]["requests"] == 2 and waits["background"]["requests"] == 2
+
+
+def test_background_reserve():
+    """后台请求不能取走最后 reserve 个令牌：交互请求仍可立即放行，排队中的后台请求取消后退出队列"""
+    async def run():
+        limiter = RateLimiter(default_rate=0.01, default_burst=3, background_reserve=1)
+        for _ in range(2):
+            await asyncio.wait_for(limiter.acquire("k", RateLimiter.BACKGROUND), 0.1)
+        waiting = asyncio.ensure_future(limiter.acquire("k", RateLimiter.BACKGROUND))
+        await asyncio.sleep(0.05)
+        blocked = not waiting.done() and limiter.stats()["queue_depth"] == 1
+        await asyncio.wait_for(limiter.acquire("k", RateLimiter.INTERACTIVE), 0.1)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        return blocked, limiter.stats()["queue_depth"]
+
+    blocked, depth = asyncio.run(run())
+    assert blocked and depth == 0
+
+
+def test_pause_blocks_all_requests():
+    """pause 期间（Retry-After）所有请求都不放行，未限速的桶也一样；结束后恢复"""
+    async def run():
+        limiter = RateLimiter()
+        await limiter.acquire("a")
+        limiter.pause(0.3)
+        started = time.monotonic()
+        await asyncio.gather(limiter.acquire("a"), limiter.acquire("b", RateLimiter.BACKGROUND))
+        return time.monotonic() - started, limiter.throttled
+
+    elapsed, throttled = asyncio.run(run())
+    assert 0.28 <= elapsed < 0.6 and throttled == 1, elapsed
+
+
+def test_parse_retry_after():
+    """Retry-After 支持秒数和 HTTP 日期；负数按 0 处理，无法解析时返回 None"""
+    assert client_module.parse_retry_after("2") == 2.0
+    assert client_module.parse_retry_after("-5") == 0.0
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < client_module.parse_retry_after(later) <= 30
+    for value in (None, "", "soon"):
+        assert client_module.parse_retry_after(value) is None
+
+
+def test_request_honours_retry_after():
+    """服务器返回 429 + Retry-After 时暂停该服务器的请求，按要求的时间后重试"""
+    calls = []
+
+    async def handle(request):
+        calls.append(time.monotonic())
+        body = await request.json()
+        if len(calls) == 1:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        return web.json_response({"jsonrpc": "2.0", "id": body["id"], "result": {"ok": True}})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/mcp", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        settings = client_module.ConnectionSettings(retry_attempts=2, retry_delay=0.1)
+        server = client_module.MCPServerConnection("fake", f"http://127.0.0.1:{port}")
+        server.open_session(settings)
+        try:
+            return await server.request("tools/list", None, settings), server.limiter.throttled
+        finally:
+            await server.session.close()
+            await runner.cleanup()
+
+    result, throttled = asyncio.run(run())
+    assert result == {"ok": True} and throttled == 1
+    assert 0.95 <= calls[1] - calls[0] < 1.5, calls[1] - calls[0]
+
+
+def test_configure_and_validation():
+    """热加载的限速参数立即作用于已有令牌桶；突发数小于 1 的配置被拒绝"""
+    limiter = RateLimiter(default_rate=1, default_burst=5)
+    bucket = limiter.bucket("get-tickets")
+    limiter.configure(2, 3, {"get-tickets": {"rate": 4, "burst": 2}}, 1)
+    assert (bucket.rate, bucket.burst, bucket.tokens) == (4.0, 2.0, 2.0)
+    assert limiter.bucket("other").burst == 3.0
+
+    settings = client_module._compile_settings(client_module.Settings, {
+        "rate_limit": {"default_rate": 5, "default_burst": 10, "tools": {"get-tickets": {"rate": 2, "burst": 5}}}})
+    assert settings.rate_limit.default_burst == 10.0 and settings.rate_limit.tools["get-tickets"]["burst"] == 5
+    assert client_module.Settings().rate_limit.default_burst == 1.0
+    for bad in ({"default_burst": 0.5}, {"tools": {"get-tickets": {"burst": 0}}},
+                {"tools": {"get-tickets": {"rate": "fast"}}}, {"tools": {"get-tickets": 5}}, {"tools": []}):
+        try:
+            client_module._compile_settings(client_module.Settings, {"rate_limit": bad})
+        except ValueError as e:
+            assert "rate_limit" in str(e), e
+        else:
+            raise AssertionError(f"无效限速配置未报错: {bad}")
+
+
+def main():
+    tests = [
+        test_bucket_refills_at_rate,
+        test_interactive_before_background,
+        test_background_reserve,
+        test_pause_blocks_all_requests,
+        test_parse_retry_after,
+        test_request_honours_retry_after,
+        test_configure_and_validation,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
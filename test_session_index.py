@@ -0,0 +1,154 @@
+"""
+测试脚本：验证历史会话的 BM25 检索（中文二元组切词、numpy 与纯 Python 一致）以及在线程池中建立索引时的并发安全
+不需要 MCP 服务器和 API Key
+
+运行: python test_session_index.py  或  pytest test_session_index.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+
+from conftest import client_module
+
+
+SESSIONS = [
+    ("s1", "北京到上海明天的高铁", "北京→上海 高铁"),
+    ("s2", "广州到深圳的动车", "广州→深圳 动车"),
+    ("s3", "北京到上海的卧铺 G101", "北京→上海 卧铺"),
+    ("s4", "成都去重庆周末", "成都→重庆"),
+]
+
+
+def build(sessions=SESSIONS):
+    index = client_module.SessionIndex()
+    for session_id, text, snippet in sessions:
+        index.add(session_id, text, snippet)
+    return index
+
+
+def test_tokenize_bigrams_and_ascii():
+    """中文按二元组切分（单字保留），字母数字转小写"""
+    assert client_module.SessionIndex.tokenize("北京南到G101") == ["北京", "京南", "南到", "g101"]
+    assert client_module.SessionIndex.tokenize("去 上海") == ["去", "上海"]
+
+
+def test_search_ranks_matching_route_first():
+    """同路线的会话排在前面，与问题无关的会话不出现"""
+    index = build()
+    hits = index.search("北京到上海还有卧铺吗", 5)
+    docs = [doc for _, doc in hits]
+    assert docs[0] == 2 and set(docs[:2]) == {0, 2}, hits
+    assert 3 not in docs
+    assert index.search("拉萨", 5) == []
+
+
+def test_numpy_and_python_scores_match():
+    """安装 NumPy 时向量化计算的得分与纯 Python 实现一致"""
+    if client_module.np is None:
+        return
+    index = build()
+    vectorized = index.search("北京到上海的高铁", 5)
+    original = client_module.np
+    client_module.np = None
+    try:
+        fallback = index.search("北京到上海的高铁", 5)
+    finally:
+        client_module.np = original
+    assert [doc for _, doc in vectorized] == [doc for _, doc in fallback]
+    assert all(abs(a - b) < 1e-9 for (a, _), (b, _) in zip(vectorized, fallback))
+
+
+def test_readd_only_updates_snippet():
+    """同一会话 ID 重复加入时只更新片段，不重复计入文档"""
+    index = build()
+    index.add("s1", "北京到上海明天的高铁", "新摘要")
+    assert len(index) == len(SESSIONS)
+    index.set_snippet("s2", "广深摘要")
+    assert index.snippets[:2] == ["新摘要", "广深摘要"]
+
+
+def test_background_build_publishes_complete_index():
+    """在其他线程建立索引期间：检索不使用半成品索引，新结束的会话在索引发布前补入"""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = client_module.ConversationMemory(os.path.join(tmp, "history.json"))
+        for session_id, text, _ in SESSIONS:
+            log = client_module.MessageLog()
+            log.append("user", text)
+            memory.history.append({"session_id": session_id, "messages": log})
+
+        reading, resume = threading.Event(), threading.Event()
+
+        def slow_archive():
+            reading.set()
+            resume.wait(5)
+            return iter(())
+
+        memory.iter_archived_sessions = slow_archive
+        builder = threading.Thread(target=memory.build_index)
+        builder.start()
+        assert reading.wait(5)
+        assert memory.index is None
+        assert memory.get_relevant_context("北京到上海", 300) == ""
+        memory.add_message("user", "拉萨到西宁的卧铺")
+        memory.clear_session()
+        resume.set()
+        builder.join(5)
+
+        assert memory.index is not None and len(memory.index) == len(SESSIONS) + 1
+        assert "拉萨到西宁" in memory.get_relevant_context("拉萨到西宁", 300)
+
+
+def test_relevant_context_builds_index_off_loop():
+    """事件循环中检索时索引尚未建立：立即返回空串，在线程池中建立索引，之后的检索使用新索引"""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = client_module.ConversationMemory(os.path.join(tmp, "history.json"))
+        for session_id, text, _ in SESSIONS:
+            log = client_module.MessageLog()
+            log.append("user", text)
+            memory.history.append({"session_id": session_id, "messages": log})
+        builder_threads = []
+
+        def record_thread():
+            builder_threads.append(threading.get_ident())
+            return iter(())
+
+        memory.iter_archived_sessions = record_thread
+
+        async def run():
+            assert memory.get_relevant_context("北京到上海", 300) == ""
+            for _ in range(100):
+                if memory.index is not None:
+                    break
+                await asyncio.sleep(0.01)
+            return memory.get_relevant_context("北京到上海", 300)
+
+        context = asyncio.run(run())
+        assert builder_threads and threading.get_ident() not in builder_threads
+        assert "北京到上海" in context
+
+
+def main():
+    tests = [
+        test_tokenize_bigrams_and_ascii,
+        test_search_ranks_matching_route_first,
+        test_numpy_and_python_scores_match,
+        test_readd_only_updates_snippet,
+        test_background_build_publishes_complete_index,
+        test_relevant_context_builds_index_off_loop,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+测试脚本：验证推测调用表的取用、过期、浪费上限，以及与工具缓存共享计算时的取消隔离
+不需要 MCP 服务器和 API Key
+
+运行: python test_speculation.py  或  pytest test_speculation.py
+"""
+import asyncio
+import sys
+
+from conftest import client_module
+
+
+def slow_call(calls: list, delay: float = 0.05, value: str = "ok"):
+    async def call():
+        calls.append(value)
+        await asyncio.sleep(delay)
+        return {"content": [{"type": "text", "text": value}]}
+    return call
+
+
+def test_take_matches_reordered_arguments():
+    """用 | 分隔的参数不区分顺序；取用后条目移除，第二次取用返回 None"""
+    calls = []
+
+    async def run():
+        spec = client_module.SpeculativeCalls()
+        assert spec.start("get-station-code-of-citys", {"citys": "北京|上海"}, slow_call(calls))
+        assert not spec.start("get-station-code-of-citys", {"citys": "上海|北京"}, slow_call(calls))
+        first = await spec.take("get-station-code-of-citys", {"citys": "上海|北京"})
+        second = await spec.take("get-station-code-of-citys", {"citys": "北京|上海"})
+        return spec, first, second
+
+    spec, first, second = asyncio.run(run())
+    assert first["content"][0]["text"] == "ok" and second is None
+    assert len(calls) == 1 and spec.used == 1 and spec.wasted == 0
+    assert spec.hidden_seconds >= 0
+
+
+def test_rejected_result_falls_through():
+    """accept 判定为不可用（如错误结果）时返回 None，由调用方正常调用，并计为浪费"""
+    async def run():
+        spec = client_module.SpeculativeCalls()
+        spec.start("get-current-date", {}, slow_call([], value="Error"))
+        result = await spec.take("get-current-date", {}, lambda value: value["content"][0]["text"] != "Error")
+        return spec, result
+
+    spec, result = asyncio.run(run())
+    assert result is None and spec.wasted == 1
+
+
+def test_expired_entry_is_dropped_not_cancelled():
+    """过期的推测只从表中移除并计为浪费，调用本身继续完成"""
+    calls, finished = [], []
+
+    async def run():
+        spec = client_module.SpeculativeCalls(ttl=0.01)
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            finished.append(1)
+            return {"content": []}
+
+        spec.start("get-current-date", {}, call)
+        await asyncio.sleep(0.02)
+        assert await spec.take("get-current-date", {}) is None
+        await spec.close()
+        return spec
+
+    spec = asyncio.run(run())
+    assert spec.wasted == 1 and finished == [1]
+
+
+def test_waste_cap_suppresses_and_probes():
+    """浪费比例超过上限后停止推测该工具，每 probe_every 次预测放行一次试探"""
+    async def run():
+        spec = client_module.SpeculativeCalls(ttl=0, min_samples=3, probe_every=3, max_waste_ratio=0.5)
+        started = []
+        for _ in range(9):
+            started.append(spec.start("get-current-date", {}, slow_call([], delay=0)))
+            await asyncio.sleep(0.001)
+        spec.expire()
+        await spec.close()
+        return spec, started
+
+    spec, started = asyncio.run(run())
+    assert started[:3] == [True, True, True], started
+    assert started[3:] == [False, False, True, False, False, True], started
+    assert spec.suppressed == 4
+
+
+def test_cancelled_taker_does_not_cancel_shared_call():
+    """取用推测结果的查询被取消时，推测调用（可能被其他查询通过工具缓存共享）继续完成并写入缓存"""
+    cache = client_module.ToolResultCache({"get-station-code-of-citys": 60})
+    calls = []
+    args = {"citys": "北京|上海"}
+
+    async def run():
+        spec = client_module.SpeculativeCalls()
+        compute = slow_call(calls, delay=0.05)
+        spec.start("get-station-code-of-citys", args,
+                   lambda: cache.get_or_compute("get-station-code-of-citys", args, compute, lambda v: True))
+        await asyncio.sleep(0.01)
+        other = asyncio.ensure_future(cache.get_or_compute("get-station-code-of-citys", args, compute,
+                                                           lambda v: True))
+        taker = asyncio.ensure_future(spec.take("get-station-code-of-citys", args))
+        await asyncio.sleep(0.01)
+        taker.cancel()
+        value, cached = await other
+        await spec.close()
+        return value, cached
+
+    value, cached = asyncio.run(run())
+    assert cached and value["content"][0]["text"] == "ok"
+    assert len(calls) == 1
+    assert asyncio.run(cache.contains("get-station-code-of-citys", args))
+
+
+def main():
+    tests = [
+        test_take_matches_reordered_arguments,
+        test_rejected_result_falls_through,
+        test_expired_entry_is_dropped_not_cancelled,
+        test_waste_cap_suppresses_and_probes,
+        test_cancelled_taker_does_not_cancel_shared_call,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
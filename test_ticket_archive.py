@@ -0,0 +1,118 @@
+"""
+测试脚本：验证车票快照归档的分区参数校验、写入/扫描往返以及 NumPy 与纯 Python 路径结果一致
+不需要 MCP 服务器和 API Key
+
+运行: python test_ticket_archive.py  或  pytest test_ticket_archive.py
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from conftest import client_module, ticket_result, train
+
+
+def ticket_text(trains):
+    """get-tickets 结果（带表头）；trains: [(车次, 出发时间, 到达时间, {席别: 余票})]"""
+    return ticket_result(*(train(code, start, arrive, "05:30", seats=seats) for code, start, arrive, seats in trains),
+                         header=True)
+
+
+def polls():
+    """同一天 G1 二等座在三次查询中 有票 -> 剩余 3 张 -> 无票，G3 一直有票"""
+    date = "2026-10-20"
+    return [
+        ("VNP", "AOH", date, ticket_text([("G1", "08:00", "13:30", {"二等座": 99}),
+                                          ("G3", "09:00", "14:30", {"二等座": 99})]), 1000.0),
+        ("VNP", "AOH", date, ticket_text([("G1", "08:00", "13:30", {"二等座": 3}),
+                                          ("G3", "09:00", "14:30", {"二等座": 99})]), 2000.0),
+        ("VNP", "AOH", date, ticket_text([("G1", "08:00", "13:30", {"二等座": 0}),
+                                          ("G3", "09:00", "14:30", {"二等座": 99})]), 3000.0),
+    ]
+
+
+def test_valid_partition():
+    """只接受 3 位大写字母的车站代码和 YYYY-MM-DD 日期"""
+    valid = client_module.TicketSnapshotArchive.valid_partition
+    assert valid("VNP", "AOH", "2026-10-20")
+    for args in [("../x", "AOH", "2026-10-20"), ("VNP", "AOH\n", "2026-10-20"), ("vnp", "AOH", "2026-10-20"),
+                 ("VNP", "A/H", "2026-10-20"), ("VNP", "AOH", "../2026-10-20"), ("VNP", None, "2026-10-20"),
+                 ("VNP", "AOH", "2026-10-20/..")]:
+        assert not valid(*args), args
+
+
+def test_invalid_arguments_not_written():
+    """record() 忽略不合法的参数，write() 跳过不合法的分区，归档目录外不会出现文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "archive")
+        archive = client_module.TicketSnapshotArchive(directory)
+        result = ticket_text([("G1", "08:00", "13:30", {"二等座": 5})])
+        archive.record({"fromStation": "../..", "toStation": "AOH", "date": "2026-10-20"}, result, 1000.0)
+        assert not archive._pending
+        written = archive.write([("VNP", "../../escape", "2026-10-20", result, 1000.0),
+                                 ("VNP", "AOH", "2026-10-20", result, 1000.0)])
+        assert len(written) == 1 and archive.snapshots_written == 1
+        assert sorted(os.listdir(tmp)) == ["archive"]
+        assert [p.name for p in Path(directory).iterdir()] == ["VNP-AOH"]
+
+
+def test_write_scan_round_trip():
+    """写入的快照可以按路线、日期、车次和席别扫描回来"""
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = client_module.TicketSnapshotArchive(tmp)
+        archive.write(polls())
+        snapshots = archive.scan("VNP", "AOH", "2026-10-20", "2026-10-20")
+        assert len(snapshots) == 6
+        assert sorted(snapshots.trains) == ["G1", "G3"] and snapshots.seats == ["二等座"]
+        g1 = archive.scan(train="G1")
+        assert [int(c) for c in g1.columns["count"]] == [99, 3, 0]
+        assert len(archive.scan(start_date="2026-10-21")) == 0
+        assert len(archive.scan(train="G9")) == 0
+
+
+def test_numpy_python_parity():
+    """NumPy 与纯 Python 路径的扫描结果和售罄规律一致"""
+    numpy = client_module.np
+    if numpy is None:
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = client_module.TicketSnapshotArchive(tmp)
+        archive.write(polls())
+        fast = archive.scan()
+        fast_profile = archive.sellout_profile(fast)
+        try:
+            client_module.np = None
+            slow = archive.scan()
+            slow_profile = archive.sellout_profile(slow)
+        finally:
+            client_module.np = numpy
+        assert fast.trains == slow.trains and fast.seats == slow.seats
+        for name in client_module.TicketSnapshotArchive.COLUMNS:
+            assert [float(v) for v in fast.columns[name]] == [float(v) for v in slow.columns[name]], name
+        assert fast_profile == slow_profile
+        g1 = next(p for p in fast_profile if p["train"] == "G1")
+        assert g1["sold_out"] == 1 and g1["departures"] == 1
+        assert fast_profile[0]["train"] == "G1"
+
+
+def main():
+    tests = [
+        test_valid_partition,
+        test_invalid_arguments_not_written,
+        test_write_scan_round_trip,
+        test_numpy_python_parity,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
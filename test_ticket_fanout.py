@@ -0,0 +1,125 @@
+"""
+测试脚本：验证多日期 × 多路线批量查票的参数解析、查询范围限制、并发上限、失败统计和汇总文本
+不需要 MCP 服务器和 API Key
+
+运行: python test_ticket_fanout.py  或  pytest test_ticket_fanout.py
+"""
+import asyncio
+import sys
+
+from conftest import client_module, ticket_result, train
+
+
+async def no_fetch(a, b, day):
+    return None
+
+
+def test_parse_arguments_dates():
+    """startDate + days 展开为连续日期（days 限制在 1..max_days）；dates 优先于 startDate/days"""
+    fanout = client_module.TicketFanout(no_fetch, max_days=5)
+    _, _, dates = fanout.parse_arguments({"fromStations": ["BJP"], "toStations": ["SHH"],
+                                          "startDate": "2026-12-30", "days": 3})
+    assert dates == ["2026-12-30", "2026-12-31", "2027-01-01"]
+    _, _, dates = fanout.parse_arguments({"startDate": "2026-10-20", "days": 30})
+    assert len(dates) == 5
+    _, _, dates = fanout.parse_arguments({"startDate": "2026-10-20", "days": -2})
+    assert dates == ["2026-10-20"]
+    _, _, dates = fanout.parse_arguments({"dates": ["2026-10-25", "2026-10-21"], "startDate": "2026-10-20"})
+    assert dates == ["2026-10-25", "2026-10-21"]
+    _, _, dates = fanout.parse_arguments({})
+    assert len(dates) == 5
+
+
+def test_parse_arguments_codes_and_errors():
+    """车站代码接受列表或逗号分隔字符串并转为大写；日期格式错误时抛出 ValueError"""
+    fanout = client_module.TicketFanout(no_fetch)
+    from_codes, to_codes, _ = fanout.parse_arguments({"fromStations": ["bjp", " TJP ", ""],
+                                                      "toStations": "shh, aoh,", "dates": ["2026-10-20"]})
+    assert from_codes == ["BJP", "TJP"] and to_codes == ["SHH", "AOH"]
+    assert fanout.parse_arguments({"dates": ["2026-10-20"]})[:2] == ([], [])
+    for arguments in ({"dates": ["2026/10/20"]}, {"startDate": "下周一"}, {"dates": ["2026-10-20", "x"]}):
+        try:
+            fanout.parse_arguments(arguments)
+        except ValueError:
+            continue
+        raise AssertionError(f"应拒绝 {arguments}")
+
+
+def test_search_limits():
+    """去重后的组合为空、天数或组合数超过上限时抛出 ValueError，且不发起查询"""
+    calls = []
+
+    async def fetch(a, b, day):
+        calls.append((a, b, day))
+        return ticket_result(train("G1", price=100))
+
+    fanout = client_module.TicketFanout(fetch, max_queries=6, max_days=3)
+    bad = [
+        (["BJP"], ["BJP"], ["2026-10-20"]),
+        (["BJP"], ["SHH"], []),
+        (["BJP"], ["SHH"], ["2026-10-20", "2026-10-21", "2026-10-22", "2026-10-23"]),
+        (["BJP", "TJP"], ["SHH", "AOH"], ["2026-10-20", "2026-10-21"]),
+    ]
+    for from_codes, to_codes, dates in bad:
+        try:
+            asyncio.run(fanout.search(from_codes, to_codes, dates))
+        except ValueError:
+            continue
+        raise AssertionError(f"应拒绝 {from_codes} {to_codes} {dates}")
+    assert calls == []
+    # 重复的日期和车站去重后只查询 3 个组合
+    result = asyncio.run(fanout.search(["BJP", "BJP"], ["SHH"], ["2026-10-20", "2026-10-20", "2026-10-21",
+                                                                   "2026-10-22"]))
+    assert len(calls) == 3 and len(result.queries) == 3
+
+
+def test_search_concurrency_and_failures():
+    """并发数不超过 concurrency；抛出异常或返回 None 的查询计为失败，其余结果合并为一张表"""
+    active = [0, 0]
+
+    async def fetch(a, b, day):
+        active[0] += 1
+        active[1] = max(active[1], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        if day.endswith("21"):
+            raise RuntimeError("timeout")
+        if a == "TJP" and day.endswith("22"):
+            return None
+        return ticket_result(train("G1", "09:00" if a == "TJP" else "08:00", price=500 if a == "BJP" else 300))
+
+    fanout = client_module.TicketFanout(fetch, concurrency=2)
+    dates = ["2026-10-20", "2026-10-21", "2026-10-22"]
+    result = asyncio.run(fanout.search(["BJP", "TJP"], ["SHH"], dates))
+    assert active[1] == 2
+    assert result.queries == [(date, a, "SHH") for date in dates for a in ("BJP", "TJP")]
+    assert result.failed == 3 and len(result.combined) == 3
+    assert [table is None for table in result.tables] == [False, False, True, True, False, True]
+
+    text = client_module.TicketFanout.render(result, client_module.TicketCriteria(sort=("price",)), str.lower)
+    assert "失败 3 次" in text and "2026-10-21 bjp→shh: 查询失败" in text
+    assert "2026-10-20 tjp→shh: 1 趟 / 300元 / 4h30m" in text
+    assert "最低价: 2026-10-20 tjp→shh 300元" in text
+
+
+def main():
+    tests = [
+        test_parse_arguments_dates,
+        test_parse_arguments_codes_and_errors,
+        test_search_limits,
+        test_search_concurrency_and_failures,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+测试脚本：验证车票列式表的解析（text / json 格式）、筛选排序，以及 NumPy 与纯 Python 路径结果一致
+不需要 MCP 服务器和 API Key
+
+运行: python test_ticket_table.py  或  pytest test_ticket_table.py
+"""
+import json
+import sys
+
+from conftest import client_module
+
+
+TEXT_RESULT = {"content": [{"type": "text", "text": "\n".join([
+    "车次 | 出发站 -> 到达站 | 出发时间 -> 到达时间 | 历时",
+    "G1(实际车次train_no: 24000000G10I) 北京南(telecode: VNP) -> 上海虹桥(telecode: AOH) 09:00 -> 13:37 历时：04:37",
+    "- 商务座: 剩余3张票 2318.0元",
+    "- 一等座: 有票 1060.0元",
+    "- 二等座: 无票 662.0元",
+    "G3(实际车次train_no: 24000000G30I) 北京南(telecode: VNP) -> 上海虹桥(telecode: AOH) 07:00 -> 11:40 历时：04:40",
+    "- 二等座: 剩余12张票 662.0元",
+    "D5(实际车次train_no: 24000000D50I) 北京(telecode: BJP) -> 上海(telecode: SHH) 19:30 -> 07:20 历时：11:50",
+    "- 二等座: 有票 409.5元",
+    "- 硬卧: 候补 600.0元",
+    "K101(实际车次train_no: 24000K101) 北京(telecode: BJP) -> 上海(telecode: SHH) 06:10 -> 06:00",
+    "- 硬座: 充足 177.5元",
+])}]}
+
+JSON_ROWS = [
+    {"start_train_code": "G7", "start_time": "12:00", "lishi": "04:30", "from_station": "北京南",
+     "to_station": "上海虹桥", "start_date": "2026-10-21",
+     "prices": [{"seat_name": "二等座", "num": "5", "price": 662}]},
+    {"start_train_code": "Z9", "start_time": "20:00", "lishi": "bad"},
+]
+
+
+# G1 全部售罄，G3 只有一等座有票：要求二等座时放宽席别，应只推荐 G3
+SOLD_OUT_RESULT = {"content": [{"type": "text", "text": "\n".join([
+    "G1(实际车次train_no: 24000000G10I) 北京南(telecode: VNP) -> 上海虹桥(telecode: AOH) 09:00 -> 13:37 历时：04:37",
+    "- 一等座: 无票 1060.0元",
+    "- 二等座: 无票 662.0元",
+    "G3(实际车次train_no: 24000000G30I) 北京南(telecode: VNP) -> 上海虹桥(telecode: AOH) 07:00 -> 11:40 历时：04:40",
+    "- 一等座: 剩余2张票 1060.0元",
+    "- 二等座: 无票 662.0元",
+])}]}
+
+
+def run_with(use_numpy: bool, fn):
+    """在指定路径（NumPy / 纯 Python）下执行 fn：建表和查询都要在同一路径下进行"""
+    numpy = client_module.np
+    try:
+        if not use_numpy:
+            client_module.np = None
+        return fn()
+    finally:
+        client_module.np = numpy
+
+
+def test_parse_text():
+    """文本格式：车次、区间、历时（缺省时由到达时间推算）和各席别余票"""
+    records = client_module.TicketTable.parse(TEXT_RESULT, "2026-10-20")
+    assert [r[0] for r in records] == ["G1", "G3", "D5", "K101"]
+    g1 = records[0]
+    assert g1[1:6] == ("北京南", "上海虹桥", "2026-10-20", 9 * 60, 4 * 60 + 37)
+    assert g1[6] == {"商务座": (3, 2318.0), "一等座": (99, 1060.0), "二等座": (0, 662.0)}
+    assert records[2][6]["硬卧"] == (0, 600.0)
+    # 没有"历时"字段时按到达时间推算（跨天）
+    assert records[3][5] == 23 * 60 + 50 and records[3][6]["硬座"][0] == 99
+
+
+def test_parse_json_and_garbage():
+    """json 格式逐行解析并跳过缺字段的行；无法识别的结果返回空列表"""
+    records = client_module.TicketTable.parse({"content": [{"type": "text", "text": json.dumps(JSON_ROWS)}]})
+    assert len(records) == 1
+    assert records[0][0] == "G7" and records[0][3] == "2026-10-21" and records[0][6] == {"二等座": (5, 662.0)}
+    for result in (None, "text", {"content": "x"}, {"content": [{"type": "text", "text": "查询失败"}]}):
+        assert client_module.TicketTable.parse(result) == []
+
+
+def test_select_filters_and_sort():
+    """按出发时间、席别余票筛选，并按偏好车型、票价排序（NumPy 与纯 Python 路径各跑一遍）"""
+    def check():
+        table = client_module.TicketTable.from_results([(TEXT_RESULT, "2026-10-20")])
+        criteria = client_module.TicketCriteria(seats=("二等座",), sort=("price", "depart"))
+        assert [table.codes[i] for i in table.select(criteria)] == ["D5", "G3"]
+        criteria = client_module.TicketCriteria(depart_after=8 * 60, depart_before=20 * 60, sort=("depart",))
+        assert [table.codes[i] for i in table.select(criteria)] == ["G1", "D5"]
+        criteria = client_module.TicketCriteria(train_types="GD", preferred_types="D", sort=("preference", "-depart"))
+        assert [table.codes[i] for i in table.select(criteria)] == ["D5", "G1", "G3"]
+        criteria = client_module.TicketCriteria(seats=("商务座",), min_seats=5)
+        assert table.select(criteria) == []
+        assert "均无余票" in table.render(criteria)
+
+    for use_numpy in ([True, False] if client_module.np is not None else [False]):
+        run_with(use_numpy, check)
+
+
+def test_numpy_python_parity():
+    """NumPy 与纯 Python 路径的筛选排序、行程段和渲染结果一致"""
+    if client_module.np is None:
+        return
+    results = [(TEXT_RESULT, "2026-10-20"), (TEXT_RESULT, "2026-10-21"),
+               ({"content": [{"type": "text", "text": json.dumps(JSON_ROWS)}]}, "2026-10-21"),
+               (SOLD_OUT_RESULT, "2026-10-22")]
+    criterias = [
+        client_module.TicketCriteria(),
+        client_module.TicketCriteria(seats=("二等座",), sort=("-seats", "arrive"), limit=3),
+        client_module.TicketCriteria(max_duration=5 * 60, max_price=1000, sort=("-price", "depart")),
+        client_module.TicketCriteria(arrive_before=20 * 60, train_types="GK", preferred_types="K",
+                                     sort=("preference", "duration", "depart")),
+        client_module.TicketCriteria(seats=("软卧",)),
+    ]
+
+    def query():
+        table = client_module.TicketTable.from_results(results)
+        return [(table.select(c), table.legs(c), table.render(c)) for c in criterias]
+
+    fast, slow = run_with(True, query), run_with(False, query)
+    for criteria, expected, actual in zip(criterias, fast, slow):
+        assert expected == actual, criteria
+
+
+def test_relaxed_seats_drop_sold_out_trains():
+    """偏好席别全部无票而放宽席别时，两条路径都丢弃全部售罄的车次"""
+    criteria = client_module.TicketCriteria(seats=("二等座",))
+
+    def query():
+        table = client_module.TicketTable.from_results([(SOLD_OUT_RESULT, "2026-10-20")])
+        return table.select(criteria), table.select(criteria, require_seats=False), table.legs(criteria), \
+            table.render(criteria)
+
+    for use_numpy in ([True, False] if client_module.np is not None else [False]):
+        strict, relaxed, legs, text = run_with(use_numpy, query)
+        assert strict == [] and relaxed == [1], (use_numpy, relaxed)
+        assert [leg[3] for leg in legs] == [1]
+        assert "G3" in text and "G1" not in text
+
+
+def main():
+    tests = [
+        test_parse_text,
+        test_parse_json_and_garbage,
+        test_select_filters_and_sort,
+        test_numpy_python_parity,
+        test_relaxed_seats_drop_sold_out_trains,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+测试脚本：验证 Token 记账器的单次查询/每日预算、跨天切换，以及接近预算时降级模型、预算用完时直接查票
+不需要 MCP 服务器和 API Key
+
+运行: python test_token_budget.py  或  pytest test_token_budget.py
+"""
+import asyncio
+import sys
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+from conftest import client_module, make_client
+
+
+def usage(prompt_tokens, completion_tokens=0):
+    """模拟 OpenAI 响应中的 usage 对象"""
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+class FakeDatetime(datetime):
+    """now() 返回 today 指定的日期，用于模拟跨天"""
+    today = "2026-10-20"
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.strptime(cls.today, "%Y-%m-%d")
+
+
+def test_per_query_budget():
+    """单次查询：下一轮提示至少和上一轮一样长，预计超出预算时停止；达到 degrade_ratio 时需要降级"""
+    accountant = client_module.TokenAccountant(per_query_tokens=1000, degrade_ratio=0.8)
+    query = accountant.start_query()
+    assert accountant.can_continue(query) and not accountant.should_degrade(query)
+    accountant.record(query, usage(300, 100), "m")
+    # 已用 400，下一轮至少 300：700 <= 1000
+    assert accountant.can_continue(query) and not accountant.should_degrade(query)
+    accountant.record(query, usage(350, 100), "m")
+    # 已用 850，下一轮至少 350：超出预算；850 >= 800 需要降级
+    assert not accountant.can_continue(query) and accountant.should_degrade(query)
+    # 新查询重新计算，会话用量累计
+    assert accountant.can_continue(accountant.start_query())
+    assert accountant.session_usage["calls"] == 2 and accountant.total_tokens(accountant.session_usage) == 850
+
+
+def test_per_day_budget_and_pricing():
+    """每日预算跨查询累计，用完后 day_exhausted；按模型单价（每千 token）计算费用"""
+    accountant = client_module.TokenAccountant(per_day_tokens=1000,
+                                               pricing={"m": {"prompt": 1.0, "completion": 2.0}})
+    for _ in range(2):
+        accountant.record(accountant.start_query(), usage(300, 100), "m")
+    query = accountant.start_query()
+    assert accountant.day_tokens() == 800 and not accountant.day_exhausted()
+    assert accountant.should_degrade(query)
+    accountant.record(query, usage(150, 50), "m")
+    assert accountant.day_exhausted() and not accountant.can_continue(query)
+    summary = accountant.summary()
+    assert summary["today"]["calls"] == 3 and summary["per_day_budget"] == 1000
+    assert summary["today"]["cost"] == 0.5 + 0.5 + 0.25
+    # 未配置单价的模型不计费
+    accountant.record(accountant.start_query(), usage(100), "other")
+    assert accountant.summary()["today"]["cost"] == summary["today"]["cost"]
+
+
+def test_day_rollover():
+    """日期变化后每日用量从零开始，只保留最近 31 天的记录"""
+    accountant = client_module.TokenAccountant(per_day_tokens=1000)
+    original = client_module.datetime
+    client_module.datetime = FakeDatetime
+    try:
+        FakeDatetime.today = "2026-10-20"
+        accountant.record(accountant.start_query(), usage(1000), "m")
+        assert accountant.day_exhausted()
+        FakeDatetime.today = "2026-10-21"
+        assert accountant.day_tokens() == 0 and not accountant.day_exhausted()
+        for day in range(1, 32):
+            FakeDatetime.today = f"2026-11-{day:02d}" if day <= 30 else "2026-12-01"
+            accountant.record(accountant.start_query(), usage(10), "m")
+        assert len(accountant._local_daily) == 31 and "2026-10-20" not in accountant._local_daily
+    finally:
+        client_module.datetime = original
+    # 会话用量不随日期清零
+    assert accountant.total_tokens(accountant.session_usage) == 1000 + 31 * 10
+
+
+def test_degrade_to_fallback_model():
+    """用量接近预算且配置了降级模型时改用更便宜的模型；未配置降级模型时保持端点默认模型"""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp, budget={"per_query_tokens": 1000, "fallback_model": "cheap-model"})
+        query = client.accountant.start_query()
+        assert client._select_model(query) is None
+        client.accountant.record(query, usage(700, 100), "m")
+        assert client._select_model(query) == "cheap-model"
+        client.fallback_model = ""
+        assert client._select_model(query) is None
+
+
+def test_day_exhausted_uses_direct_query():
+    """今日预算用完时不再调用 LLM，改为直接查票；直接查询失败时提示额度已用完"""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp, budget={"per_day_tokens": 100})
+        client.is_connected = True
+        client.tools_cache = [{"type": "function", "function": {"name": "get-tickets", "parameters": {}}}]
+        client.accountant.record(client.accountant.start_query(), usage(100), "m")
+        llm_calls = []
+        direct_answers = ["🚄 直接查询结果", None]
+
+        async def llm_create(**kwargs):
+            llm_calls.append(kwargs)
+            raise AssertionError("预算用完后不应调用 LLM")
+
+        async def direct_ticket_query(message):
+            return direct_answers.pop(0)
+
+        client._llm_create = llm_create
+        client._direct_ticket_query = direct_ticket_query
+        assert asyncio.run(client.chat("明天北京到上海")) == "🚄 直接查询结果"
+        assert "额度已用完" in asyncio.run(client.chat("明天北京到上海"))
+        assert llm_calls == []
+
+
+def main():
+    tests = [
+        test_per_query_budget,
+        test_per_day_budget_and_pricing,
+        test_day_rollover,
+        test_degrade_to_fallback_model,
+        test_day_exhausted_uses_direct_query,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+测试脚本：验证工具结果缓存的并发去重、取消隔离和后端出错时的降级
+不需要 MCP 服务器和 API Key
+
+运行: python test_tool_cache.py  或  pytest test_tool_cache.py
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from conftest import client_module
+
+
+def make_compute(calls: list, delay: float = 0.05, value: str = "ok"):
+    async def compute():
+        calls.append(value)
+        await asyncio.sleep(delay)
+        return {"content": [{"type": "text", "text": value}]}
+    return compute
+
+
+def test_concurrent_misses_compute_once():
+    """同一键的并发未命中只计算一次，其余调用得到同一个结果"""
+    cache = client_module.ToolResultCache({"t": 60})
+    calls = []
+
+    async def run():
+        return await asyncio.gather(*(
+            cache.get_or_compute("t", {"x": 1}, make_compute(calls), lambda v: True) for _ in range(5)
+        ))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1, calls
+    assert [cached for _, cached in results].count(False) == 1
+    assert all(value == results[0][0] for value, _ in results)
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    """发起计算的调用被取消时，两个等待者都不会收到 CancelledError，由其中一个重新计算"""
+    cache = client_module.ToolResultCache({"t": 60})
+    calls = []
+
+    async def run():
+        leader = asyncio.ensure_future(cache.get_or_compute("t", {"x": 1}, make_compute(calls), lambda v: True))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.ensure_future(cache.get_or_compute("t", {"x": 1}, make_compute(calls), lambda v: True))
+                   for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        assert leader.cancelled()
+        return results
+
+    results = asyncio.run(run())
+    assert len(calls) == 2, calls
+    assert all(value["content"][0]["text"] == "ok" for value, _ in results)
+    assert not cache._inflight
+
+
+def test_leader_error_propagates_to_waiters():
+    """计算出错（非取消）时，等待者收到同一个异常"""
+    cache = client_module.ToolResultCache({"t": 60})
+
+    async def fail():
+        await asyncio.sleep(0.02)
+        raise RuntimeError("boom")
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute("t", {}, fail, lambda v: True) for _ in range(2)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results), results
+
+
+def test_uncacheable_result_is_shared_but_not_a_hit():
+    """不可缓存的结果（如错误）仍共享给并发的等待者，但等待者不计为命中，返回 from_cache=False"""
+    cache = client_module.ToolResultCache({"t": 60})
+    calls = []
+
+    async def run():
+        return await asyncio.gather(*(
+            cache.get_or_compute("t", {}, make_compute(calls, value="Error: busy"), lambda v: False)
+            for _ in range(3)
+        ))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert [cached for _, cached in results] == [False, False, False]
+    assert cache.hits == 0 and cache.misses == 1
+    assert not asyncio.run(cache.contains("t", {}))
+
+
+def test_blocking_backend_contains_off_loop():
+    """会阻塞的后端（如被锁住的 SQLite）的 contains 在线程池中执行，不阻塞事件循环"""
+    class SlowBackend(client_module.MemoryCacheBackend):
+        blocking = True
+
+        def contains(self, key):
+            time.sleep(0.2)
+            return False
+
+    cache = client_module.ToolResultCache({"t": 60}, backend=SlowBackend())
+
+    async def run():
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0)
+        found = await cache.contains("t", {})
+        task.cancel()
+        return found, len(ticks)
+
+    found, ticks = asyncio.run(run())
+    assert not found and ticks >= 5, ticks
+
+
+def test_sqlite_backend_shared_and_error_tolerant():
+    """SQLite 后端：第二个实例命中第一个实例写入的结果；数据库出错时按未命中处理，不影响工具调用"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite3")
+        first = client_module.ToolResultCache({"t": 60}, backend=client_module.SQLiteCacheBackend(path))
+        second = client_module.ToolResultCache({"t": 60}, backend=client_module.SQLiteCacheBackend(path))
+        calls = []
+
+        async def run():
+            await first.get_or_compute("t", {"x": 1}, make_compute(calls), lambda v: True)
+            return await second.get_or_compute("t", {"x": 1}, make_compute(calls), lambda v: True)
+
+        value, cached = asyncio.run(run())
+        assert cached and len(calls) == 1
+
+        def broken(*args):
+            raise sqlite3.OperationalError("database is locked")
+
+        second.backend.get = second.backend.set = second.backend.try_lease = second.backend.release = broken
+        second.backend.contains = broken
+        value, cached = asyncio.run(second.get_or_compute("t", {"x": 2}, make_compute(calls), lambda v: True))
+        assert not cached and value["content"][0]["text"] == "ok"
+        assert not asyncio.run(second.contains("t", {"x": 2}))
+        first.backend.close()
+        second.backend.close()
+
+
+def test_incomplete_backend_rejected():
+    """未实现 get/set 的后端在构造时即报错"""
+    class Incomplete(client_module.CacheBackend):
+        def get(self, key):
+            return None
+
+    try:
+        Incomplete()
+    except TypeError:
+        return
+    raise AssertionError("缺少 set 的后端应无法实例化")
+
+
+def main():
+    tests = [
+        test_concurrent_misses_compute_once,
+        test_cancelled_leader_does_not_cancel_waiters,
+        test_leader_error_propagates_to_waiters,
+        test_uncacheable_result_is_shared_but_not_a_hit,
+        test_blocking_backend_contains_off_loop,
+        test_sqlite_backend_shared_and_error_tolerant,
+        test_incomplete_backend_rejected,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+测试脚本：验证工具循环控制（同参数重复调用复用结果、查票成功后提前收尾、按最近查询轮数自适应收紧最大轮数）
+不需要 MCP 服务器和 API Key
+
+运行: python test_tool_loop.py  或  pytest test_tool_loop.py
+"""
+import asyncio
+import sys
+import tempfile
+
+import conftest
+from conftest import client_module, completion, ticket_result, tool_call, train
+
+
+TICKETS = ticket_result(train("G1", "09:00", "13:37", "04:37", price=662.0))
+CODES = {"content": [{"type": "text", "text": '{"北京": {"station_code": "BJP"}, "上海": {"station_code": "SHH"}}'}]}
+TICKET_ARGS = {"date": "2026-10-20", "fromStation": "BJP", "toStation": "SHH"}
+
+
+def make_client(tmp):
+    """未连接的客户端：关闭推测调用和工具路由，工具调用和 LLM 请求由用例替换"""
+    client = conftest.make_client(tmp, speculation={"enabled": False}, tool_routing={"enabled": False})
+    client.is_connected = True
+    client.tools_cache = [{"type": "function", "function": {"name": name, "parameters": {"type": "object"}}}
+                          for name in ("get-station-code-of-citys", "get-tickets")]
+    return client
+
+
+def run_scripted(client, responses, results):
+    """按顺序返回 responses 中的 LLM 响应，工具调用返回 results[工具名]；返回 (回复, LLM 请求参数, 工具调用)"""
+    requests, calls = [], []
+
+    async def llm_create(**kwargs):
+        requests.append(kwargs)
+        return responses[len(requests) - 1], "fake-model"
+
+    async def call_tool(name, arguments, **kwargs):
+        calls.append((name, arguments))
+        return results[name]
+
+    client._llm_create = llm_create
+    client.call_tool = call_tool
+    answer = asyncio.run(client.chat("明天北京到上海"))
+    return answer, requests, calls
+
+
+def test_state_reuses_duplicate_calls():
+    """同一查询中参数相同的调用返回上次结果并计为重复，重复达到 max_repeats 后要求收尾"""
+    state = client_module.ToolLoopState(max_repeats=2)
+    assert state.lookup("get-station-code-of-citys", {"citys": "北京"}) is None
+    state.remember("get-station-code-of-citys", {"citys": "北京"}, "BJP", ok=True)
+    assert state.lookup("get-station-code-of-citys", {"citys": "上海"}) is None
+    assert state.lookup("get-station-code-of-citys", {"citys": "北京"}) == "BJP"
+    assert state.repeats == 1 and not state.should_finalize()
+    state.lookup("get-station-code-of-citys", {"citys": "北京"})
+    assert state.should_finalize()
+
+
+def test_state_finalizes_after_tickets():
+    """查票成功的路线数达到预计路线数后收尾；失败的查票不计入；批量查票一次覆盖全部路线；可关闭提前收尾"""
+    controller = client_module.ToolLoopController()
+    state = controller.start_query(["北京", "南京", "上海"])
+    assert state.expected_routes == 2
+    state.remember("get-tickets", TICKET_ARGS, "失败", ok=False)
+    state.remember("get-tickets", dict(TICKET_ARGS, toStation="NJH"), "G1", ok=True)
+    assert not state.should_finalize()
+    state.remember("get-tickets", dict(TICKET_ARGS, fromStation="NJH"), "G3", ok=True)
+    assert state.should_finalize()
+
+    state = controller.start_query(["北京", "南京", "上海"])
+    state.remember(client_module.TicketFanout.TOOL_NAME, {}, "汇总", ok=True)
+    assert state.should_finalize()
+
+    state = client_module.ToolLoopController(finalize_after_tickets=False).start_query([])
+    assert state.expected_routes == 1
+    state.remember("get-tickets", TICKET_ARGS, "G1", ok=True)
+    assert not state.should_finalize()
+
+
+def test_adaptive_iteration_cap():
+    """样本不足 5 个或关闭自适应时使用配置值；否则取最近轮数的 P90 加余量，不低于 min_iterations、不超过配置值"""
+    controller = client_module.ToolLoopController(min_iterations=2, window=20, margin=1)
+    for _ in range(4):
+        controller.record_outcome(2, exhausted=False)
+    assert controller.allowed_iterations(10) == 10
+    controller.record_outcome(3, exhausted=False)
+    assert controller.allowed_iterations(10) == 4
+    assert controller.allowed_iterations(3) == 3
+    # 轮数耗尽按多一轮计入，使限制在不够用时放宽
+    for _ in range(5):
+        controller.record_outcome(4, exhausted=True)
+    assert controller.allowed_iterations(10) == 6
+    # 窗口只保留最近 window 次
+    for _ in range(20):
+        controller.record_outcome(1, exhausted=False)
+    assert controller.allowed_iterations(10) == 2
+    controller.adaptive = False
+    assert controller.allowed_iterations(10) == 10
+
+
+def test_chat_reuses_duplicate_call_and_finalizes():
+    """对话中重复的工具调用不再请求服务器；查票成功后下一轮以 tool_choice=none 要求模型直接作答"""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        codes = tool_call("c1", "get-station-code-of-citys", {"citys": "北京|上海"})
+        responses = [
+            completion(tool_calls=[codes]),
+            completion(tool_calls=[tool_call("c2", "get-station-code-of-citys", {"citys": "北京|上海"}),
+                                   tool_call("c3", "get-tickets", TICKET_ARGS)]),
+            completion(content="G1 09:00 出发"),
+        ]
+        answer, requests, calls = run_scripted(client, responses, {"get-station-code-of-citys": CODES,
+                                                                   "get-tickets": TICKETS})
+        assert answer == "G1 09:00 出发"
+        assert [name for name, _ in calls] == ["get-station-code-of-citys", "get-tickets"]
+        tool_messages = [m for m in requests[-1]["messages"] if isinstance(m, dict) and m.get("role") == "tool"]
+        assert tool_messages[0]["content"] == tool_messages[1]["content"]
+        assert [r["tool_choice"] for r in requests] == ["auto", "auto", "none"]
+        # 成功的查询按实际轮数计入自适应上限
+        assert list(client.loop_controller._rounds) == [3]
+
+
+def main():
+    tests = [
+        test_state_reuses_duplicate_calls,
+        test_state_finalizes_after_tickets,
+        test_adaptive_iteration_cap,
+        test_chat_reuses_duplicate_call_and_finalizes,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+测试脚本：验证按查询挑选工具子集（常用工具、关键词规则、其他服务器工具的描述匹配、放宽）和 token 统计
+不需要 MCP 服务器和 API Key
+
+运行: python test_tool_selector.py  或  pytest test_tool_selector.py
+"""
+import sys
+
+from conftest import client_module
+
+
+# 12306-mcp 的工具，加上一个其他 MCP 服务器的工具（没有关键词规则）
+TOOL_DESCRIPTIONS = {
+    "get-current-date": "获取当前日期，以上海时区为准",
+    "get-stations-code-in-city": "通过中文城市名查询该城市所有火车站的名称及其对应的车站代码",
+    "get-station-code-of-citys": "通过中文城市名查询代表该城市的车站代码",
+    "get-station-code-by-names": "通过具体的中文车站名查询其车站代码和名称",
+    "get-station-by-telecode": "通过车站的电报码查询车站的详细信息",
+    "get-tickets": "查询12306余票信息",
+    "get-interline-tickets": "查询12306中转余票信息",
+    "get-train-route-stations": "查询特定列车车次在各站的到发时间和经停信息",
+    "get-tickets-range": "一次查询多个日期和多条路线的车票并汇总",
+    "get-weather-forecast": "查询城市未来几天的天气预报和气温",
+}
+
+
+def make_tools():
+    return [{"type": "function", "function": {"name": name, "description": description,
+                                              "parameters": {"type": "object", "properties": {}}}}
+            for name, description in TOOL_DESCRIPTIONS.items()]
+
+
+def selected(selector, query, **kwargs):
+    return {tool["function"]["name"] for tool in selector.select(query, **kwargs)}
+
+
+def test_rules_for_sample_queries():
+    """常用工具始终发送，其余工具只在问题命中对应规则时发送"""
+    selector = client_module.ToolSelector()
+    selector.update(make_tools())
+    always = set(client_module.ToolSelector.ALWAYS)
+    cases = {
+        "明天北京到上海的高铁": set(),
+        "下周哪天去上海最便宜": {"get-tickets-range"},
+        "北京到乌鲁木齐没有直达的话怎么中转": {"get-interline-tickets"},
+        "G1033 经停哪些站": {"get-train-route-stations"},
+        "G101几点到济南": {"get-train-route-stations"},
+        "北京有哪些火车站": {"get-stations-code-in-city"},
+        "北京南到上海虹桥": {"get-station-code-by-names"},
+        "从虹桥站出发去杭州": {"get-station-code-by-names"},
+        "VNP 是哪个车站": {"get-station-by-telecode"},
+        "去上海的车站在哪里": set(),
+        "明天上海天气怎么样": {"get-weather-forecast"},
+    }
+    for query, expected in cases.items():
+        assert selected(selector, query) == always | expected, (query, selected(selector, query) - always)
+
+
+def test_extra_and_widen():
+    """extra 中的工具（模型调用过的子集外工具）一并发送；widen=True 时发送全部工具"""
+    selector = client_module.ToolSelector()
+    tools = make_tools()
+    selector.update(tools)
+    assert "get-interline-tickets" in selected(selector, "明天北京到上海", extra={"get-interline-tickets"})
+    assert selector.select("明天北京到上海", widen=True) == tools
+
+
+def test_custom_always_and_rules():
+    """构造参数可以替换常用工具并增加或覆盖规则"""
+    selector = client_module.ToolSelector(always=["get-tickets"],
+                                          rules={"get-weather-forecast": [r"下雨|气温"],
+                                                 "get-interline-tickets": [r"转乘"]})
+    selector.update(make_tools())
+    assert selected(selector, "北京今天下雨吗") == {"get-tickets", "get-weather-forecast"}
+    assert selected(selector, "在南京转乘") == {"get-tickets", "get-interline-tickets"}
+    assert selected(selector, "怎么中转") == {"get-tickets"}
+
+
+def test_never_selects_empty_subset():
+    """常用工具不在工具表中（如主服务器未连接）且问题与其余工具都不匹配时发送全部工具，而不是空列表"""
+    weather = [tool for tool in make_tools() if tool["function"]["name"] == "get-weather-forecast"]
+    selector = client_module.ToolSelector()
+    selector.update(weather)
+    assert selector.select("明天北京到上海") == weather
+
+
+def test_prefixed_tool_names():
+    """工具名都带服务器前缀（server__tool）时，常用工具和规则按去掉前缀的名称匹配"""
+    prefixed = [{"type": "function", "function": dict(tool["function"], name=f"backup__{tool['function']['name']}")}
+                for tool in make_tools()]
+    selector = client_module.ToolSelector()
+    selector.update(prefixed)
+    always = {f"backup__{name}" for name in client_module.ToolSelector.ALWAYS}
+    assert selected(selector, "明天北京到上海") == always
+    assert selected(selector, "VNP 是哪个车站") == always | {"backup__get-station-by-telecode"}
+    assert selected(selector, "明天上海天气怎么样") == always | {"backup__get-weather-forecast"}
+
+
+def test_record_and_stats():
+    """按实际发送的工具估算 token，统计相对每次发送全部工具节省的比例"""
+    selector = client_module.ToolSelector()
+    assert selector.stats()["saved_ratio"] == 0.0
+    selector.update(make_tools())
+    subset = selector.select("明天北京到上海")
+    selector.record(subset)
+    selector.record(selector.select("", widen=True))
+    stats = selector.stats()
+    assert stats["requests"] == 2
+    assert stats["tool_tokens_full"] == 2 * sum(selector._tool_tokens.values())
+    assert stats["tool_tokens_full"] > stats["tool_tokens_sent"] > stats["tool_tokens_full"] / 2
+    assert 0 < stats["saved_ratio"] < 0.5
+
+
+def main():
+    tests = [
+        test_rules_for_sample_queries,
+        test_extra_and_widen,
+        test_custom_always_and_rules,
+        test_never_selects_empty_subset,
+        test_prefixed_tool_names,
+        test_record_and_stats,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ PASS - {test.__doc__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ FAIL - {test.__doc__}\n     {e}")
+    print(f"\n总计: {len(tests)}，失败: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()